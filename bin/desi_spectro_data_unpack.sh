@@ -104,22 +104,28 @@ for kk in ${src_dir}/*.sha256sum; do
 done
 #
 # Update transfer status after all nights are in place.
+# Collect the updates, then apply them with a single desi_transfer_status.
 #
+updates=()
 for night in "${nights[@]}"; do
     for e in ../../data/${night}/*; do
         expid=$(basename ${e})
-        ${verbose} && echo desi_transfer_status ${night} ${expid} rsync
-        ${test}    || desi_transfer_status ${night} ${expid} rsync
+        ${verbose} && echo "updates+=( '${night} ${expid} rsync' )"
+        updates+=( "${night} ${expid} rsync" )
         ${verbose} && echo "(cd ${e} && sha256sum --quiet --check checksum-${expid}.sha256sum)"
         ${test}    || (cd ${e} && sha256sum --quiet --check checksum-${expid}.sha256sum)
         if [[ $? == 0 ]]; then
-            ${verbose} && echo desi_transfer_status ${night} ${expid} checksum
-            ${test}    || desi_transfer_status ${night} ${expid} checksum
+            ${verbose} && echo "updates+=( '${night} ${expid} checksum' )"
+            updates+=( "${night} ${expid} checksum" )
         else
-            ${verbose} && echo desi_transfer_status --failure ${night} ${expid} checksum
-            ${test}    || desi_transfer_status --failure ${night} ${expid} checksum
+            ${verbose} && echo "updates+=( '${night} ${expid} checksum failure' )"
+            updates+=( "${night} ${expid} checksum failure" )
         fi
     done
-    ${verbose} && echo desi_transfer_status ${night} all backup
-    ${test}    || desi_transfer_status ${night} all backup
+    ${verbose} && echo "updates+=( '${night} all backup' )"
+    updates+=( "${night} all backup" )
 done
+if (( ${#updates[@]} > 0 )); then
+    ${verbose} && echo "printf '%s\n' \"\${updates[@]}\" | desi_transfer_status --from-file -"
+    ${test}    || printf '%s\n' "${updates[@]}" | desi_transfer_status --from-file -
+fi
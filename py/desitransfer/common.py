@@ -6,11 +6,14 @@ desitransfer.common
 
 Code needed by all scripts.
 """
+import asyncio
 import datetime as dt
 import os
 import re
 import stat
 import time
+from collections import namedtuple
+from tempfile import SpooledTemporaryFile
 import pytz
 
 MST = pytz.timezone('America/Phoenix')
@@ -21,6 +24,222 @@ dir_perm = (stat.S_ISGID |
 file_perm = stat.S_IRUSR | stat.S_IRGRP    # 0o0440
 
 
+async def _drain(stream, buffer, blocksize=2**16):
+    """Copy everything from an asyncio `stream` to `buffer`.
+
+    Parameters
+    ----------
+    stream : :class:`asyncio.StreamReader`
+        Output of a subprocess.
+    buffer : file-like
+        Write data to this object.
+    blocksize : :class:`int`, optional
+        Read at most this many bytes at a time.
+    """
+    while True:
+        chunk = await stream.read(blocksize)
+        if not chunk:
+            break
+        buffer.write(chunk)
+
+
+async def _apopen(command, timeout=None, spool=2**20, cwd=None):
+    """Run `command` as an asyncio subprocess.
+
+    Standard output and standard error are read through pipes into buffers
+    that are held in memory, and only written to disk if they
+    exceed `spool` bytes.  If the coroutine is cancelled, the
+    process is killed.
+
+    Parameters
+    ----------
+    command : :class:`list`
+        Command to run.
+    timeout : :class:`float`, optional
+        Kill the process if it has not finished after this many seconds.
+    spool : :class:`int`, optional
+        Keep at most this many bytes of each output stream in memory
+        (default 1 MiB).
+    cwd : :class:`str`, optional
+        Run `command` in this directory.
+
+    Returns
+    -------
+    :func:`tuple`
+        The returncode, standard output and standard error.
+    """
+    proc = await asyncio.create_subprocess_exec(*command,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE,
+                                                cwd=cwd)
+    with SpooledTemporaryFile(max_size=spool) as tout, SpooledTemporaryFile(max_size=spool) as terr:
+        timed_out = False
+        try:
+            await asyncio.wait_for(asyncio.gather(_drain(proc.stdout, tout),
+                                                  _drain(proc.stderr, terr),
+                                                  proc.wait()), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+        tout.seek(0)
+        out = tout.read().decode('utf-8')
+        terr.seek(0)
+        err = terr.read().decode('utf-8')
+    if timed_out:
+        err += "Command timed out after {0} seconds.\n".format(timeout)
+    return (str(proc.returncode), out, err)
+
+
+def _popen(command, timeout=None, cwd=None):
+    """Run `command` and wait for it to finish.
+
+    This is a synchronous wrapper on :func:`_apopen`, and is safe to call
+    from multiple threads.
+
+    Parameters
+    ----------
+    command : :class:`list`
+        Command to run.
+    timeout : :class:`float`, optional
+        Kill the process if it has not finished after this many seconds.
+    cwd : :class:`str`, optional
+        Run `command` in this directory.
+
+    Returns
+    -------
+    :func:`tuple`
+        The returncode, standard output and standard error.
+    """
+    return asyncio.run(_apopen(command, timeout=timeout, cwd=cwd))
+
+
+def _popen_many(commands, timeout=None, limit=None):
+    """Run several commands concurrently.
+
+    Parameters
+    ----------
+    commands : :class:`list`
+        A list of commands.
+    timeout : :class:`float`, optional
+        Kill any process that has not finished after this many seconds.
+    limit : :class:`int`, optional
+        Run at most this many processes at the same time.
+
+    Returns
+    -------
+    :class:`list`
+        A list of returncode, standard output, standard error tuples,
+        in the same order as `commands`.
+    """
+    async def _run():
+        semaphore = asyncio.Semaphore(limit if limit else max(1, len(commands)))
+
+        async def _one(command):
+            async with semaphore:
+                return await _apopen(command, timeout=timeout)
+
+        return await asyncio.gather(*[_one(c) for c in commands])
+
+    return list(asyncio.run(_run()))
+
+
+_empty_rsync_re = re.compile(r'(receiving|sent [0-9]+ bytes|total size)')
+_new_exposures_re = re.compile(r'([0-9]{8})/?')
+_itemize_re = re.compile(r'([<>ch.*][fdLDS][^ ]{7,9}) +([0-9,]+) (.+)$')
+
+#
+# Pass this to rsync to obtain output that can be read by parse_rsync().
+#
+itemize_format = '--out-format=%i %l %n'
+
+
+class RsyncItem(namedtuple('RsyncItem', 'path, flags, size')):
+    """A single change reported by :command:`rsync --itemize-changes`.
+
+    Attributes
+    ----------
+    path : :class:`str`
+        Path relative to the top of the transfer. Directories end in ``/``.
+    flags : :class:`str`
+        The itemized change flags, *e.g.* ``>f+++++++++``.
+    size : :class:`int`
+        Size of the file in bytes.
+    """
+    __slots__ = ()
+
+    @property
+    def is_dir(self):
+        """``True`` if the item is a directory.
+        """
+        return self.flags[1] == 'd' and not self.deleted
+
+    @property
+    def is_file(self):
+        """``True`` if the item is a regular file.
+        """
+        return self.flags[1] == 'f'
+
+    @property
+    def new(self):
+        """``True`` if the item did not previously exist at the destination.
+        """
+        return self.flags[2:].strip('+') == ''
+
+    @property
+    def content(self):
+        """``True`` if file data were, or would be, transferred.
+        """
+        return self.flags[0] in '<>'
+
+    @property
+    def metadata(self):
+        """``True`` if only attributes such as time or permission changed.
+        """
+        return not self.new and not self.content
+
+    @property
+    def deleted(self):
+        """``True`` if the item was, or would be, deleted.
+        """
+        return self.flags.startswith('*deleting')
+
+    @property
+    def top(self):
+        """The first component of :attr:`path`, *e.g.* an exposure number.
+        """
+        return self.path.split('/', 1)[0]
+
+
+def parse_rsync(out):
+    """Parse output from :command:`rsync` run with :data:`itemize_format`.
+
+    Lines that are not itemized changes, such as the summary printed
+    by ``--verbose``, are ignored.  Sizes may include digit separators,
+    as printed by recent versions of :command:`rsync`.
+
+    Parameters
+    ----------
+    out : :class:`str` or iterable
+        Output from :command:`rsync`, either as a single string or
+        as an iterable of lines, for example an open file.
+
+    Yields
+    ------
+    :class:`RsyncItem`
+        A record of each change.
+    """
+    if isinstance(out, str):
+        out = out.split('\n')
+    for out_line in out:
+        m = _itemize_re.match(out_line.rstrip('\n'))
+        if m is not None:
+            flags, size, path = m.groups()
+            yield RsyncItem(path, flags, int(size.replace(',', '')))
+
+
 def empty_rsync(out):
     """Scan rsync output for files to be transferred.
 
@@ -34,8 +253,7 @@ def empty_rsync(out):
     :class:`bool`
         ``True`` if there are no files to transfer.
     """
-    rr = re.compile(r'(receiving|sent [0-9]+ bytes|total size)')
-    return all([rr.match(out_line) is not None for out_line in out.split('\n') if out_line])
+    return all([_empty_rsync_re.match(out_line) is not None for out_line in out.split('\n') if out_line])
 
 
 def new_exposures(out):
@@ -52,15 +270,127 @@ def new_exposures(out):
         The unique exposure numbers detected in `out`.
     """
     e = set()
-    e_re = re.compile(r'([0-9]{8})/?')
     for out_line in out.split('\n'):
-        m = e_re.match(out_line)
+        m = _new_exposures_re.match(out_line)
         if m is not None:
             e.add(m.groups()[0])
     return e
 
 
-def rsync(s, d, test=False, config='dts', reverse=False):
+class SSHMaster(object):
+    """Manage a persistent, multiplexed ssh connection to a remote host.
+
+    Commands built with :meth:`~SSHMaster.command` or :meth:`~SSHMaster.rsh`
+    share a single master connection, so they do not have to repeat
+    the ssh handshake.  If the master connection goes away, the next command
+    will start a new one automatically.
+
+    Parameters
+    ----------
+    host : :class:`str`, optional
+        Remote host or ssh configuration.
+    ssh : :class:`str`, optional
+        Path to ssh.
+    control_path : :class:`str`, optional
+        Path to the control socket; the default is in ``~/.ssh``.
+    persist : :class:`int`, optional
+        Keep an idle master connection open for this many minutes.
+    timeout : :class:`float`, optional
+        Wait this many seconds for the master connection to start.
+    """
+
+    def __init__(self, host='dts', ssh='/bin/ssh', control_path=None, persist=10, timeout=None):
+        self.host = host
+        self.ssh = ssh
+        if control_path is None:
+            control_path = os.path.join(os.path.expanduser('~'), '.ssh', 'desitransfer_%C')
+        self.control_path = control_path
+        self.persist = persist
+        self.timeout = timeout
+
+    @property
+    def options(self):
+        """ssh options needed to share the master connection.
+        """
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath={0}'.format(self.control_path),
+                '-o', 'ControlPersist={0:d}m'.format(self.persist)]
+
+    def command(self, *args):
+        """Build a command that runs `args` on the remote host.
+
+        Returns
+        -------
+        :class:`list`
+            A list suitable for passing to :func:`_popen`.
+        """
+        return [self.ssh] + self.options + ['-q', self.host] + list(args)
+
+    def rsh(self):
+        """Remote shell for :command:`rsync`.
+
+        Returns
+        -------
+        :class:`str`
+            A string suitable for passing to :command:`rsync -e`.
+        """
+        return ' '.join([self.ssh] + self.options)
+
+    def check(self):
+        """Check whether the master connection is running.
+
+        Returns
+        -------
+        :class:`bool`
+            ``True`` if the master connection is running.
+        """
+        cmd = [self.ssh, '-o', 'ControlPath={0}'.format(self.control_path),
+               '-O', 'check', self.host]
+        status, out, err = _popen(cmd, timeout=self.timeout)
+        return status == '0'
+
+    def start(self):
+        """Start the master connection in the background.
+
+        Returns
+        -------
+        :class:`bool`
+            ``True`` if the master connection was started.
+        """
+        cmd = [self.ssh, '-f', '-N', '-o', 'ControlMaster=yes',
+               '-o', 'ControlPath={0}'.format(self.control_path),
+               '-o', 'ControlPersist={0:d}m'.format(self.persist),
+               self.host]
+        status, out, err = _popen(cmd, timeout=self.timeout)
+        return status == '0'
+
+    def ensure(self):
+        """Start the master connection if it is not already running.
+
+        Returns
+        -------
+        :class:`bool`
+            ``True`` if the master connection is running.
+        """
+        if self.check():
+            return True
+        return self.start()
+
+    def stop(self):
+        """Ask the master connection to exit.
+
+        Returns
+        -------
+        :class:`bool`
+            ``True`` if the master connection was stopped.
+        """
+        cmd = [self.ssh, '-o', 'ControlPath={0}'.format(self.control_path),
+               '-O', 'exit', self.host]
+        status, out, err = _popen(cmd, timeout=self.timeout)
+        return status == '0'
+
+
+def rsync(s, d, test=False, config='dts', reverse=False, ssh=None, itemize=False):
     """Set up rsync command.
 
     Parameters
@@ -75,6 +405,11 @@ def rsync(s, d, test=False, config='dts', reverse=False):
         Pass this configuration to the ssh command.
     reverse : :class:`bool`
         If ``True``, attach `config` to `d` instead of `s`.
+    ssh : :class:`str`, optional
+        Use this remote shell, for example from :meth:`SSHMaster.rsh`.
+    itemize : :class:`bool`, optional
+        If ``True``, report changes in a form that can be read by
+        :func:`parse_rsync`.
 
     Returns
     -------
@@ -83,6 +418,10 @@ def rsync(s, d, test=False, config='dts', reverse=False):
     """
     c = ['/bin/rsync', '--verbose', '--recursive',
          '--copy-dirlinks', '--times', '--omit-dir-times']
+    if itemize:
+        c.append(itemize_format)
+    if ssh:
+        c += ['-e', ssh]
     if reverse:
         c += [s + '/', config + ':' + d + '/']
     else:
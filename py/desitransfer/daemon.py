@@ -16,17 +16,21 @@ import re
 import shutil
 import stat
 import subprocess as sub
+import tarfile
+import threading
 import time
 import traceback
 import requests
 from argparse import ArgumentParser
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from configparser import ConfigParser, ExtendedInterpolation
 from logging.handlers import RotatingFileHandler, SMTPHandler
 from socket import getfqdn
 from tempfile import TemporaryFile
 from desiutil.log import get_logger
-from .common import dir_perm, file_perm, rsync, yesterday, empty_rsync, new_exposures, ensure_scratch
+from .common import (dir_perm, file_perm, rsync, yesterday, empty_rsync, new_exposures,
+                     parse_rsync, ensure_scratch, SSHMaster, _popen, _popen_many)
 from .status import TransferStatus
 from . import __version__ as dtVersion
 
@@ -43,6 +47,8 @@ def _options():
     """
     desc = "Transfer DESI raw data files."
     prsr = ArgumentParser(description=desc)
+    prsr.add_argument('-b', '--bulk', metavar='NIGHT[,NIGHT...]',
+                      help="Transfer entire NIGHTs as a single tar stream, then exit.")
     prsr.add_argument('-B', '--no-backup', action='store_false', dest='backup',
                       help="Skip NERSC HPSS backups.")
     prsr.add_argument('-c', '--configuration', metavar='FILE',
@@ -68,7 +74,9 @@ class TransferDaemon(object):
         The parsed command-line options.
     """
     _link_re = re.compile(r'[0-9]{8}/[0-9]{8}$')
-    _directory = namedtuple('_directory', 'source, staging, destination, hpss, checksum')
+    _backup_job = namedtuple('_backup_job', 'proc, cmd, out, err')
+    _directory = namedtuple('_directory', ('source, staging, destination, hpss, checksum, ' +
+                                           'workers, verify_workers, batch, streams, interval'))
     _default_configuration = os.path.join(str(ir.files('desitransfer')), 'data', 'desi_transfer_daemon.ini')
 
     def __init__(self, options):
@@ -90,9 +98,45 @@ class TransferDaemon(object):
                                             self.conf[s]['staging'],
                                             self.conf[s]['destination'],
                                             self.conf[s]['hpss'],
-                                            self.conf[s]['checksum_file'])
+                                            self.conf[s]['checksum_file'],
+                                            self.conf[s].getint('workers', fallback=1),
+                                            self.conf[s].getint('verify_workers', fallback=0),
+                                            self.conf[s].getint('batch', fallback=0),
+                                            self.conf[s].getint('streams', fallback=1),
+                                            self.conf[s].getint('interval', fallback=0))
                             for s in self.sections]
         self.scratch = ensure_scratch(self.conf['common'].getlist('temporary'))
+        timeout = self.conf['common'].getint('timeout', fallback=0)
+        self.timeout = timeout * 60 if timeout > 0 else None
+        if self.conf['common'].getboolean('ssh_master', fallback=False):
+            self.ssh = SSHMaster('dts', ssh=self.conf['common']['ssh'],
+                                 persist=self.conf['common'].getint('ssh_persist', fallback=10),
+                                 timeout=self.timeout)
+        else:
+            self.ssh = None
+        self._checksum_caches = dict()
+        self._seen = dict()
+        self._retry = dict()
+        self._indexes = dict()
+        self._backups = dict()
+        self._catchups = dict()
+        self._lookback = dict()
+        self._hpss = dict()
+        self._hpss_lock = threading.Lock()
+        self._background = None
+        self._night_locks = dict()
+        self._night_locks_lock = threading.Lock()
+        self._indexes_lock = threading.Lock()
+        self._last_scan = dict()
+        self._last_full_scan = dict()
+        self._checksum_caches_lock = threading.Lock()
+        self._journals = dict()
+        self._journals_lock = threading.Lock()
+        self._sections = None
+        self._section_tasks = dict()
+        self._section_started = dict()
+        self._statuses = dict()
+        self._statuses_lock = threading.Lock()
         self._configure_log(options.debug)
         return
 
@@ -133,11 +177,42 @@ The DESI Collaboration Account
         handler2.setLevel(logging.CRITICAL)
         log.parent.addHandler(handler2)
 
+    def _ssh(self, *args):
+        """Build a command that runs `args` at KPNO.
+
+        Returns
+        -------
+        :class:`list`
+            A list suitable for passing to :func:`~desitransfer.common._popen`.
+        """
+        if self.ssh is None:
+            return [self.conf['common']['ssh'], '-q', 'dts'] + list(args)
+        return self.ssh.command(*args)
+
+    def _rsh(self):
+        """Remote shell for :func:`~desitransfer.common.rsync`.
+
+        Returns
+        -------
+        :class:`str`
+            The remote shell, or ``None`` to use the :command:`rsync` default.
+        """
+        if self.ssh is None:
+            return None
+        return self.ssh.rsh()
+
     def transfer(self):
         """Loop over and transfer all configured directories.
         """
+        if self.ssh is not None and not self.ssh.ensure():
+            log.warning('Could not start ssh master connection to dts; ' +
+                        'commands will open separate connections.')
         if self.checksum_lock():
             return
+        sections = self.conf['common'].getint('sections', fallback=1)
+        if sections > 1:
+            self.schedule(sections)
+            return
         for d in self.directories:
             log.info('Looking for new data in %s.', d.source)
             try:
@@ -146,6 +221,84 @@ The DESI Collaboration Account
                 log.critical("Exception detected in transfer of %s!\n\n%s",
                              d.source, traceback.format_exc())
 
+    def schedule(self, sections):
+        """Start transfers of configured directories as independent background tasks.
+
+        A directory is skipped if its previous transfer is still running,
+        or if its ``interval`` has not yet elapsed.
+
+        Parameters
+        ----------
+        sections : :class:`int`
+            Transfer at most this many directories at the same time.
+        """
+        if self._sections is None:
+            log.debug("ThreadPoolExecutor(max_workers=%d)", sections)
+            self._sections = ThreadPoolExecutor(max_workers=sections)
+        now = time.time()
+        for d in self.directories:
+            task = self._section_tasks.get(d.source)
+            if task is not None and not task.done():
+                log.debug("Transfer of %s is still running.", d.source)
+                continue
+            started = self._section_started.get(d.source)
+            if started is not None and now - started < d.interval * 60:
+                log.debug("Next transfer of %s is not due yet.", d.source)
+                continue
+            log.info('Looking for new data in %s.', d.source)
+            self._section_started[d.source] = now
+            self._section_tasks[d.source] = self._sections.submit(self.section, d)
+
+    def section(self, d):
+        """Transfer a single configured directory, reporting any exception.
+
+        Directories that share a status directory also share a
+        :class:`~desitransfer.status.TransferStatus` object while
+        they are running.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        """
+        directory = os.path.join(os.path.dirname(d.staging), 'status')
+        with self._statuses_lock:
+            status, users = self._statuses.get(directory, (None, 0))
+            if users == 0:
+                status = self._transfer_status(directory)
+            self._statuses[directory] = (status, users + 1)
+        try:
+            self.directory(d, status)
+        except Exception:
+            log.critical("Exception detected in transfer of %s!\n\n%s",
+                         d.source, traceback.format_exc())
+        finally:
+            with self._statuses_lock:
+                status, users = self._statuses[directory]
+                if users == 1:
+                    del self._statuses[directory]
+                else:
+                    self._statuses[directory] = (status, users - 1)
+
+    def _transfer_status(self, directory):
+        """Create a status object, configured by the ``status_journal``, ``status_database``
+        and ``status_export`` options.
+
+        Parameters
+        ----------
+        directory : :class:`str`
+            The status directory.
+
+        Returns
+        -------
+        :class:`~desitransfer.status.TransferStatus`
+            The status object.
+        """
+        database = self.conf['common'].get('status_database', fallback='')
+        return TransferStatus(directory, journal=self.conf['common'].getint('status_journal', fallback=0),
+                              database=database if database else None,
+                              export=self.conf['common'].getint('status_export', fallback=0))
+
     def checksum_lock(self):
         """See if checksums are being computed at KPNO.
 
@@ -154,56 +307,207 @@ The DESI Collaboration Account
         :class:`bool`
             ``True`` if checksums are being computed.
         """
-        cmd = [self.conf['common']['ssh'], '-q', 'dts',
-               '/bin/ls', self.conf['common']['checksum_lock']]
+        cmd = self._ssh('/bin/ls', self.conf['common']['checksum_lock'])
         log.debug(' '.join(cmd))
-        _, out, err = _popen(cmd)
+        _, out, err = _popen(cmd, timeout=self.timeout)
         if out:
             log.info('Checksums are being computed at KPNO.')
             return True
         return False
 
-    def directory(self, d):
+    def directory(self, d, status=None):
         """Data transfer operations for a single destination directory.
 
         Parameters
         ----------
         d : :func:`collections.namedtuple`
             Configuration for the destination directory.
+        status : :class:`desitransfer.status.TransferStatus`, optional
+            The status object associated with `d`. If not set, a new
+            status object will be created.
         """
-        status = TransferStatus(os.path.join(os.path.dirname(d.staging),
-                                             'status'))
+        if status is None:
+            status = self._transfer_status(os.path.join(os.path.dirname(d.staging),
+                                                        'status'))
+        #
+        # Reconcile the index, if necessary, before searching for links.
+        #
+        self.index(d)
         #
         # Find symlinks at KPNO.
         #
-        cmd = [self.conf['common']['ssh'], '-q', 'dts',
-               '/bin/find', d.source, '-type', 'l']
-        log.debug(' '.join(cmd))
-        _, out, err = _popen(cmd)
-        links = sorted([x for x in out.split('\n') if x])
+        links, full = self.links(d)
+        seen = self._seen.setdefault(d.source, set())
+        if full:
+            seen &= set(links)
+            self._retry.pop(d.source, None)
+        else:
+            #
+            # Exposures that failed are not found again by an incremental search.
+            #
+            links = sorted(set(links) | self._retry.pop(d.source, set()))
         if links:
+            valid_links = list()
             for link in links:
                 if self._link_re.search(link) is None:
                     log.warning("Malformed symlink detected: %s. Skipping.", link)
-                else:
+                elif link not in seen:
+                    valid_links.append(link)
+            if d.batch > 1 and len(valid_links) > 1:
+                self.batch_exposures(d, valid_links, status)
+            elif (d.workers > 1 or d.verify_workers > 0) and len(valid_links) > 1:
+                self.exposures(d, valid_links, status)
+            else:
+                for link in valid_links:
                     self.exposure(d, link, status)
-        else:
+        elif full:
             log.warning('No links found, check connection.')
+        else:
+            log.debug('No new links found.')
         #
         # Check for delayed files.
         #
-        yst = yesterday()
         now = int(dt.datetime.utcnow().strftime('%H'))
         if now >= self.conf['common'].getint('catchup'):
-            self.catchup(d, yst, status)
+            for night in self.lookback(d, 'catchup'):
+                if self.conf['common'].getint('catchup_workers', fallback=0) > 0:
+                    self.background_catchup(d, night, status)
+                else:
+                    self.catchup(d, night, status)
         #
         # Are any nights eligible for backup?
         #
+        self.backup_jobs(d, status)
         if now >= self.conf['common'].getint('backup'):
-            s = self.backup(d, yst, status)
-            if s and self.tape:
-                log.debug("status.update('%s', 'all', 'backup')", yst)
-                status.update(yst, 'all', 'backup')
+            for night in self.lookback(d, 'backup'):
+                s = self.backup(d, night, status)
+                if s and self.tape:
+                    log.debug("status.update('%s', 'all', 'backup')", night)
+                    status.update(night, 'all', 'backup')
+        #
+        # Drop installed exposures from the transfer journal.
+        #
+        journal = self.journal(d)
+        if journal is not None:
+            journal.compact()
+        #
+        # In journal or database mode, bring the status file up to date.
+        #
+        status.compact()
+
+    def lookback(self, d, task):
+        """Choose the nights that `task` should examine on this pass.
+
+        Yesterday is always examined.  If the ``lookback`` option is
+        greater than one, at most one older night within the look-back
+        window is added on each pass.  A night that is ``k`` nights older
+        than yesterday is only examined again after ``k`` times
+        ``lookback_interval`` minutes, so recent nights are checked most often.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        task : :class:`str`
+            The type of task, *e.g.* ``'catchup'`` or ``'backup'``.
+
+        Returns
+        -------
+        :class:`list`
+            The nights to examine, most recent first.
+        """
+        yst = yesterday()
+        nights = [yst]
+        window = self.conf['common'].getint('lookback', fallback=1)
+        if window <= 1:
+            return nights
+        interval = self.conf['common'].getint('lookback_interval', fallback=60) * 60
+        now = time.time()
+        y = dt.datetime.strptime(yst, '%Y%m%d')
+        for k in range(1, window):
+            night = (y - dt.timedelta(days=k)).strftime('%Y%m%d')
+            key = (task, d.destination, night)
+            if now - self._lookback.get(key, 0) >= k * interval:
+                self._lookback[key] = now
+                nights.append(night)
+                break
+        return nights
+
+    def index(self, d):
+        """Obtain the index of exposures already present for `d`.
+
+        If the ``reconcile`` option is set, the index is discarded
+        and rebuilt from disk every ``reconcile`` minutes.  At the same
+        time the links already handled are forgotten, and the next search
+        for links covers the entire tree, so exposures removed from disk
+        will be transferred again.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+
+        Returns
+        -------
+        :class:`ExposureIndex`
+            The index object.
+        """
+        reconcile = self.conf['common'].getint('reconcile', fallback=0)
+        with self._indexes_lock:
+            if d.destination in self._indexes:
+                i = self._indexes[d.destination]
+                if reconcile > 0 and time.time() - i.created >= reconcile * 60:
+                    log.info('Reconciling exposure index for %s with disk.', d.destination)
+                    del self._indexes[d.destination]
+                    self._seen.pop(d.source, None)
+                    self._last_full_scan.pop(d.source, None)
+            if d.destination not in self._indexes:
+                self._indexes[d.destination] = ExposureIndex(d.staging, d.destination)
+            return self._indexes[d.destination]
+
+    def links(self, d):
+        """Find exposure symlinks at KPNO.
+
+        Normally the entire `d.source` tree is searched.  If the
+        ``full_scan`` option is set, the entire tree is only searched
+        every ``full_scan`` minutes, and in between only links created
+        since the previous search are returned.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+
+        Returns
+        -------
+        :func:`tuple`
+            A sorted list of links, and a boolean that is ``True``
+            if the entire tree was searched successfully.
+        """
+        full_scan = self.conf['common'].getint('full_scan', fallback=0)
+        now = time.time()
+        cmd = self._ssh('/bin/find', d.source, '-type', 'l')
+        full = True
+        if full_scan > 0 and d.source in self._last_full_scan:
+            if now - self._last_full_scan[d.source] < full_scan * 60:
+                #
+                # Add a couple of minutes to allow for the time taken
+                # by the previous search.
+                #
+                minutes = int((now - self._last_scan[d.source]) // 60) + 2
+                cmd = self._ssh('/bin/find', d.source, '-mindepth', '2', '-maxdepth', '2',
+                                '-type', 'l', '-mmin', '-{0:d}'.format(minutes))
+                full = False
+        log.debug(' '.join(cmd))
+        find_status, out, err = _popen(cmd, timeout=self.timeout)
+        if find_status != '0':
+            log.warning('Search for links in %s failed (status = %s), check connection.', d.source, find_status)
+            log.error('find STDERR = %s', err)
+            return ([], False)
+        self._last_scan[d.source] = now
+        if full:
+            self._last_full_scan[d.source] = now
+        return (sorted([x for x in out.split('\n') if x]), full)
 
     def hpss_status(self):
         """Check HPSS availability.
@@ -228,6 +532,51 @@ The DESI Collaboration Account
             else:
                 return status['status'] == 'active'
 
+    def exposures(self, d, links, status):
+        """Transfer several exposures through a staged pipeline.
+
+        Each exposure passes through three stages: :meth:`rsync_exposure`,
+        :meth:`verify_exposure` and :meth:`install_exposure`.  The first two
+        stages have their own pool of workers, so the next exposure can be
+        transferred while the previous one is being verified.  Installation
+        is done by the calling thread, in the order verification completes.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        links : :class:`list`
+            The exposure paths.
+        status : :class:`desitransfer.status.TransferStatus`
+            The status object associated with `d`.
+        """
+        verify_workers = d.verify_workers if d.verify_workers > 0 else d.workers
+        log.debug("ThreadPoolExecutor(max_workers=%d)", d.workers)
+        log.debug("ThreadPoolExecutor(max_workers=%d)", verify_workers)
+        with ThreadPoolExecutor(max_workers=d.workers) as transfer_pool, \
+                ThreadPoolExecutor(max_workers=verify_workers) as verify_pool:
+            pending = dict([(transfer_pool.submit(self.rsync_exposure, d, link, status), ('rsync', link))
+                            for link in links])
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    stage, link = pending.pop(f)
+                    e = f.exception()
+                    if e is not None:
+                        log.critical("Exception detected in transfer of %s!\n\n%s",
+                                     link, ''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+                        self.retry(d, link)
+                    elif stage == 'rsync':
+                        if f.result():
+                            pending[verify_pool.submit(self.verify_exposure, d, link, status)] = ('verify', link)
+                    else:
+                        try:
+                            self.install_exposure(d, link)
+                        except Exception:
+                            log.critical("Exception detected in transfer of %s!\n\n%s",
+                                         link, traceback.format_exc())
+                            self.retry(d, link)
+
     def exposure(self, d, link, status):
         """Data transfer operations for a single exposure.
 
@@ -243,47 +592,227 @@ The DESI Collaboration Account
         status : :class:`desitransfer.status.TransferStatus`
             The status object associated with `d`.
         """
-        exposure = os.path.basename(link)
-        night = os.path.basename(os.path.dirname(link))
+        try:
+            with status.batch():
+                if self.rsync_exposure(d, link, status):
+                    self.verify_exposure(d, link, status)
+                    self.install_exposure(d, link)
+        except Exception:
+            self.retry(d, link)
+            raise
+
+    def batch_exposures(self, d, links, status):
+        """Transfer several exposures with as few :command:`rsync` commands as possible.
+
+        Exposures are transferred by :meth:`rsync_exposures`, then each
+        exposure is verified and installed in turn, or by a pool of
+        ``verify_workers`` if that is greater than one.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        links : :class:`list`
+            The exposure paths.
+        status : :class:`desitransfer.status.TransferStatus`
+            The status object associated with `d`.
+        """
+        transferred = self.rsync_exposures(d, links, status)
+        if d.verify_workers > 1 and len(transferred) > 1:
+            log.debug("ThreadPoolExecutor(max_workers=%d)", d.verify_workers)
+            with ThreadPoolExecutor(max_workers=d.verify_workers) as pool:
+                futures = [pool.submit(self.verify_exposure, d, link, status) for link in transferred]
+                for link, f in zip(transferred, futures):
+                    e = f.exception()
+                    if e is not None:
+                        log.critical("Exception detected in transfer of %s!\n\n%s",
+                                     link, ''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+                        self.retry(d, link)
+                    else:
+                        self.install_exposure(d, link)
+        else:
+            for link in transferred:
+                try:
+                    self.verify_exposure(d, link, status)
+                    self.install_exposure(d, link)
+                except Exception:
+                    self.retry(d, link)
+                    raise
+
+    def prepare_night(self, d, night):
+        """Create the staging and destination directories for `night`.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        night : :class:`str`
+            Night to prepare.
+        """
         staging_night = os.path.join(d.staging, night)
         destination_night = os.path.join(d.destination, night)
-        staging_exposure = os.path.join(staging_night, exposure)
-        destination_exposure = os.path.join(destination_night, exposure)
+        index = self.index(d)
         #
         # New night detected?
         #
-        if not os.path.isdir(staging_night):
+        if not index.has_night(night, 'staging'):
             log.debug("os.makedirs('%s', exist_ok=True)", staging_night)
             if not self.test:
                 os.makedirs(staging_night, exist_ok=True)
+                index.add_night(night, 'staging')
         #
         # Set up DESI_SPECTRO_DATA.
         #
-        if not os.path.isdir(destination_night):
+        if not index.has_night(night, 'destination'):
             log.debug("os.makedirs('%s', exist_ok=True)", destination_night)
             log.debug("os.chmod('%s', 0o%o)", destination_night, dir_perm)
             if not self.test:
                 os.makedirs(destination_night, exist_ok=True)
                 os.chmod(destination_night, dir_perm)
+                index.add_night(night, 'destination')
+
+    def rsync_exposures(self, d, links, status):
+        """Transfer several exposures into the staging directory.
+
+        Exposures from the same night are grouped into batches of up to
+        ``batch`` exposures, and each batch is transferred by a single
+        :command:`rsync` command using ``--files-from``.  If a batch fails,
+        its exposures are transferred again one at a time by
+        :meth:`rsync_exposure`, so that problems are reported against
+        individual exposures.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        links : :class:`list`
+            The exposure paths.
+        status : :class:`desitransfer.status.TransferStatus`
+            The status object associated with `d`.
+
+        Returns
+        -------
+        :class:`list`
+            The exposure paths that were transferred and still need
+            to be verified and installed.
+        """
+        index = self.index(d)
+        journal = self.journal(d)
+        nights = dict()
+        transferred = list()
+        for link in links:
+            night = os.path.basename(os.path.dirname(link))
+            self.prepare_night(d, night)
+            stage = self.transfer_stage(d, link)
+            if stage == 'rsync':
+                nights.setdefault(night, list()).append(link)
+            elif stage == 'verify':
+                transferred.append(link)
+        for night in nights:
+            for i in range(0, len(nights[night]), d.batch):
+                batch = nights[night][i:i + d.batch]
+                exposures = [os.path.basename(link) for link in batch]
+                files_from = os.path.join(self.scratch,
+                                          'files_from_{0}_{1}_{2}.txt'.format(d.destination.replace('/', '_'),
+                                                                              night, exposures[0]))
+                cmd = rsync(os.path.join(d.source, night), os.path.join(d.staging, night),
+                            ssh=self._rsh())
+                cmd.insert(cmd.index('--omit-dir-times') + 1, '--files-from')
+                cmd.insert(cmd.index('--files-from') + 1, files_from)
+                if journal is not None:
+                    cmd.insert(cmd.index('--omit-dir-times') + 1, '--partial')
+                log.debug(' '.join(cmd))
+                if self.test:
+                    rsync_status = '0'
+                else:
+                    if journal is not None:
+                        for exposure in exposures:
+                            journal.record(night, exposure, 'rsync')
+                    with open(files_from, 'w') as f:
+                        f.write('\n'.join(exposures) + '\n')
+                    try:
+                        rsync_status, out, err = _popen(cmd, timeout=self.timeout)
+                    finally:
+                        os.remove(files_from)
+                if rsync_status == '0':
+                    with status.batch():
+                        for exposure in exposures:
+                            log.debug("status.update('%s', '%s', 'rsync')", night, exposure)
+                            if not self.test:
+                                index.add(night, exposure, 'staging')
+                                if journal is not None:
+                                    journal.record(night, exposure, 'staged')
+                                status.update(night, exposure, 'rsync')
+                    transferred += batch
+                else:
+                    log.warning('rsync problem (status = %s) detected for %d exposures in %s; ' +
+                                'transferring them individually.', rsync_status, len(batch), night)
+                    log.debug('rsync STDERR = %s', err)
+                    for link in batch:
+                        if self.rsync_exposure(d, link, status):
+                            transferred.append(link)
+        return transferred
+
+    def rsync_exposure(self, d, link, status):
+        """Transfer a single exposure into the staging directory.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        link : :class:`str`
+            The exposure path.
+        status : :class:`desitransfer.status.TransferStatus`
+            The status object associated with `d`.
+
+        Returns
+        -------
+        :class:`bool`
+            ``True`` if the exposure was transferred and still needs
+            to be verified and installed.
+        """
+        exposure = os.path.basename(link)
+        night = os.path.basename(os.path.dirname(link))
+        staging_exposure = os.path.join(d.staging, night, exposure)
+        index = self.index(d)
+        journal = self.journal(d)
+        self.prepare_night(d, night)
         #
         # Has exposure already been transferred?
         #
-        if not os.path.isdir(staging_exposure) and not os.path.isdir(destination_exposure):
-            cmd = rsync(os.path.join(d.source, night, exposure), staging_exposure)
-            log.debug(' '.join(cmd))
-            if self.test:
-                rsync_status = '0'
-            else:
-                rsync_status, out, err = _popen(cmd)
+        stage = self.transfer_stage(d, link)
+        if stage is None:
+            return False
+        if stage == 'verify':
+            return True
+        cmd = rsync(os.path.join(d.source, night, exposure), staging_exposure,
+                    ssh=self._rsh())
+        if journal is not None:
+            cmd.insert(cmd.index('--omit-dir-times') + 1, '--partial')
+        log.debug(' '.join(cmd))
+        if self.test:
+            rsync_status = '0'
         else:
-            log.debug('%s already transferred.', staging_exposure)
-            return
+            if journal is not None:
+                journal.record(night, exposure, 'rsync')
+            if d.streams > 1:
+                rsync_status, out, err = self.rsync_streams(d, night, exposure, cmd)
+            else:
+                rsync_status, out, err = _popen(cmd, timeout=self.timeout)
+            #
+            # If rsync failed before creating the exposure, leave it out
+            # of the index, so that it is transferred again on the next pass.
+            #
+            if rsync_status == '0' or os.path.isdir(staging_exposure):
+                index.add(night, exposure, 'staging')
         #
         # Transfer complete.
         #
         if rsync_status == '0':
             log.debug("status.update('%s', '%s', 'rsync')", night, exposure)
             if not self.test:
+                if journal is not None:
+                    journal.record(night, exposure, 'staged')
                 status.update(night, exposure, 'rsync')
         else:
             log.critical('rsync problem (status = %s) detected for %s/%s, check logs!',
@@ -292,6 +821,96 @@ The DESI Collaboration Account
             log.error('rsync STDERR = %s', err)
             log.debug("status.update('%s', '%s', 'rsync', failure=True)", night, exposure)
             status.update(night, exposure, 'rsync', failure=True)
+        return True
+
+    def rsync_streams(self, d, night, exposure, cmd):
+        """Transfer a single exposure with several concurrent :command:`rsync` streams.
+
+        The files in the exposure are listed at KPNO, then divided among
+        ``streams`` commands so that each command transfers roughly
+        the same number of bytes.  If the listing fails, or there are
+        too few files to divide, `cmd` is run as-is.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        night : :class:`str`
+            Night of observation.
+        exposure : :class:`str`
+            Exposure number.
+        cmd : :class:`list`
+            The :command:`rsync` command that transfers the entire exposure.
+
+        Returns
+        -------
+        :func:`tuple`
+            The combined returncode, standard output and standard error
+            of the :command:`rsync` commands.
+        """
+        #
+        # The format is quoted because ssh passes it through the remote shell.
+        #
+        listing = self._ssh('/bin/find', '-L', os.path.join(d.source, night, exposure),
+                            '-type', 'f', '-printf', "'%s %P\\n'")
+        log.debug(' '.join(listing))
+        find_status, out, err = _popen(listing, timeout=self.timeout)
+        files = list()
+        if find_status == '0':
+            for line in out.split('\n'):
+                if line:
+                    size, name = line.split(' ', 1)
+                    files.append((int(size), name))
+        groups = _balance(files, d.streams)
+        if len(groups) < 2:
+            log.debug(' '.join(cmd))
+            return _popen(cmd, timeout=self.timeout)
+        commands = list()
+        files_from = list()
+        for i, group in enumerate(groups):
+            f = os.path.join(self.scratch,
+                             'files_from_{0}_{1}_{2}_{3:d}.txt'.format(d.destination.replace('/', '_'),
+                                                                       night, exposure, i))
+            with open(f, 'w') as ff:
+                ff.write('\n'.join(group) + '\n')
+            files_from.append(f)
+            c = cmd.copy()
+            c.insert(c.index('--omit-dir-times') + 1, '--files-from')
+            c.insert(c.index('--files-from') + 1, f)
+            log.debug(' '.join(c))
+            commands.append(c)
+        #
+        # Create the exposure directory here, otherwise the commands
+        # race to create it, and all but one of them may fail.
+        #
+        staging_exposure = os.path.join(d.staging, night, exposure)
+        log.debug("os.makedirs('%s', exist_ok=True)", staging_exposure)
+        os.makedirs(staging_exposure, exist_ok=True)
+        try:
+            results = _popen_many(commands, timeout=self.timeout)
+        finally:
+            for f in files_from:
+                os.remove(f)
+        failed = [r[0] for r in results if r[0] != '0']
+        return (failed[0] if failed else '0',
+                ''.join([r[1] for r in results]),
+                ''.join([r[2] for r in results]))
+
+    def verify_exposure(self, d, link, status):
+        """Lock a staged exposure and verify its checksums.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        link : :class:`str`
+            The exposure path.
+        status : :class:`desitransfer.status.TransferStatus`
+            The status object associated with `d`.
+        """
+        exposure = os.path.basename(link)
+        night = os.path.basename(os.path.dirname(link))
+        staging_exposure = os.path.join(d.staging, night, exposure)
         #
         # Check permissions.
         #
@@ -302,61 +921,368 @@ The DESI Collaboration Account
         #
         checksum_file = os.path.join(staging_exposure,
                                      d.checksum.format(night=night, exposure=exposure))
-        self.checksum(checksum_file, status)
+        self.checksum(checksum_file, status, self.checksum_cache(d, night))
+
+    def install_exposure(self, d, link):
+        """Move a staged exposure into the destination directory.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        link : :class:`str`
+            The exposure path.
+        """
+        exposure = os.path.basename(link)
+        night = os.path.basename(os.path.dirname(link))
+        staging_exposure = os.path.join(d.staging, night, exposure)
+        destination_night = os.path.join(d.destination, night)
+        index = self.index(d)
         #
         # Move data into DESI_SPECTRO_DATA.
         #
-        if not os.path.isdir(destination_exposure):
-            log.debug("shutil.move('%s', '%s')", staging_exposure, destination_night)
-            if not self.test:
-                shutil.move(staging_exposure, destination_night)
+        with self.night_lock(d, night):
+            if index.location(night, exposure) != 'destination':
+                log.debug("shutil.move('%s', '%s')", staging_exposure, destination_night)
+                if not self.test:
+                    shutil.move(staging_exposure, destination_night)
+                    index.add(night, exposure, 'destination')
+        journal = self.journal(d)
+        if journal is not None:
+            journal.record(night, exposure, 'installed')
+        self._seen.setdefault(d.source, set()).add(link)
 
-    def checksum(self, checksum_file, status):
-        """Verify checksum associated with `checksum_file` and report status.
+    def bulk(self, d, night, status):
+        """Transfer an entire night as a single tar stream.
 
-        The status is reported via log messages and messages passed
-        to the `status` object, not via a return value.
+        The stream is unpacked into the staging directory while checksums are
+        computed, so files do not have to be read again for verification.
+        Exposures are then verified and installed as usual.  Exposures
+        already present in the destination directory are excluded.
 
         Parameters
         ----------
-        checksum_file : :class:`str`
-            The checksum file.
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        night : :class:`str`
+            Night to transfer.
         status : :class:`desitransfer.status.TransferStatus`
-            The associated status object.
+            The status object associated with `d`.
+
+        Returns
+        -------
+        :class:`bool`
+            ``True`` if the transfer succeeded.
         """
-        exposure = os.path.basename(os.path.dirname(checksum_file))
-        night = os.path.basename(os.path.dirname(os.path.dirname(checksum_file)))
-        log.debug("verify_checksum('%s')", checksum_file)
-        if not self.test:
+        index = self.index(d)
+        self.prepare_night(d, night)
+        staging_night = os.path.join(d.staging, night)
+        cmd = self._ssh('/bin/tar', '--create', '--dereference', '--file', '-',
+                        '--directory', d.source)
+        for exposure in index.exposures(night, 'destination'):
+            cmd += ['--exclude', '{0}/{1}'.format(night, exposure)]
+        cmd.append(night)
+        log.debug(' '.join(cmd))
+        if self.test:
+            return True
+        unlock_directory(staging_night, self.test)
+        with TemporaryFile() as terr:
+            proc = sub.Popen(cmd, stdout=sub.PIPE, stderr=terr)
+            try:
+                hashes = _untar(proc.stdout, d.staging, night)
+            except (tarfile.TarError, OSError) as e:
+                log.critical("Error unpacking tar stream of %s: %s", night, str(e))
+                proc.kill()
+                hashes = None
+            finally:
+                proc.stdout.close()
+                tar_status = proc.wait()
+            terr.seek(0)
+            err = terr.read().decode('utf-8')
+        if hashes is None or tar_status != 0:
+            log.critical('tar problem (status = %d) detected on bulk transfer of %s, check logs!',
+                         tar_status, night)
+            log.error('tar STDERR = \n%s', err)
+            return False
+        exposures = dict()
+        for path in hashes:
+            exposures.setdefault(os.path.relpath(path, staging_night).split(os.sep)[0], dict())[path] = hashes[path]
+        for exposure in sorted(exposures):
+            link = night + '/' + exposure
+            if self._link_re.search(link) is None:
+                continue
+            staging_exposure = os.path.join(staging_night, exposure)
+            checksum_file = os.path.join(staging_exposure,
+                                         d.checksum.format(night=night, exposure=exposure))
+            cache = self.checksum_cache(d, night)
+            if cache is None:
+                cache = ChecksumCache(None)
             if os.path.exists(checksum_file):
-                checksum_status = verify_checksum(checksum_file)
-                #
-                # Did we pass checksums?
-                #
-                if checksum_status == "":
-                    log.debug("status.update('%s', '%s', 'checksum')", night, exposure)
-                    status.update(night, exposure, 'checksum')
-                else:
-                    msg = "The following checksum error(s) detected for %s/%s:\n\n" + checksum_status
-                    log.critical(msg, night, exposure)
-                    log.debug("status.update('%s', '%s', 'checksum', failure=True)", night, exposure)
-                    status.update(night, exposure, 'checksum', failure=True)
-            else:
-                log.critical("No checksum file for %s/%s!", night, exposure)
-                log.debug("status.update('%s', '%s', 'checksum', failure=True)", night, exposure)
-                status.update(night, exposure, 'checksum', failure=True)
+                for path, h in exposures[exposure].items():
+                    if path != checksum_file:
+                        cache.set(checksum_file, os.path.basename(path), os.stat(path), h)
+            index.add(night, exposure, 'staging')
+            log.debug("status.update('%s', '%s', 'rsync')", night, exposure)
+            status.update(night, exposure, 'rsync')
+            log.debug("lock_directory('%s', %s)", staging_exposure, str(self.test))
+            lock_directory(staging_exposure, self.test)
+            self.checksum(checksum_file, status, cache)
+            self.install_exposure(d, link)
+        return True
 
-    def catchup(self, d, night, status, backup=False):
-        """Do a "catch-up" transfer to catch delayed files in the morning, rather than at noon.
+    def checksum_cache(self, d, night):
+        """Obtain the checksum cache for a particular night.
 
         Parameters
         ----------
         d : :func:`collections.namedtuple`
             Configuration for the destination directory.
         night : :class:`str`
-            Night to check.
-        status : :class:`desitransfer.status.TransferStatus`
-            The status object associated with `d`.
+            Night of observation.
+
+        Returns
+        -------
+        :class:`ChecksumCache`
+            The cache object, or ``None`` if caching is disabled.
+        """
+        if not self.conf['common'].getboolean('checksum_cache', fallback=False):
+            return None
+        cache_file = os.path.join(self.scratch,
+                                  'checksum_{0}_{1}.json'.format(d.destination.replace('/', '_'), night))
+        if self.test:
+            cache_file = cache_file.replace('.json', '.test.json')
+        with self._checksum_caches_lock:
+            if cache_file not in self._checksum_caches:
+                self._checksum_caches[cache_file] = ChecksumCache(cache_file)
+            return self._checksum_caches[cache_file]
+
+    def journal(self, d):
+        """Obtain the transfer journal for a particular destination directory.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+
+        Returns
+        -------
+        :class:`TransferJournal`
+            The journal object, or ``None`` if the journal is disabled.
+        """
+        if self.test or not self.conf['common'].getboolean('journal', fallback=False):
+            return None
+        journal_file = d.staging.rstrip('/') + '.journal'
+        with self._journals_lock:
+            if journal_file not in self._journals:
+                self._journals[journal_file] = TransferJournal(journal_file)
+            return self._journals[journal_file]
+
+    def retry(self, d, link):
+        """Arrange for a failed exposure to be transferred again on the next pass.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        link : :class:`str`
+            The exposure path.
+        """
+        self._seen.get(d.source, set()).discard(link)
+        self._retry.setdefault(d.source, set()).add(link)
+
+    def transfer_stage(self, d, link):
+        """Determine what remains to be done to transfer an exposure.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        link : :class:`str`
+            The exposure path.
+
+        Returns
+        -------
+        :class:`str`
+            ``'rsync'`` if the exposure needs to be transferred,
+            ``'verify'`` if it was transferred but still needs to be verified
+            and installed, or ``None`` if it was already transferred.
+        """
+        exposure = os.path.basename(link)
+        night = os.path.basename(os.path.dirname(link))
+        location = self.index(d).location(night, exposure)
+        journal = self.journal(d)
+        stage = None if journal is None else journal.stage(night, exposure)
+        if location is None:
+            return 'rsync'
+        if location == 'staging' and stage == 'rsync':
+            log.info('Resuming interrupted transfer of %s/%s.', night, exposure)
+            return 'rsync'
+        if location == 'staging' and stage == 'staged':
+            log.info('Resuming verification of %s/%s.', night, exposure)
+            return 'verify'
+        if stage is not None and location == 'destination':
+            journal.record(night, exposure, 'installed')
+        log.debug('%s already transferred.', os.path.join(d.staging, night, exposure))
+        self._seen.setdefault(d.source, set()).add(link)
+        return None
+
+    def checksum(self, checksum_file, status, cache=None):
+        """Verify checksum associated with `checksum_file` and report status.
+
+        The status is reported via log messages and messages passed
+        to the `status` object, not via a return value.
+
+        Parameters
+        ----------
+        checksum_file : :class:`str`
+            The checksum file.
+        status : :class:`desitransfer.status.TransferStatus`
+            The associated status object.
+        cache : :class:`ChecksumCache`, optional
+            Skip files that have already been verified, according to `cache`.
+        """
+        exposure = os.path.basename(os.path.dirname(checksum_file))
+        night = os.path.basename(os.path.dirname(os.path.dirname(checksum_file)))
+        log.debug("verify_checksum('%s')", checksum_file)
+        if not self.test:
+            if os.path.exists(checksum_file):
+                if cache is None:
+                    checksum_status = verify_checksum(checksum_file)
+                else:
+                    checksum_status = verify_checksum(checksum_file, cache=cache)
+                #
+                # Did we pass checksums?
+                #
+                if checksum_status == "":
+                    log.debug("status.update('%s', '%s', 'checksum')", night, exposure)
+                    status.update(night, exposure, 'checksum')
+                else:
+                    msg = "The following checksum error(s) detected for %s/%s:\n\n" + checksum_status
+                    log.critical(msg, night, exposure)
+                    log.debug("status.update('%s', '%s', 'checksum', failure=True)", night, exposure)
+                    status.update(night, exposure, 'checksum', failure=True)
+            else:
+                log.critical("No checksum file for %s/%s!", night, exposure)
+                log.debug("status.update('%s', '%s', 'checksum', failure=True)", night, exposure)
+                status.update(night, exposure, 'checksum', failure=True)
+
+    def night_lock(self, d, night):
+        """Obtain a lock that serializes changes to `night` in the destination directory.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        night : :class:`str`
+            Night of observation.
+
+        Returns
+        -------
+        :class:`threading.Lock`
+            The lock associated with `night`.
+        """
+        with self._night_locks_lock:
+            return self._night_locks.setdefault((d.destination, night), threading.Lock())
+
+    def _executor(self):
+        """Obtain the executor used for background catch-up tasks.
+
+        Returns
+        -------
+        :class:`concurrent.futures.ThreadPoolExecutor`
+            The executor, with ``catchup_workers`` workers.
+        """
+        with self._night_locks_lock:
+            if self._background is None:
+                workers = max(1, self.conf['common'].getint('catchup_workers', fallback=0))
+                log.debug("ThreadPoolExecutor(max_workers=%d)", workers)
+                self._background = ThreadPoolExecutor(max_workers=workers)
+            return self._background
+
+    def _background_task(self, description, func, *args):
+        """Run `func` and report any exception, since nobody waits for the result.
+        """
+        try:
+            return func(*args)
+        except Exception:
+            log.critical("Exception detected in %s!\n\n%s",
+                         description, traceback.format_exc())
+
+    def catchup_running(self, d, night):
+        """``True`` if a background catch-up transfer of `night` is in progress.
+        """
+        f = self._catchups.get((d.destination, night))
+        if f is None:
+            return False
+        if f.done():
+            del self._catchups[(d.destination, night)]
+            return False
+        return True
+
+    def background_catchup(self, d, night, status):
+        """Run :meth:`catchup` in the background.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        night : :class:`str`
+            Night to check.
+        status : :class:`desitransfer.status.TransferStatus`
+            The status object associated with `d`.
+
+        Returns
+        -------
+        :class:`bool`
+            ``True`` if a new catch-up transfer was started.
+        """
+        if self.catchup_running(d, night):
+            log.debug("Catch-up transfer of %s is still running.", night)
+            return False
+        self._catchups[(d.destination, night)] = self._executor().submit(self._background_task,
+                                                                         'catch-up transfer of ' + night,
+                                                                         self.catchup, d, night, status)
+        return True
+
+    def manifest(self, d, night):
+        """Summarize the exposures in `night` at KPNO with a single remote command.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        night : :class:`str`
+            Night to check.
+
+        Returns
+        -------
+        :class:`dict`
+            The manifest, in the format returned by :func:`_parse_manifest`,
+            or ``None`` if the remote command failed.
+        """
+        cmd = self._ssh('/bin/find', '-L', os.path.join(d.source, night),
+                        '-type', 'f', '-printf', "'%P %s %T@\\n'",
+                        '|', '/bin/awk', _manifest_awk)
+        log.debug(' '.join(cmd))
+        manifest_status, out, err = _popen(cmd, timeout=self.timeout)
+        if manifest_status != '0':
+            log.warning('Could not obtain manifest of %s/%s (status = %s); ' +
+                        'falling back to rsync.', d.source, night, manifest_status)
+            log.debug('STDERR = \n%s', err)
+            return None
+        return _parse_manifest(out)
+
+    def catchup(self, d, night, status, backup=False):
+        """Do a "catch-up" transfer to catch delayed files in the morning, rather than at noon.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        night : :class:`str`
+            Night to check.
+        status : :class:`desitransfer.status.TransferStatus`
+            The status object associated with `d`.
         backup : :class:`bool`
             If ``True``, this catch-up is happening immediately prior to tape backup.
 
@@ -377,31 +1303,277 @@ The DESI Collaboration Account
             if os.path.exists(sync_file):
                 log.debug("%s detected, catch-up transfer is done.", sync_file)
             else:
-                cmd = rsync(os.path.join(d.source, night),
-                            os.path.join(d.destination, night), test=True)
-                log.debug(' '.join(cmd))
-                rsync_status, out, err = _popen(cmd)
-                with open(sync_file, 'w') as sf:
-                    sf.write(out)
-                if empty_rsync(out):
+                remote = None
+                if self.conf['common'].getboolean('manifest', fallback=False):
+                    remote = self.manifest(d, night)
+                if remote is not None:
+                    #
+                    # Compare with the manifest saved by the previous catch-up,
+                    # or with the files on disk if there is none.
+                    #
+                    manifest_file = os.path.join(self.scratch,
+                                                 'manifest_{0}_{1}.json'.format(ketchup_file, night))
+                    if self.test:
+                        manifest_file = manifest_file.replace('.json', '.test.json')
+                    try:
+                        with open(manifest_file) as j:
+                            local = json.load(j)
+                    except (FileNotFoundError, json.JSONDecodeError):
+                        local = _manifest(os.path.join(d.destination, night))
+                    differ = sorted([e for e in remote if local.get(e) != remote[e]])
+                    with open(sync_file, 'w') as sf:
+                        for e in differ:
+                            sf.write('{0} {1[0]:d} {1[1]:d} {1[2]:d}\n'.format(e, remote[e]))
+                    empty = len(differ) == 0
+                    changed = set([e for e in differ if self._link_re.search(night + '/' + e) is not None])
+                    #
+                    # Sync every subdirectory that differs, not just exposures,
+                    # or the difference would be hidden by the saved manifest.
+                    #
+                    touched = set([e for e in differ if e != '.'])
+                else:
+                    itemize = self.conf['common'].getboolean('itemize', fallback=False)
+                    cmd = rsync(os.path.join(d.source, night),
+                                os.path.join(d.destination, night), test=True,
+                                ssh=self._rsh(), itemize=itemize)
+                    log.debug(' '.join(cmd))
+                    rsync_status, out, err = _popen(cmd, timeout=self.timeout)
+                    with open(sync_file, 'w') as sf:
+                        sf.write(out)
+                    if itemize:
+                        #
+                        # Only re-verify exposures where file data changed,
+                        # but re-lock exposures with any change.
+                        #
+                        items = [i for i in parse_rsync(out) if i.path != './']
+                        empty = len(items) == 0
+                        items = [i for i in items if self._link_re.search(night + '/' + i.top) is not None]
+                        changed = set([i.top for i in items if i.is_file and (i.new or i.content)])
+                        touched = set([i.top for i in items])
+                    else:
+                        empty = empty_rsync(out)
+                        changed = new_exposures(out)
+                        touched = changed
+                synced = True
+                if empty:
                     log.info('No files appear to have changed in %s.', night)
                 else:
                     log.warning('New files detected in %s!', night)
-                    rsync_night(d.source, d.destination, night, self.test)
+                    with self.night_lock(d, night):
+                        if remote is not None:
+                            #
+                            # Only rsync the exposures that differ.
+                            #
+                            synced = rsync_night(d.source, d.destination, night, self.test, self.timeout, self._rsh(),
+                                                 touched, restrict=True)
+                        else:
+                            if not self.conf['common'].getboolean('catchup_touched', fallback=False):
+                                touched = None
+                            rsync_night(d.source, d.destination, night, self.test, self.timeout, self._rsh(), touched)
+                        self.index(d).forget(night)
                     #
                     # Re-check the checksums for exposures that changed.
                     #
-                    e = new_exposures(out)
+                    e = changed
                     if len(e) == 0:
                         log.warning('No updated exposures in night %s detected.', night)
                     else:
-                        for exposure in e:
-                            checksum_file = os.path.join(os.path.join(d.destination, night, exposure),
-                                                         d.checksum.format(night=night, exposure=exposure))
-                            self.checksum(checksum_file, status)
+                        checksum_files = dict([(exposure, os.path.join(d.destination, night, exposure,
+                                                                       d.checksum.format(night=night, exposure=exposure)))
+                                               for exposure in e])
+                        if self.conf['common'].getint('catchup_workers', fallback=0) > 0:
+                            #
+                            # The status is updated by other threads, so there is nothing to batch.
+                            #
+                            for exposure in e:
+                                log.debug("Queuing checksum verification of %s/%s.", night, exposure)
+                                self._executor().submit(self._background_task,
+                                                        'checksum verification of ' + checksum_files[exposure],
+                                                        self.checksum, checksum_files[exposure], status,
+                                                        self.checksum_cache(d, night))
+                        else:
+                            with status.batch():
+                                for exposure in e:
+                                    self.checksum(checksum_files[exposure], status, self.checksum_cache(d, night))
+                if remote is not None and synced:
+                    with open(manifest_file, 'w') as j:
+                        json.dump(remote, j, indent=None, separators=(',', ':'))
         else:
             log.warning("No data from %s detected, skipping catch-up transfer.", night)
 
+    def backup_jobs(self, d, status):
+        """Check on HTAR commands running in the background.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        status : :class:`desitransfer.status.TransferStatus`
+            The status object associated with `d`.
+
+        Returns
+        -------
+        :class:`int`
+            The number of backups still running for `d`.
+        """
+        running = 0
+        for key in list(self._backups.keys()):
+            destination, night = key
+            if destination != d.destination:
+                continue
+            job = self._backups[key]
+            if job.proc.poll() is None:
+                log.debug("HTAR backup of %s (pid = %d) is still running.", night, job.proc.pid)
+                running += 1
+                continue
+            del self._backups[key]
+            job.out.close()
+            job.err.seek(0)
+            err = job.err.read().decode('utf-8')
+            job.err.close()
+            failure = _htar_error(job.cmd, str(job.proc.returncode), err)
+            if not failure:
+                self.hpss_complete(d, night)
+            log.info("HTAR backup of %s (pid = %d) finished with status %d.", night, job.proc.pid, job.proc.returncode)
+            log.debug("status.update('%s', 'all', 'backup', failure=%s)", night, failure)
+            status.update(night, 'all', 'backup', failure=failure)
+        return running
+
+    def shutdown(self, interval=60):
+        """Wait for running transfers and backups to finish before the daemon exits.
+
+        HTAR commands running in the background are polled with
+        :meth:`backup_jobs` until they finish, so that their results are
+        reported, and a partially-written backup is not started again
+        after a restart.
+
+        Parameters
+        ----------
+        interval : :class:`int`, optional
+            Check background HTAR commands every `interval` seconds.
+        """
+        if self._sections is not None:
+            self._sections.shutdown(wait=True)
+        if self._background is not None:
+            self._background.shutdown(wait=True)
+        for d in self.directories:
+            status = None
+            while any([key[0] == d.destination for key in self._backups]):
+                if status is None:
+                    status = self._transfer_status(os.path.join(os.path.dirname(d.staging), 'status'))
+                running = self.backup_jobs(d, status)
+                if running > 0:
+                    log.info("Waiting for %d HTAR backups of %s to finish.", running, d.destination)
+                    time.sleep(interval)
+        if self.ssh is not None:
+            self.ssh.stop()
+
+    def _hpss_ttl(self):
+        """Lifetime of the HPSS listing cache in seconds, zero if disabled.
+        """
+        return self.conf['common'].getint('hpss_cache', fallback=0) * 60
+
+    def _hpss_cache_file(self, d):
+        """Name of the file that stores the HPSS listing cache for `d`.
+        """
+        cache_file = os.path.join(self.scratch, 'hpss_{0}.json'.format(d.hpss.replace('/', '_')))
+        if self.test:
+            cache_file = cache_file.replace('.json', '.test.json')
+        return cache_file
+
+    def hpss_backups(self, d, backup_file=None):
+        """Find the nights of `d` that are completely backed up on HPSS.
+
+        If the ``hpss_cache`` option is set, the result is cached in
+        memory and in $SCRATCH, and HPSS is only listed again when
+        the cache is older than ``hpss_cache`` minutes, or if
+        `backup_file` is not known to be complete.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        backup_file : :class:`str`, optional
+            List HPSS again if the cache does not contain this file.
+
+        Returns
+        -------
+        :class:`set`
+            The names of backup files that have both a ``.tar`` and
+            a ``.tar.idx`` file.
+        """
+        ttl = self._hpss_ttl()
+        if ttl > 0:
+            with self._hpss_lock:
+                if d.hpss not in self._hpss:
+                    try:
+                        with open(self._hpss_cache_file(d)) as j:
+                            self._hpss[d.hpss] = json.load(j)
+                    except (FileNotFoundError, json.JSONDecodeError):
+                        self._hpss[d.hpss] = {'listed': 0, 'complete': []}
+                cache = self._hpss[d.hpss]
+                if (time.time() - cache['listed'] < ttl and
+                        (backup_file is None or backup_file in cache['complete'])):
+                    return set(cache['complete'])
+        hpss_file = d.hpss.replace('/', '_')
+        ls_file = os.path.join(self.scratch, hpss_file + '.txt')
+        if self.test:
+            ls_file = ls_file.replace('.txt', '.test.txt')
+        log.debug("os.remove('%s')", ls_file)
+        try:
+            os.remove(ls_file)
+        except FileNotFoundError:
+            log.debug("Failed to remove %s because it didn't exist. That's OK.", ls_file)
+        cmd = [os.path.join(self.conf['common']['hpss'], 'hsi'),
+               '-O', ls_file, 'ls', '-l', d.hpss]
+        if self.tape:
+            log.debug(' '.join(cmd))
+            _, out, err = _popen(cmd)
+            with open(ls_file) as ls_fileobj:
+                data = ls_fileobj.read()
+            backup_files = set([ls_out.split()[-1] for ls_out in data.split('\n') if ls_out])
+        else:
+            backup_files = set()
+        #
+        # Both a .tar and a .tar.idx file should be present.
+        #
+        complete = set([f for f in backup_files if f.endswith('.tar') and f + '.idx' in backup_files])
+        if ttl > 0 and self.tape:
+            with self._hpss_lock:
+                self._hpss[d.hpss] = {'listed': time.time(), 'complete': sorted(complete)}
+                self._save_hpss(d)
+        return complete
+
+    def hpss_complete(self, d, night):
+        """Record a completed backup of `night` in the HPSS listing cache.
+
+        Parameters
+        ----------
+        d : :func:`collections.namedtuple`
+            Configuration for the destination directory.
+        night : :class:`str`
+            Night that was backed up.
+        """
+        if self._hpss_ttl() <= 0:
+            return
+        backup_file = d.hpss.replace('/', '_') + '_' + night + '.tar'
+        with self._hpss_lock:
+            if d.hpss not in self._hpss:
+                return
+            cache = self._hpss[d.hpss]
+            if backup_file not in cache['complete']:
+                cache['complete'] = sorted(cache['complete'] + [backup_file])
+                self._save_hpss(d)
+
+    def _save_hpss(self, d):
+        """Write the HPSS listing cache for `d`; the caller must hold the lock.
+        """
+        cache_file = self._hpss_cache_file(d)
+        tmp = cache_file + '.tmp'
+        with open(tmp, 'w') as j:
+            json.dump(self._hpss[d.hpss], j, indent=None, separators=(',', ':'))
+        os.replace(tmp, cache_file)
+
     def backup(self, d, night, status):
         """Final sync and backup for a specific night.
 
@@ -419,37 +1591,32 @@ The DESI Collaboration Account
         :class:`bool`
             ``True`` indicates the backup ran to completion and the
             the transfer status should be updated to reflect that.
+            If the ``background_backup`` option is set, the HTAR command
+            is started in the background and ``False`` is returned;
+            :meth:`backup_jobs` updates the status when it finishes.
 
         Notes
         -----
         * 12:00 MST = 19:00 UTC, plus one hour just to be safe, so after 20:00 UTC.
         """
+        background = self.conf['common'].getboolean('background_backup', fallback=False)
+        if (d.destination, night) in self._backups:
+            log.debug("Backup of %s is still running.", night)
+            return False
+        if self.catchup_running(d, night):
+            log.debug("Catch-up transfer of %s is still running.", night)
+            return False
         if os.path.isdir(os.path.join(d.destination, night)):
             hpss_file = d.hpss.replace('/', '_')
-            ls_file = os.path.join(self.scratch, hpss_file + '.txt')
-            if self.test:
-                ls_file = ls_file.replace('.txt', '.test.txt')
-            log.debug("os.remove('%s')", ls_file)
-            try:
-                os.remove(ls_file)
-            except FileNotFoundError:
-                log.debug("Failed to remove %s because it didn't exist. That's OK.", ls_file)
-            cmd = [os.path.join(self.conf['common']['hpss'], 'hsi'),
-                   '-O', ls_file, 'ls', '-l', d.hpss]
-            if self.tape:
-                log.debug(' '.join(cmd))
-                _, out, err = _popen(cmd)
-                with open(ls_file) as ls_fileobj:
-                    data = ls_fileobj.read()
-                backup_files = [ls_out.split()[-1] for ls_out in data.split('\n') if ls_out]
-            else:
-                backup_files = []
             backup_file = hpss_file + '_' + night + '.tar'
-            #
-            # Both a .tar and a .tar.idx file should be present.
-            #
-            if backup_file in backup_files and backup_file + '.idx' in backup_files:
+            if backup_file in self.hpss_backups(d, backup_file):
                 log.debug("Backup of %s already complete.", night)
+                #
+                # The backup may have finished while the daemon was not running.
+                #
+                if self.tape and night in status.status and not all(status.find(night, stage='backup').values()):
+                    log.debug("status.update('%s', 'all', 'backup')", night)
+                    status.update(night, 'all', 'backup')
                 return False
             else:
                 self.catchup(d, night, status, backup=True)
@@ -464,23 +1631,27 @@ The DESI Collaboration Account
                 # Issue HTAR command.
                 #
                 if self.tape:
-                    start_dir = os.getcwd()
-                    log.debug("os.chdir('%s')", d.destination)
-                    os.chdir(d.destination)
+                    #
+                    # Sections may run concurrently, so do not change the
+                    # working directory of the entire process.
+                    #
                     cmd = [os.path.join(self.conf['common']['hpss'], 'htar'),
                            '-cvhf', os.path.join(d.hpss, backup_file),
                            '-H', 'crc:verify=all',
                            night]
                     log.debug(' '.join(cmd))
                     if not self.test:
-                        status, out, err = _popen(cmd)
-                        if status != '0' or err:
-                            msg = "HTAR Backup failed! Command was: {0}.".format(' '.join(cmd))
-                            if err:
-                                msg += "\nHTAR error message was: " + err
-                            log.critical(msg)
-                    log.debug("os.chdir('%s')", start_dir)
-                    os.chdir(start_dir)
+                        if background:
+                            tout, terr = TemporaryFile(), TemporaryFile()
+                            proc = sub.Popen(cmd, stdout=tout, stderr=terr, cwd=d.destination)
+                            log.info("HTAR backup of %s started in the background (pid = %d).", night, proc.pid)
+                            self._backups[(d.destination, night)] = self._backup_job(proc, cmd, tout, terr)
+                        else:
+                            htar_status, out, err = _popen(cmd, cwd=d.destination)
+                            if not _htar_error(cmd, htar_status, err):
+                                self.hpss_complete(d, night)
+                    if background and not self.test:
+                        return False
                 else:
                     log.info('Tape backup disabled by user request.')
                 return True
@@ -489,36 +1660,543 @@ The DESI Collaboration Account
             return False
 
 
-def _popen(command):
-    """Simple wrapper for :class:`subprocess.Popen` to avoid repeated code.
+def _htar_error(command, status, err):
+    """Report an unsuccessful HTAR command.
 
     Parameters
     ----------
     command : :class:`list`
-        Command to pass to :class:`subprocess.Popen`.
+        The HTAR command.
+    status : :class:`str`
+        The return code of `command`.
+    err : :class:`str`
+        Standard error of `command`.
+
+    Returns
+    -------
+    :class:`bool`
+        ``True`` if the HTAR command failed.
+    """
+    if status != '0' or err:
+        msg = "HTAR Backup failed! Command was: {0}.".format(' '.join(command))
+        if err:
+            msg += "\nHTAR error message was: " + err
+        log.critical(msg)
+        return True
+    return False
+
+
+class ExposureIndex(object):
+    """In-memory index of exposures present in the staging and destination
+    directories.
+
+    Each night is read with :func:`os.scandir` the first time it is needed;
+    after that the index is kept current by the daemon as it creates
+    nights and installs exposures, so no further filesystem access is needed.
+
+    Parameters
+    ----------
+    staging : :class:`str`
+        The staging directory.
+    destination : :class:`str`
+        The destination directory.
+    """
+
+    def __init__(self, staging, destination):
+        self.staging = staging
+        self.destination = destination
+        self.created = time.time()
+        self._nights = dict()
+        self._lock = threading.RLock()
+
+    def _night(self, night):
+        """Read `night` from disk if it is not already in the index.
+        """
+        if night not in self._nights:
+            n = {'staging': False, 'destination': False, 'exposures': dict()}
+            for area in ('staging', 'destination'):
+                exposures = _subdirectories(os.path.join(getattr(self, area), night))
+                if exposures is not None:
+                    n[area] = True
+                    for e in exposures:
+                        n['exposures'][e] = area
+            self._nights[night] = n
+        return self._nights[night]
+
+    def has_night(self, night, area):
+        """``True`` if `night` exists in `area`, ``'staging'`` or ``'destination'``.
+        """
+        with self._lock:
+            return self._night(night)[area]
+
+    def add_night(self, night, area):
+        """Record that `night` has been created in `area`.
+        """
+        with self._lock:
+            self._night(night)[area] = True
+
+    def location(self, night, exposure):
+        """Find an exposure.
+
+        Parameters
+        ----------
+        night : :class:`str`
+            Night of observation.
+        exposure : :class:`str`
+            Exposure number.
+
+        Returns
+        -------
+        :class:`str`
+            ``'staging'`` or ``'destination'``, or ``None`` if the exposure
+            is not present.
+        """
+        with self._lock:
+            return self._night(night)['exposures'].get(exposure)
+
+    def exposures(self, night, area):
+        """List the exposures of `night` present in `area`.
+
+        Parameters
+        ----------
+        night : :class:`str`
+            Night of observation.
+        area : :class:`str`
+            ``'staging'`` or ``'destination'``.
+
+        Returns
+        -------
+        :class:`list`
+            A sorted list of exposure numbers.
+        """
+        with self._lock:
+            return sorted([e for e, a in self._night(night)['exposures'].items() if a == area])
+
+    def add(self, night, exposure, area):
+        """Record that `exposure` is now present in `area`.
+        """
+        with self._lock:
+            n = self._night(night)
+            n[area] = True
+            n['exposures'][exposure] = area
+
+    def forget(self, night):
+        """Remove `night` from the index, so it will be read from disk again.
+        """
+        with self._lock:
+            self._nights.pop(night, None)
+
+
+def _subdirectories(directory):
+    """Find the subdirectories of `directory`.
+
+    Parameters
+    ----------
+    directory : :class:`str`
+        Directory to read.
+
+    Returns
+    -------
+    :class:`set`
+        The names of the subdirectories, or ``None`` if `directory`
+        does not exist.
+    """
+    try:
+        with os.scandir(directory) as it:
+            return set([entry.name for entry in it if entry.is_dir()])
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+class TransferJournal(object):
+    """Append-only, on-disk record of the transfer stage of each exposure.
+
+    Each change of stage is appended to `filename` as a single line of JSON
+    and flushed to disk immediately, so the record survives a crash of the
+    daemon.  Exposures that have been installed are dropped when the journal
+    is compacted, which happens every time the journal is loaded, and
+    at the end of each pass of the daemon.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Journal file.
+    """
+    stages = ('rsync', 'staged', 'installed')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._stages = dict()
+        self._lock = threading.Lock()
+        self._appended = 0
+        try:
+            with open(self.filename) as j:
+                for line in j:
+                    self._appended += 1
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        #
+                        # Possibly a partial line written during a crash.
+                        #
+                        continue
+                    if entry['stage'] == 'installed':
+                        self._stages.pop(entry['exposure'], None)
+                    else:
+                        self._stages[entry['exposure']] = entry['stage']
+        except FileNotFoundError:
+            pass
+        self.compact()
+
+    def stage(self, night, exposure):
+        """Look up the most recent stage of an exposure.
+
+        Parameters
+        ----------
+        night : :class:`str`
+            Night of observation.
+        exposure : :class:`str`
+            Exposure number.
+
+        Returns
+        -------
+        :class:`str`
+            The stage, or ``None`` if there is no incomplete
+            transfer of `exposure`.
+        """
+        with self._lock:
+            return self._stages.get(night + '/' + exposure)
+
+    def record(self, night, exposure, stage):
+        """Record that an exposure has reached `stage`.
+
+        Parameters
+        ----------
+        night : :class:`str`
+            Night of observation.
+        exposure : :class:`str`
+            Exposure number.
+        stage : :class:`str`
+            One of :attr:`stages`.
+        """
+        key = night + '/' + exposure
+        with self._lock:
+            if stage == 'installed':
+                if self._stages.pop(key, None) is None:
+                    return
+            else:
+                self._stages[key] = stage
+            with open(self.filename, 'a') as j:
+                j.write(json.dumps({'exposure': key, 'stage': stage}) + '\n')
+                j.flush()
+                os.fsync(j.fileno())
+            self._appended += 1
+
+    def compact(self):
+        """Rewrite the journal, keeping only incomplete transfers.
+
+        Nothing is done if no records have been added since the
+        journal was last compacted.
+        """
+        with self._lock:
+            if self._appended == 0:
+                return
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as j:
+                for key in sorted(self._stages):
+                    j.write(json.dumps({'exposure': key, 'stage': self._stages[key]}) + '\n')
+                j.flush()
+                os.fsync(j.fileno())
+            os.replace(tmp, self.filename)
+            self._appended = 0
+
+
+class ChecksumCache(object):
+    """Persistent record of files that have already been hashed.
+
+    Entries are keyed by ``NIGHT/EXPOSURE``, rather than by full path,
+    so an entry created in the staging directory remains valid after
+    the exposure is moved into the destination directory.  A file is only
+    considered known if its inode, size and modification time are unchanged.
+    All entries for an exposure are discarded if its checksum file changes.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Retrieve and store JSON-encoded cache data in `filename`.
+        If ``None``, the cache is only kept in memory.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.cache = dict()
+        self._lock = threading.Lock()
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename) as j:
+                self.cache = json.load(j)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    @staticmethod
+    def _key(checksum_file):
+        """Convert `checksum_file` into a ``NIGHT/EXPOSURE`` key.
+        """
+        d = os.path.dirname(checksum_file)
+        return os.path.basename(os.path.dirname(d)) + '/' + os.path.basename(d)
+
+    @staticmethod
+    def _stat(st):
+        """Reduce the output of :func:`os.stat` to the values stored in the cache.
+        """
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def _entry(self, checksum_file):
+        """Find the entry associated with `checksum_file`, invalidating it if necessary.
+        """
+        key = self._key(checksum_file)
+        cs = self._stat(os.stat(checksum_file))
+        if key not in self.cache or self.cache[key]['checksum'] != cs:
+            self.cache[key] = {'checksum': cs, 'files': dict()}
+        return self.cache[key]['files']
+
+    def get(self, checksum_file, filename, st):
+        """Look up the checksum of a file.
+
+        Parameters
+        ----------
+        checksum_file : :class:`str`
+            The checksum file that lists `filename`.
+        filename : :class:`str`
+            Name of the file, without any directory.
+        st : :class:`os.stat_result`
+            Current :func:`os.stat` of the file.
+
+        Returns
+        -------
+        :class:`str`
+            The cached checksum, or ``None`` if the file is unknown or
+            has changed.
+        """
+        with self._lock:
+            files = self._entry(checksum_file)
+            try:
+                value = files[filename]
+            except KeyError:
+                return None
+            if value[0:3] == self._stat(st):
+                return value[3]
+            return None
+
+    def set(self, checksum_file, filename, st, checksum):
+        """Record the checksum of a file.
+
+        Parameters
+        ----------
+        checksum_file : :class:`str`
+            The checksum file that lists `filename`.
+        filename : :class:`str`
+            Name of the file, without any directory.
+        st : :class:`os.stat_result`
+            :func:`os.stat` of the file at the time it was hashed.
+        checksum : :class:`str`
+            The hexadecimal digest.
+        """
+        with self._lock:
+            files = self._entry(checksum_file)
+            files[filename] = self._stat(st) + [checksum]
+
+    def save(self):
+        """Write the cache to disk.
+        """
+        if self.filename is None:
+            return
+        with self._lock:
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as j:
+                json.dump(self.cache, j, indent=None, separators=(',', ':'))
+            os.replace(tmp, self.filename)
+
+
+#
+# Summarize the output of find -printf '%P %s %T@\n' by exposure.
+# Files directly in the night directory are summarized as '.'.
+#
+_manifest_awk = ("'{n = split($1, p, \"/\"); e = (n > 1) ? p[1] : \".\"; " +
+                 "c[e]++; s[e] += $2; t = int($3); if (t > m[e]) m[e] = t} " +
+                 "END {for (e in c) printf \"%s %d %.0f %.0f\\n\", e, c[e], s[e], m[e]}'")
+
+
+def _parse_manifest(out):
+    """Convert the output of the remote manifest command into a :class:`dict`.
+
+    Parameters
+    ----------
+    out : :class:`str`
+        Output of the remote manifest command.
 
     Returns
     -------
-    :func:`tuple`
-        The returncode, standard output and standard error.
+    :class:`dict`
+        A mapping of exposure to a list containing the number of files,
+        total size and latest modification time of that exposure.
     """
-    with TemporaryFile() as tout, TemporaryFile() as terr:
-        p = sub.Popen(command, stdout=tout, stderr=terr)
-        p.wait()
-        tout.seek(0)
-        out = tout.read()
-        terr.seek(0)
-        err = terr.read()
-    return (str(p.returncode), out.decode('utf-8'), err.decode('utf-8'))
+    manifest = dict()
+    for line in out.split('\n'):
+        try:
+            e, count, size, mtime = line.split()
+            manifest[e] = [int(count), int(size), int(mtime)]
+        except ValueError:
+            pass
+    return manifest
+
+
+def _manifest(directory):
+    """Summarize the exposures in a local night `directory`.
 
+    Parameters
+    ----------
+    directory : :class:`str`
+        A night directory.
+
+    Returns
+    -------
+    :class:`dict`
+        A manifest in the same format returned by :func:`_parse_manifest`.
+    """
+    manifest = dict()
+    for dirpath, dirnames, filenames in os.walk(directory, followlinks=True):
+        r = os.path.relpath(dirpath, directory)
+        e = '.' if r == '.' else r.split(os.sep)[0]
+        for f in filenames:
+            try:
+                st = os.stat(os.path.join(dirpath, f))
+            except FileNotFoundError:
+                continue
+            if e not in manifest:
+                manifest[e] = [0, 0, 0]
+            manifest[e][0] += 1
+            manifest[e][1] += st.st_size
+            manifest[e][2] = max(manifest[e][2], int(st.st_mtime))
+    return manifest
+
+
+def _balance(files, n):
+    """Divide files into groups of roughly equal total size.
+
+    Parameters
+    ----------
+    files : :class:`list`
+        A list of (size, name) tuples.
+    n : :class:`int`
+        Maximum number of groups.
 
-def verify_checksum(checksum_file):
+    Returns
+    -------
+    :class:`list`
+        A list of non-empty lists of file names.
+    """
+    groups = [[0, list()] for i in range(min(n, len(files)))]
+    for size, name in sorted(files, reverse=True):
+        g = min(groups, key=lambda x: x[0])
+        g[0] += size
+        g[1].append(name)
+    return [sorted(g[1]) for g in groups]
+
+
+def _untar(stream, directory, night, blocksize=2**20):
+    """Unpack a tar stream containing `night` while computing checksums.
+
+    Only regular files and directories below `night` are unpacked.
+
+    Parameters
+    ----------
+    stream : file-like
+        A tar stream, for example the output of :command:`tar -c`.
+    directory : :class:`str`
+        Unpack into this directory.
+    night : :class:`str`
+        Night of observation.
+    blocksize : :class:`int`, optional
+        Copy files in chunks of this size.
+
+    Returns
+    -------
+    :class:`dict`
+        The SHA-256 hexdigest of each unpacked file, keyed by full path.
+    """
+    hashes = dict()
+    with tarfile.open(fileobj=stream, mode='r|') as tf:
+        for member in tf:
+            name = os.path.normpath(member.name)
+            parts = name.split(os.sep)
+            if os.path.isabs(name) or parts[0] != night or '..' in parts:
+                log.warning("Skipping unexpected file %s in tar stream.", member.name)
+                continue
+            path = os.path.join(directory, name)
+            if member.isdir():
+                log.debug("os.makedirs('%s', exist_ok=True)", path)
+                os.makedirs(path, exist_ok=True)
+            elif member.isfile():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                h = hashlib.sha256()
+                src = tf.extractfile(member)
+                with open(path, 'wb') as dst:
+                    while True:
+                        chunk = src.read(blocksize)
+                        if not chunk:
+                            break
+                        h.update(chunk)
+                        dst.write(chunk)
+                os.utime(path, (member.mtime, member.mtime))
+                hashes[path] = h.hexdigest()
+            else:
+                log.warning("Skipping unexpected file %s in tar stream.", member.name)
+    return hashes
+
+
+def _sha256(filename, blocksize=2**20):
+    """Compute the SHA-256 checksum of `filename`.
+
+    The file is read in chunks, so memory usage does not depend on the
+    size of the file.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Name of the file.
+    blocksize : :class:`int`, optional
+        Read the file in chunks of this many bytes (default 1 MiB).
+
+    Returns
+    -------
+    :class:`str`
+        The hexadecimal digest.
+    """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def verify_checksum(checksum_file, workers=None, cache=None):
     """Verify checksums supplied with the raw data.
 
+    Files are hashed concurrently, since :mod:`hashlib` releases the GIL
+    while hashing large buffers.
+
     Parameters
     ----------
     checksum_file : :class:`str`
         The checksum file.
+    workers : :class:`int`, optional
+        Hash at most this many files at the same time. If not set,
+        the default of :class:`concurrent.futures.ThreadPoolExecutor` is used.
+    cache : :class:`ChecksumCache`, optional
+        If set, do not hash files whose checksum is already in `cache`,
+        and record the checksums of any files that are hashed.
 
     Returns
     -------
@@ -546,11 +2224,26 @@ def verify_checksum(checksum_file):
         log.error("%d files are not listed in %s!", -1 * n_lines, checksum_file)
         errors += "{0:d} file(s) downloaded but not listed.\n".format(-1 * n_lines)
     digest = dict([(cl.split()[1], cl.split()[0]) for cl in lines if cl])
+    data_files = [os.path.join(d, f) for f in files if os.path.join(d, f) != checksum_file]
+    hashes = dict()
+    if cache is not None:
+        stats = dict([(ff, os.stat(ff)) for ff in data_files])
+        for ff in data_files:
+            h = cache.get(checksum_file, os.path.basename(ff), stats[ff])
+            if h is not None:
+                log.debug("Using cached checksum for %s.", ff)
+                hashes[ff] = h
+    new_files = [ff for ff in data_files if ff not in hashes]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes.update(zip(new_files, pool.map(_sha256, new_files)))
+    if cache is not None:
+        for ff in new_files:
+            cache.set(checksum_file, os.path.basename(ff), stats[ff], hashes[ff])
+        cache.save()
     for f in files:
         ff = os.path.join(d, f)
         if ff != checksum_file:
-            with open(ff, 'rb') as fp:
-                h = hashlib.sha256(fp.read()).hexdigest()
+            h = hashes[ff]
             try:
                 hh = digest[f]
             except KeyError:
@@ -567,7 +2260,55 @@ def verify_checksum(checksum_file):
     return errors
 
 
-def unlock_directory(directory, test=False):
+def _chmod_tree(directory, dir_mode, file_mode, test=False, only=None):
+    """Set the mode of a directory tree, skipping entries that already have it.
+
+    The tree is traversed with :func:`os.scandir` on open directory
+    descriptors, and modes are changed relative to those descriptors,
+    so full paths are never resolved again.  Symlinks are ignored.
+
+    Parameters
+    ----------
+    directory : :class:`str`
+        Top-level directory.
+    dir_mode : :class:`int`
+        Mode for directories.
+    file_mode : :class:`int`
+        Mode for files.
+    test : :class:`bool`, optional
+        If ``True``, only print the commands.
+    only : iterable, optional
+        If set, only descend into the subdirectories of `directory`
+        in `only`.  Files directly in `directory` are always included.
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    try:
+        if stat.S_IMODE(os.fstat(fd).st_mode) != dir_mode:
+            log.debug("os.chmod('%s', 0o%o)", directory, dir_mode)
+            if not test:
+                os.chmod(fd, dir_mode)
+        subdirectories = list()
+        with os.scandir(fd) as it:
+            for entry in sorted(it, key=lambda e: e.name):
+                if entry.is_symlink():
+                    continue
+                if entry.is_dir():
+                    if only is None or entry.name in only:
+                        subdirectories.append(entry.name)
+                elif stat.S_IMODE(entry.stat().st_mode) != file_mode:
+                    log.debug("os.chmod('%s', 0o%o)", os.path.join(directory, entry.name), file_mode)
+                    if not test:
+                        os.chmod(entry.name, file_mode, dir_fd=fd)
+    finally:
+        os.close(fd)
+    for s in subdirectories:
+        _chmod_tree(os.path.join(directory, s), dir_mode, file_mode, test)
+
+
+def unlock_directory(directory, test=False, only=None):
     """Set a directory and its contents user-writeable.
 
     Parameters
@@ -576,19 +2317,14 @@ def unlock_directory(directory, test=False):
         Directory to unlock.
     test : :class:`bool`, optional
         If ``True``, only print the commands.
+    only : iterable, optional
+        If set, only unlock these subdirectories of `directory`,
+        for example, the exposures in a night.
     """
-    for dirpath, dirnames, filenames in os.walk(directory):
-        log.debug("os.chmod('%s', 0o%o)", dirpath, dir_perm | stat.S_IWUSR)
-        if not test:
-            os.chmod(dirpath, dir_perm | stat.S_IWUSR)
-        for f in filenames:
-            log.debug("os.chmod('%s', 0o%o)", os.path.join(dirpath, f),
-                      file_perm | stat.S_IWUSR)
-            if not test:
-                os.chmod(os.path.join(dirpath, f), file_perm | stat.S_IWUSR)
+    _chmod_tree(directory, dir_perm | stat.S_IWUSR, file_perm | stat.S_IWUSR, test, only)
 
 
-def lock_directory(directory, test=False):
+def lock_directory(directory, test=False, only=None):
     """Set a directory and its contents read-only.
 
     Parameters
@@ -597,18 +2333,14 @@ def lock_directory(directory, test=False):
         Directory to lock.
     test : :class:`bool`, optional
         If ``True``, only print the commands.
+    only : iterable, optional
+        If set, only lock these subdirectories of `directory`,
+        for example, the exposures in a night.
     """
-    for dirpath, dirnames, filenames in os.walk(directory):
-        log.debug("os.chmod('%s', 0o%o)", dirpath, dir_perm)
-        if not test:
-            os.chmod(dirpath, dir_perm)
-        for f in filenames:
-            log.debug("os.chmod('%s', 0o%o)", os.path.join(dirpath, f), file_perm)
-            if not test:
-                os.chmod(os.path.join(dirpath, f), file_perm)
+    _chmod_tree(directory, dir_perm, file_perm, test, only)
 
 
-def rsync_night(source, destination, night, test=False):
+def rsync_night(source, destination, night, test=False, timeout=None, ssh=None, exposures=None, restrict=False):
     """Run an rsync command on an entire `night`, for example, to pick up
     delayed files.
 
@@ -622,21 +2354,39 @@ def rsync_night(source, destination, night, test=False):
         Night directory.
     test : :class:`bool`, optional
         If ``True``, only print the commands.
+    timeout : :class:`float`, optional
+        Kill rsync if it has not finished after this many seconds.
+    ssh : :class:`str`, optional
+        Remote shell passed to :func:`~desitransfer.common.rsync`.
+    exposures : iterable, optional
+        If set, only unlock and lock these subdirectories of `night`,
+        usually exposures, rather than the entire night.
+    restrict : :class:`bool`, optional
+        If ``True``, also restrict rsync to `exposures`.  Files directly
+        in `night` are always included.
+
+    Returns
+    -------
+    :class:`bool`
+        ``True`` if rsync succeeded.
     """
     #
     # Unlock files.
     #
-    unlock_directory(os.path.join(destination, night), test)
+    unlock_directory(os.path.join(destination, night), test, exposures)
     #
     # Run rsync.
     #
     cmd = rsync(os.path.join(source, night),
-                os.path.join(destination, night))
+                os.path.join(destination, night), ssh=ssh)
+    if restrict and exposures is not None:
+        i = cmd.index('--omit-dir-times') + 1
+        cmd[i:i] = ['--include=/{0}/***'.format(e) for e in sorted(exposures)] + ['--exclude=/*/']
     log.debug(' '.join(cmd))
     if test:
         rsync_status, out, err = '0', '', ''
     else:
-        rsync_status, out, err = _popen(cmd)
+        rsync_status, out, err = _popen(cmd, timeout=timeout)
     if rsync_status != '0':
         log.critical('rsync problem (status = %s) detected on catch-up for %s, check logs!',
                      rsync_status, night)
@@ -645,7 +2395,8 @@ def rsync_night(source, destination, night, test=False):
     #
     # Lock files.
     #
-    lock_directory(os.path.join(destination, night), test)
+    lock_directory(os.path.join(destination, night), test, exposures)
+    return rsync_status == '0'
 
 
 def main():
@@ -658,6 +2409,20 @@ def main():
     """
     options = _options()
     transfer = TransferDaemon(options)
+    if options.bulk:
+        failed = False
+        for d in transfer.directories:
+            status = transfer._transfer_status(os.path.join(os.path.dirname(d.staging),
+                                                            'status'))
+            for night in options.bulk.split(','):
+                log.info('Starting bulk transfer of %s/%s.', d.source, night)
+                try:
+                    failed |= not transfer.bulk(d, night, status)
+                except Exception:
+                    failed = True
+                    log.critical("Exception detected in bulk transfer of %s/%s!\n\n%s",
+                                 d.source, night, traceback.format_exc())
+        return int(failed)
     sleep = transfer.conf['common'].getint('sleep')
     while True:
         log.info('Starting transfer loop; desitransfer version = %s.',
@@ -665,6 +2430,7 @@ def main():
         if os.path.exists(options.kill):
             log.info("%s detected, shutting down transfer daemon.",
                      options.kill)
+            transfer.shutdown()
             return 0
         transfer.transfer()
         time.sleep(sleep * 60)
@@ -11,7 +11,8 @@ import os
 import stat
 import subprocess as sub
 from argparse import ArgumentParser
-from .common import dir_perm, file_perm, rsync, stamp
+from concurrent.futures import ThreadPoolExecutor
+from .common import dir_perm, file_perm, rsync, stamp, parse_rsync, _popen
 from . import __version__ as dtVersion
 
 
@@ -34,23 +35,34 @@ class DailyDirectory(object):
         self.source = source
         self.destination = destination
         self.log = self.destination + '.log'
+        self.failed = self.destination + '.failed'
         self.extra = extra
         self.dirlinks = dirlinks
 
-    def transfer(self, permission=True):
+    def transfer(self, permission=True, timeout=None):
         """Data transfer operations for a single destination directory.
 
         Parameters
         ----------
         permission : :class:`bool`, optional
             If ``True``, set permissions for DESI collaboration access.
+        timeout : :class:`float`, optional
+            Kill :command:`rsync` if it has not finished after this many seconds.
 
         Returns
         -------
         :class:`int`
             The status returned by :command:`rsync`.
+
+        Notes
+        -----
+        Only files and directories reported as changed by :command:`rsync`
+        are locked, and permissions are only reset if something changed.
+        Files transferred by a failed run are not reported again, so
+        a failure is recorded in a file, and the next successful run
+        locks the entire directory and resets permissions.
         """
-        cmd = rsync(self.source, self.destination)
+        cmd = rsync(self.source, self.destination, itemize=True)
         if not self.dirlinks:
             cmd[cmd.index('--copy-dirlinks')] = '--links'
         if self.extra:
@@ -61,25 +73,52 @@ class DailyDirectory(object):
             logfile.write(("DEBUG: %s\n" % ' '.join(cmd)).encode('utf-8'))
             logfile.write(("DEBUG: Transfer start: %s\n" % stamp()).encode('utf-8'))
             logfile.flush()
-            p = sub.Popen(cmd, stdout=logfile, stderr=sub.STDOUT)
-            status = p.wait()
+            rsync_status, out, err = _popen(cmd, timeout=timeout)
+            if out:
+                logfile.write(out.encode('utf-8'))
+            if err:
+                logfile.write(err.encode('utf-8'))
             logfile.write(("DEBUG: Transfer complete: %s\n" % stamp()).encode('utf-8'))
+        status = int(rsync_status)
         if status == 0:
-            self.lock()
-            if permission:
-                s = self.permission()
+            if os.path.exists(self.failed):
+                self.lock()
+                if permission:
+                    s = self.permission()
+                os.remove(self.failed)
+            else:
+                changed = [i.path for i in parse_rsync(out) if i.is_file or i.is_dir]
+                self.lock(changed)
+                if permission and changed:
+                    s = self.permission()
+        else:
+            with open(self.failed, 'w') as f:
+                f.write("%d\n" % status)
         return status
 
-    def lock(self):
+    def lock(self, paths=None):
         """Make a directory read-only.
+
+        Parameters
+        ----------
+        paths : :class:`list`, optional
+            If set, only lock these paths, relative to the destination directory.
         """
-        for dirpath, dirnames, filenames in os.walk(self.destination):
-            if stat.S_IMODE(os.stat(dirpath).st_mode) != dir_perm:
-                os.chmod(dirpath, dir_perm)
-            for f in filenames:
-                fpath = os.path.join(dirpath, f)
-                if stat.S_IMODE(os.stat(fpath).st_mode) != file_perm:
-                    os.chmod(fpath, file_perm)
+        if paths is None:
+            for dirpath, dirnames, filenames in os.walk(self.destination):
+                if stat.S_IMODE(os.stat(dirpath).st_mode) != dir_perm:
+                    os.chmod(dirpath, dir_perm)
+                for f in filenames:
+                    fpath = os.path.join(dirpath, f)
+                    if stat.S_IMODE(os.stat(fpath).st_mode) != file_perm:
+                        os.chmod(fpath, file_perm)
+        else:
+            for p in paths:
+                fpath = os.path.normpath(os.path.join(self.destination, p))
+                mode = os.stat(fpath).st_mode
+                perm = dir_perm if stat.S_ISDIR(mode) else file_perm
+                if stat.S_IMODE(mode) != perm:
+                    os.chmod(fpath, perm)
         with open(self.log, 'ab') as logfile:
             logfile.write(("DEBUG: Lock complete: %s\n" % stamp()).encode('utf-8'))
 
@@ -168,8 +207,12 @@ def _options():
     prsr.add_argument('-k', '--kill', metavar='FILE',
                       default=os.path.join(os.environ['HOME'], 'stop_desi_transfer'),
                       help="Exit the script when FILE is detected (default %(default)s).")
+    prsr.add_argument('-p', '--processes', metavar='N', type=int, default=1,
+                      help='Transfer up to N directories at the same time (default %(default)s).')
     prsr.add_argument('-P', '--no-permission', action='store_false', dest='permission',
                       help='Do not set permissions for DESI collaboration access.')
+    prsr.add_argument('-t', '--timeout', metavar='M', type=int, default=0,
+                      help='Kill rsync if it has not finished after M minutes (default %(default)s, i.e. never).')
     prsr.add_argument('-V', '--version', action='version',
                       version='%(prog)s {0}'.format(dtVersion))
     prsr.add_argument('timeframe', choices=['morning', 'noon'],
@@ -197,8 +240,12 @@ def main():
     if os.path.exists(options.kill):
         print(f"INFO: {options.kill} detected, shutting down daily {options.timeframe} transfer script.")
         return 0
-    for d in _config(options.timeframe):
-        s = d.transfer(permission=options.permission)
+    timeout = options.timeout * 60 if options.timeout > 0 else None
+    directories = _config(options.timeframe)
+    with ThreadPoolExecutor(max_workers=max(1, options.processes)) as pool:
+        statuses = list(pool.map(lambda d: d.transfer(permission=options.permission, timeout=timeout),
+                                 directories))
+    for d, s in zip(directories, statuses):
         if s != 0:
             print(f"ERROR: rsync problem detected for {d.source} -> {d.destination}!")
             status |= s
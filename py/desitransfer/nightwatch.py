@@ -32,8 +32,7 @@ from argparse import ArgumentParser
 from logging.handlers import RotatingFileHandler, SMTPHandler
 from socket import getfqdn
 from desiutil.log import get_logger
-from .common import rsync, today, idle_time
-from .daemon import _popen
+from .common import rsync, parse_rsync, today, idle_time, _popen, _popen_many
 from . import __version__ as dtVersion
 
 # Identify new night directory in a directory listing.
@@ -62,6 +61,8 @@ def _options():
                       help='Do not set permissions for DESI collaboration access.')
     prsr.add_argument('-s', '--sleep', metavar='M', type=int, default=1,
                       help='Sleep M minutes before checking for new data (default %(default)s minutes).')
+    prsr.add_argument('-t', '--timeout', metavar='M', type=int, default=0,
+                      help='Kill rsync if it has not finished after M minutes (default %(default)s, i.e. never).')
     prsr.add_argument('-V', '--version', action='version',
                       version='%(prog)s {0}'.format(dtVersion))
     return prsr.parse_args()
@@ -116,6 +117,7 @@ def main():
     _configure_log(options.debug)
     errcount = 0
     wait = options.sleep * 60
+    timeout = options.timeout * 60 if options.timeout > 0 else None
     source = '/exposures/nightwatch'
     basedir = os.path.join(os.environ['DESI_ROOT'], 'spectro', 'nightwatch')
     kpnodir = os.path.join(basedir, 'kpno')
@@ -147,7 +149,7 @@ def main():
         log.info('Checking for nightwatch data from %s.', night)
         cmd = ['/bin/rsync', 'dts:{0}/'.format(source)]
         log.debug(' '.join(cmd))
-        status, out, err = _popen(cmd)
+        status, out, err = _popen(cmd, timeout=timeout)
         found = False
         if status != '0':
             log.error('Error detected while syncing the list of nights; trying again in %d minutes.', night, options.sleep)
@@ -166,15 +168,23 @@ def main():
             time.sleep(wait)
             continue
         #
-        # Sync per-night directory.
+        # Sync per-night directory and, at the same time, the top level files;
+        # skip the logs.
         #
         nightdir = os.path.join(kpnodir, night)
-        cmd = rsync(os.path.join(source, night), nightdir)
+        cmd = rsync(os.path.join(source, night), nightdir, itemize=True)
         cmd.insert(cmd.index('--omit-dir-times') + 1, '--exclude-from')
         cmd.insert(cmd.index('--exclude-from') + 1, exclude)
+        top_cmd = ['/bin/rsync', '--verbose', '--links', '--times', '--files-from',
+                   include,
+                   'dts:{0}/'.format(source),
+                   '{0}/'.format(kpnodir)]
         log.info('Syncing %s.', night)
         log.debug(' '.join(cmd))
-        status, out, err = _popen(cmd)
+        log.info('Syncing top level html/js files.')
+        log.debug(' '.join(top_cmd))
+        (status, out, err), top_result = _popen_many([cmd, top_cmd], timeout=timeout)
+        changed = status != '0' or any(i.is_file or i.is_dir for i in parse_rsync(out))
         if status != '0':
             if 'file has vanished' in err:
                 log.warning("File vanished while syncing %s; not serious.")
@@ -188,7 +198,9 @@ def main():
         # Correct the permissions.
         #
         if options.permission:
-            if os.path.exists(nightdir):
+            if not changed:
+                log.info('No changes to %s; skipping permission changes.', nightdir)
+            elif os.path.exists(nightdir):
                 log.info('Fixing permissions for DESI.')
                 cmd = ['fix_permissions.sh', nightdir]
                 log.debug(' '.join(cmd))
@@ -203,16 +215,7 @@ def main():
                 log.info('No data yet for night %s.', night)
         else:
             log.info("Skipping permission changes at user request.")
-        #
-        # Sync the top level files; skip the logs.
-        #
-        log.info('Syncing top level html/js files.')
-        cmd = ['/bin/rsync', '--verbose', '--links', '--times', '--files-from',
-               include,
-               'dts:{0}/'.format(source),
-               '{0}/'.format(kpnodir)]
-        log.debug(' '.join(cmd))
-        status, out, err = _popen(cmd)
+        status, out, err = top_result
         if status != '0':
             log.error('Error detected while syncing top level html files.')
             log.error("STATUS = %s", status)
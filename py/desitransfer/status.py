@@ -6,11 +6,16 @@ desitransfer.status
 
 Entry point for :command:`desi_transfer_status`.
 """
+import fcntl
 import importlib.resources as ir
 import json
 import os
 import shutil
+import sqlite3
+import sys
+import threading
 import time
+from contextlib import contextmanager
 from datetime import date
 from argparse import ArgumentParser
 from desiutil.log import log, DEBUG
@@ -20,6 +25,24 @@ from . import __version__ as dtVersion
 class TransferStatus(object):
     """Simple object for interacting with desitransfer status reports.
 
+    Calls to :meth:`~TransferStatus.update` are serialized, so one
+    object may be shared by several threads.
+
+    Within a :meth:`~TransferStatus.batch` block, updates made by the
+    same thread are only written once, at the end of the block.
+    Updates are applied to the JSON file as it exists when they are
+    written, so several objects may update the same file.
+
+    In journal mode, each update is appended to a journal file instead of
+    rewriting the entire JSON file.  The journal is merged into the JSON
+    file by :meth:`~TransferStatus.compact`, which happens automatically
+    after `journal` updates.
+
+    If `database` is set, updates are stored in an SQLite database, which
+    may be shared safely by several processes, and the JSON file read by
+    the web page becomes an export of the database.  Existing data from
+    the JSON file are imported when the database contains no data for `year`.
+
     Parameters
     ----------
     directory : :class:`str`
@@ -29,10 +52,26 @@ class TransferStatus(object):
     year : :class:`str` or :class:`int`
         Update records belonging to `year`. If not set, the current
         year is assumed.
+    journal : :class:`int`, optional
+        If greater than zero, use journal mode and compact the journal
+        after this many updates.  Ignored if `database` is set.
+    database : :class:`str`, optional
+        Name of an SQLite database file.
+    export : :class:`int`, optional
+        In database mode, write the JSON file at most once every `export`
+        seconds.  Updates that have not been written yet are written by
+        :meth:`~TransferStatus.compact`.  Zero means write the JSON file
+        on every update.
     """
+    #
+    # Serialize writes to each JSON file by all objects in this process.
+    #
+    _json_locks = dict()
+    _json_locks_lock = threading.Lock()
 
-    def __init__(self, directory, install=False, year=None):
+    def __init__(self, directory, install=False, year=None, journal=0, database=None, export=0):
         self._stages = {'rsync': 0, 'checksum': 1, 'backup': 2}
+        self._lock = threading.RLock()
         self.directory = directory
         self.status = dict()
         if year is None:
@@ -42,6 +81,16 @@ class TransferStatus(object):
         self.first_year = "2018"
         self.json = os.path.join(self.directory,
                                  f'desi_transfer_status_{self.current_year}.json')
+        self.database = database
+        self.journal = 0 if database else journal
+        self.journal_file = os.path.join(self.directory,
+                                         f'desi_transfer_status_{self.current_year}.journal')
+        self._pending = 0
+        self._stat = None
+        self.export = export
+        self._exported = 0
+        self._local = threading.local()
+        self._index = dict()
         if not os.path.exists(self.directory) or install:
             log.debug("os.makedirs('%s', exist_ok=True)", self.directory)
             os.makedirs(self.directory, exist_ok=True)
@@ -56,15 +105,257 @@ class TransferStatus(object):
                 else:
                     log.debug("shutil.copy('%s', '%s')", src, self.directory)
                     shutil.copy(src, self.directory)
+        if self.database:
+            self._db = self._connect()
+            self._import()
+            self._version = self._data_version()
+            self.status = self._load()
+        else:
+            self.status = self._read()
+        self._index = dict()
+        if self.journal > 0:
+            self._pending = self._replay()
+        return
+
+    def _connect(self):
+        """Open the SQLite database, creating the table if necessary.
+
+        Returns
+        -------
+        :class:`sqlite3.Connection`
+            A connection in autocommit mode; transactions are managed explicitly.
+        """
+        log.debug("sqlite3.connect('%s')", self.database)
+        db = sqlite3.connect(self.database, timeout=60, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS status (' +
+                   'seq INTEGER PRIMARY KEY AUTOINCREMENT, year TEXT NOT NULL, ' +
+                   'night TEXT NOT NULL, expid TEXT NOT NULL, ' +
+                   'stage INTEGER NOT NULL, success INTEGER NOT NULL, ts INTEGER NOT NULL)')
+        db.execute('CREATE INDEX IF NOT EXISTS status_year_night_expid_stage ' +
+                   'ON status (year, night, expid, stage)')
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """Hold the database write lock for the duration of the block.
+        """
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._db
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _data_version(self):
+        """Return a number that changes when other connections modify the database.
+        """
+        return self._db.execute('PRAGMA data_version').fetchone()[0]
+
+    def _import(self):
+        """Copy data from the JSON file into an empty database.
+        """
+        with self._transaction() as db:
+            n = db.execute('SELECT COUNT(*) FROM status WHERE year = ?', (self.current_year,)).fetchone()[0]
+            if n > 0:
+                return
+            status = self._read()
+            rows = list()
+            for night in status:
+                for expid in status[night]:
+                    #
+                    # Oldest rows first, so that the most recent row has the highest seq.
+                    #
+                    for r in reversed(status[night][expid]):
+                        rows.append((self.current_year, night, expid, r[0], r[1], r[2]))
+            if rows:
+                log.info("Importing %d rows from %s into %s.", len(rows), self.json, self.database)
+                db.executemany('INSERT INTO status (year, night, expid, stage, success, ts) ' +
+                               'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def _load(self, night=None):
+        """Load status data from the database.
+
+        Parameters
+        ----------
+        night : :class:`str`, optional
+            Only load this night.
+
+        Returns
+        -------
+        :class:`dict`
+            The status data, in the same format as the JSON file.
+        """
+        query = 'SELECT night, expid, stage, success, ts FROM status WHERE year = ?'
+        args = (self.current_year,)
+        if night is not None:
+            query += ' AND night = ?'
+            args += (night,)
+        status = dict()
+        for n, expid, stage, success, ts in self._db.execute(query + ' ORDER BY night, expid, seq DESC', args):
+            status.setdefault(n, dict()).setdefault(expid, list()).append([stage, success, ts])
+        return status
+
+    def _refresh(self, night):
+        """Update the status data for `night` from the database.
+
+        If any other process has modified the database since it was last
+        read, all data are reloaded.
+
+        Parameters
+        ----------
+        night : :class:`str`
+            Night of observation.
+        """
+        version = self._data_version()
+        if version != self._version:
+            self._version = version
+            self.status = self._load()
+        else:
+            status = self._load(night)
+            if night in status:
+                self.status[night] = status[night]
+            else:
+                self.status.pop(night, None)
+        self._index = dict()
+
+    def _export(self):
+        """Write the status data from the database to the JSON file.
+
+        If any other process has modified the database since it was last
+        read, all data are reloaded first.
+        """
+        version = self._data_version()
+        if version != self._version:
+            self._version = version
+            self.status = self._load()
+            self._index = dict()
+        log.debug("Exporting %s to %s.", self.database, self.json)
+        self._write()
+        self._exported = time.time()
+        self._pending = 0
+
+    def _apply_db(self, night, exposure, row):
+        """Apply a single status `row` to the database.
+
+        This follows the same rules as :meth:`~TransferStatus._apply`.
+
+        Parameters
+        ----------
+        night : :class:`str`
+            Night of observation.
+        exposure : :class:`str`
+            Exposure number, or ``'all'``.
+        row : :class:`list`
+            Stage, success and timestamp.
+
+        Returns
+        -------
+        :class:`int`
+            The number of updates performed.
+
+        Raises
+        ------
+        :exc:`KeyError`
+            If `exposure` is ``'all'`` and `night` is not yet defined.
+        """
+        with self._transaction() as db:
+            if exposure == 'all':
+                expids = [e for e, in db.execute('SELECT DISTINCT expid FROM status WHERE year = ? AND night = ?',
+                                                 (self.current_year, night))]
+                if not expids:
+                    raise KeyError(night)
+                log.debug("INSERT %d rows for night %s", len(expids), night)
+                db.executemany('INSERT INTO status (year, night, expid, stage, success, ts) VALUES (?, ?, ?, ?, ?, ?)',
+                               [(self.current_year, night, e, row[0], row[1], row[2]) for e in expids])
+                return len(expids)
+            expid = str(int(exposure))
+            old_row = db.execute('SELECT seq, success, ts FROM status ' +
+                                 'WHERE year = ? AND night = ? AND expid = ? AND stage = ? ' +
+                                 'ORDER BY seq DESC LIMIT 1', (self.current_year, night, expid, row[0])).fetchone()
+            if old_row is None:
+                log.debug("INSERT [%d, %d, %d] for %s/%s", row[0], row[1], row[2], night, expid)
+                db.execute('INSERT INTO status (year, night, expid, stage, success, ts) VALUES (?, ?, ?, ?, ?, ?)',
+                           (self.current_year, night, expid, row[0], row[1], row[2]))
+            elif (row[2] >= old_row[2]) and (row[1] != old_row[1]):
+                log.debug("UPDATE [%d, %d, %d] for %s/%s", row[0], row[1], row[2], night, expid)
+                db.execute('UPDATE status SET success = ?, ts = ? WHERE seq = ?', (row[1], row[2], old_row[0]))
+            else:
+                #
+                # Rare edge case: daemon is in shadow/test mode and there
+                # are untransferred files.
+                #
+                return 0
+            return 1
+
+    def _read(self):
+        """Read the JSON file.
+
+        Returns
+        -------
+        :class:`dict`
+            The status data, which will be empty if the file does not
+            exist or is malformed.
+        """
         try:
             with open(self.json) as j:
+                self._stat = _file_key(os.fstat(j.fileno()))
                 try:
-                    self.status = json.load(j)
+                    status = json.load(j)
                 except json.JSONDecodeError:
                     self._handle_malformed()
+                    return dict()
         except FileNotFoundError:
-            pass
-        return
+            return dict()
+        #
+        # Rows are never modified in place, so identical rows, such as
+        # those created by backups, can share a single list.
+        #
+        shared = dict()
+        for night in status:
+            for expid in status[night]:
+                status[night][expid] = [shared.setdefault(tuple(r), r) for r in status[night][expid]]
+        return status
+
+    def _replay(self, journal=None):
+        """Apply records from the journal to the status data.
+
+        Parameters
+        ----------
+        journal : file-like, optional
+            An open journal file.  If not set, the journal file is opened
+            and read, if it exists.
+
+        Returns
+        -------
+        :class:`int`
+            The number of records applied.
+        """
+        if journal is None:
+            try:
+                with open(self.journal_file) as j:
+                    return self._replay(j)
+            except FileNotFoundError:
+                return 0
+        n = 0
+        for line in journal:
+            try:
+                night, exposure, row = json.loads(line)
+            except ValueError:
+                #
+                # An incomplete record may be left at the end of the file
+                # if a process was interrupted while writing.
+                #
+                log.warning("Skipping malformed record in %s.", self.journal_file)
+                continue
+            try:
+                self._apply(night, exposure, row)
+            except KeyError:
+                log.warning("Skipping record for undefined night %s in %s.", night, self.journal_file)
+                continue
+            n += 1
+        return n
 
     def _handle_malformed(self):
         """Handle malformed JSON files.
@@ -100,26 +391,129 @@ class TransferStatus(object):
         :class:`int`
             The number of updates performed.
         """
-        ts = int(time.time() * 1000)  # Convert to milliseconds for JS.
-        success = not failure
-        row = [self._stages[stage], int(success), ts]
+        with self._lock:
+            ts = int(time.time() * 1000)  # Convert to milliseconds for JS.
+            success = not failure
+            row = [self._stages[stage], int(success), ts]
+            if self.database:
+                r = self._apply_db(night, exposure, row)
+                if r > 0:
+                    self._refresh(night)
+            else:
+                r = self._apply(night, exposure, row)
+            if r == 0:
+                return 0
+            if getattr(self._local, 'depth', 0) > 0:
+                self._local.records.append([night, exposure, row])
+            else:
+                self._save([[night, exposure, row]])
+            return r
+
+    def _save(self, records):
+        """Write updates to disk.
+
+        Parameters
+        ----------
+        records : :class:`list`
+            Updates that have already been applied to the status data,
+            as lists of night, exposure and status row.
+        """
+        if self.database:
+            self._pending += len(records)
+            if time.time() - self._exported >= self.export:
+                self._export()
+        elif self.journal > 0:
+            self._append(*records)
+            self._pending += len(records)
+            if self._pending >= self.journal:
+                self.compact()
+        else:
+            self._merge(records)
+
+    def _merge(self, records):
+        """Apply updates to the JSON file as it currently exists on disk.
+
+        Other status objects, for example in background threads, may have
+        written the JSON file since it was read.  If so, it is read again and
+        `records` are applied to it before it is written.
+
+        Parameters
+        ----------
+        records : :class:`list`
+            Updates as lists of night, exposure and status row.
+        """
+        with self._json_locks_lock:
+            lock = self._json_locks.setdefault(os.path.abspath(self.json), threading.Lock())
+        with lock:
+            try:
+                key = _file_key(os.stat(self.json))
+            except FileNotFoundError:
+                key = None
+            if key != self._stat:
+                log.debug("%s has changed on disk; merging %d updates.", self.json, len(records))
+                self.status = self._read()
+                self._index = dict()
+                for night, exposure, row in records:
+                    try:
+                        self._apply(night, exposure, row)
+                    except KeyError:
+                        log.warning("Skipping update for undefined night %s in %s.", night, self.json)
+            self._write()
+
+    @contextmanager
+    def batch(self):
+        """Write all updates made by this thread within the block at once.
+
+        Blocks may be nested; updates are written when the outermost
+        block exits, even if an exception was raised.
+        """
+        depth = getattr(self._local, 'depth', 0)
+        if depth == 0:
+            self._local.records = list()
+        self._local.depth = depth + 1
+        try:
+            yield self
+        finally:
+            self._local.depth = depth
+            if depth == 0 and self._local.records:
+                with self._lock:
+                    self._save(self._local.records)
+                self._local.records = list()
+
+    def _apply(self, night, exposure, row):
+        """Apply a single status `row` to the status data.
+
+        Parameters
+        ----------
+        night : :class:`str`
+            Night of observation.
+        exposure : :class:`str`
+            Exposure number, or ``'all'``.
+        row : :class:`list`
+            Stage, success and timestamp.
+
+        Returns
+        -------
+        :class:`int`
+            The number of updates performed.
+        """
         if exposure == 'all':
             rows = list()
             for expid in self.status[night]:
                 log.debug("self.status['%s']['%s'].insert(0, [%d, %d, %d])", night, expid, row[0], row[1], row[2])
-                self.status[night][expid].insert(0, row)
+                self._insert(night, expid, row)
                 rows.append(row)
         else:
             expid = str(int(exposure))
             if night not in self.status:
                 log.debug("self.status['%s'] = {'%s': []}", night, expid)
                 self.status[night] = {expid: []}
-            log.debug("il = self.find('%s', '%s', '%s')", night, expid, stage)
-            il = self.find(night, expid, stage)
+            log.debug("il = self._rows('%s', '%s', %d)", night, expid, row[0])
+            il = self._rows(night, expid, row[0])
             if il:
                 old_row = self.status[night][expid][il[0]]
                 log.debug("self.status['%s']['%s'][%d] = [%d, %d, %d]", night, expid, il[0], old_row[0], old_row[1], old_row[2])
-                update = (ts >= old_row[2]) and (int(success) != old_row[1])
+                update = (row[2] >= old_row[2]) and (row[1] != old_row[1])
                 if update:
                     log.debug("self.status['%s']['%s'][%d] = [%d, %d, %d]", night, expid, il[0], row[0], row[1], row[2])
                     self.status[night][expid][il[0]] = row
@@ -131,13 +525,133 @@ class TransferStatus(object):
                     #
                     return 0
             else:
-                try:
-                    log.debug("self.status['%s']['%s'].insert(0, [%d, %d, %d])", night, expid, row[0], row[1], row[2])
-                    self.status[night][expid].insert(0, row)
-                except KeyError:
-                    log.debug("self.status['%s']['%s'] = [%d, %d, %d]", night, expid, row[0], row[1], row[2])
-                    self.status[night][expid] = [row]
+                log.debug("self.status['%s']['%s'].insert(0, [%d, %d, %d])", night, expid, row[0], row[1], row[2])
+                self._insert(night, expid, row)
                 rows = [row, ]
+        r = len(rows)
+        if r == 0:
+            return 1
+        return r
+
+    def _positions(self, night, expid):
+        """Obtain the index of rows by stage for a single exposure.
+
+        Rows are always inserted at the front of an exposure's list, so
+        positions are counted from the end of the list, and remain valid
+        when rows are inserted.  The index is rebuilt if the list has
+        changed length behind its back.
+
+        Parameters
+        ----------
+        night : :class:`str`
+            Night of observation.
+        expid : :class:`str`
+            Exposure number.
+
+        Returns
+        -------
+        :class:`dict`
+            A mapping of stage number to positions, in increasing order.
+
+        Raises
+        ------
+        :exc:`KeyError`
+            If `night` or `expid` is not yet defined.
+        """
+        rows = self.status[night][expid]
+        try:
+            n, positions = self._index[(night, expid)]
+            if n == len(rows):
+                return positions
+        except KeyError:
+            pass
+        positions = dict()
+        for p, r in enumerate(reversed(rows)):
+            positions.setdefault(r[0], []).append(p)
+        self._index[(night, expid)] = (len(rows), positions)
+        return positions
+
+    def _rows(self, night, expid, stage):
+        """Find the rows of an exposure that match a stage number.
+
+        Parameters
+        ----------
+        night : :class:`str`
+            Night of observation.
+        expid : :class:`str`
+            Exposure number.
+        stage : :class:`int`
+            Stage number.
+
+        Returns
+        -------
+        :class:`list`
+            Indexes of matching rows, most recent first.
+        """
+        try:
+            positions = self._positions(night, expid)
+        except KeyError:
+            return list()
+        n = len(self.status[night][expid])
+        return [n - 1 - p for p in reversed(positions.get(stage, []))]
+
+    def _insert(self, night, expid, row):
+        """Insert `row` as the most recent row of an exposure, keeping the index current.
+
+        Parameters
+        ----------
+        night : :class:`str`
+            Night of observation.
+        expid : :class:`str`
+            Exposure number.
+        row : :class:`list`
+            Stage, success and timestamp.
+        """
+        try:
+            rows = self.status[night][expid]
+        except KeyError:
+            rows = self.status[night][expid] = list()
+        n = len(rows)
+        rows.insert(0, row)
+        try:
+            m, positions = self._index[(night, expid)]
+        except KeyError:
+            return
+        if m == n:
+            positions.setdefault(row[0], []).append(n)
+            self._index[(night, expid)] = (n + 1, positions)
+
+    def _append(self, *records):
+        """Append `records` to the journal and flush them to disk.
+
+        Parameters
+        ----------
+        records : :class:`list`
+            Night, exposure and status row of each record.
+        """
+        with open(self.journal_file, 'ab+') as j:
+            fcntl.flock(j, fcntl.LOCK_EX)
+            try:
+                #
+                # Do not append to an incomplete record.
+                #
+                end = j.seek(0, os.SEEK_END)
+                if end > 0:
+                    j.seek(end - 1)
+                    if j.read(1) != b'\n':
+                        j.write(b'\n')
+                j.write(''.join([json.dumps(r, separators=(',', ':')) + '\n' for r in records]).encode('utf-8'))
+                j.flush()
+                os.fsync(j.fileno())
+            finally:
+                fcntl.flock(j, fcntl.LOCK_UN)
+
+    def _write(self):
+        """Write the status data to the JSON file.
+
+        The data are written to a temporary file that then replaces the
+        JSON file, so readers never see a partially-written file.
+        """
         #
         # Copy the original file before modifying.
         # This will overwrite any existing .bak file
@@ -147,12 +661,59 @@ class TransferStatus(object):
             shutil.copy2(self.json, self.json + '.bak')
         except FileNotFoundError:
             pass
-        with open(self.json, 'w') as j:
+        tmp = '{0}.{1:d}.{2:d}.tmp'.format(self.json, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as j:
             json.dump(self.status, j, indent=None, separators=(',', ':'))
-        r = len(rows)
-        if r == 0:
-            return 1
-        return r
+        try:
+            shutil.copymode(self.json, tmp)
+        except FileNotFoundError:
+            pass
+        stat = _file_key(os.stat(tmp))
+        os.replace(tmp, self.json)
+        self._stat = stat
+
+    def compact(self):
+        """Merge the journal into the JSON file.
+
+        The JSON file and journal are read again from disk, so updates
+        journaled by other processes are preserved.  In database mode,
+        updates that have not yet been exported are written to the JSON file.
+
+        Returns
+        -------
+        :class:`int`
+            The number of journal records merged or updates exported.
+        """
+        if self.database:
+            with self._lock:
+                n = self._pending
+                if n > 0:
+                    self._export()
+                return n
+        if self.journal <= 0:
+            return 0
+        with self._lock:
+            try:
+                j = open(self.journal_file, 'r+')
+            except FileNotFoundError:
+                self._pending = 0
+                return 0
+            with j:
+                fcntl.flock(j, fcntl.LOCK_EX)
+                try:
+                    self.status = self._read()
+                    self._index = dict()
+                    n = self._replay(j)
+                    if n > 0:
+                        log.debug("Merging %d records from %s into %s.", n, self.journal_file, self.json)
+                        self._write()
+                    j.truncate(0)
+                    j.flush()
+                    os.fsync(j.fileno())
+                finally:
+                    fcntl.flock(j, fcntl.LOCK_UN)
+            self._pending = 0
+            return n
 
     def find(self, night, exposure=None, stage=None):
         """Find status entries that match `night`, etc.
@@ -191,7 +752,7 @@ class TransferStatus(object):
         elif exposure is None:
             e = dict()
             for expid in self.status[night]:
-                e[expid] = [k for k, r in enumerate(self.status[night][expid]) if r[0] == self._stages[stage]]
+                e[expid] = self._rows(night, expid, self._stages[stage])
             return e
         elif stage is None:
             try:
@@ -202,11 +763,13 @@ class TransferStatus(object):
                 e = self.status[night][exposure] = list()
             return e
         else:
-            try:
-                r = [k for k, r in enumerate(self.status[night][exposure]) if r[0] == self._stages[stage]]
-            except KeyError:
-                r = list()
-            return r
+            return self._rows(night, exposure, self._stages[stage])
+
+
+def _file_key(st):
+    """Summarize :func:`os.stat` results to detect changes to a file.
+    """
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
 
 
 def _options():
@@ -223,22 +786,78 @@ def _options():
                       default=os.path.join(os.environ['DESI_ROOT'],
                                            'spectro', 'staging', 'status'),
                       help="Install and update files in DIR (default %(default)s).")
+    prsr.add_argument('-D', '--database', metavar='FILE',
+                      default=os.environ.get('DESI_TRANSFER_STATUS_DB'),
+                      help="Store status in the SQLite database FILE and export it to JSON " +
+                           "(default %(default)s, or set DESI_TRANSFER_STATUS_DB).")
     prsr.add_argument('-f', '--failure', action='store_true', dest='failure',
                       help='Indicate that the transfer failed somehow.')
+    prsr.add_argument('-F', '--from-file', dest='from_file', metavar='FILE',
+                      help="Read many updates from FILE, or standard input if FILE is '-'. " +
+                           "Each line should contain 'YYYYMMDD EXPID STAGE [failure]'.")
     prsr.add_argument('-i', '--install', action='store_true', dest='install',
                       help='Ensure that HTML and related files are in place.')
     prsr.add_argument('-V', '--version', action='version',
                       version='%(prog)s {0}'.format(dtVersion))
     prsr.add_argument('-v', '--verbose', action='store_true',
                       help='Print debugging information.')
-    prsr.add_argument('night', type=int, metavar='YYYYMMDD',
+    prsr.add_argument('night', type=int, metavar='YYYYMMDD', nargs='?',
                       help="Night of observation.")
-    prsr.add_argument('expid', metavar='EXPID',
+    prsr.add_argument('expid', metavar='EXPID', nargs='?',
                       help="Exposure number, or 'all'.")
-    prsr.add_argument('stage',
+    prsr.add_argument('stage', nargs='?',
                       choices=['rsync', 'checksum', 'backup'],
                       help="Transfer stage.")
-    return prsr.parse_args()
+    options = prsr.parse_args()
+    if options.from_file is None and options.stage is None:
+        prsr.error("YYYYMMDD, EXPID and STAGE are required unless --from-file is used.")
+    return options
+
+
+def _read_updates(lines):
+    """Parse status updates, one per line.
+
+    Blank lines and lines starting with ``#`` are ignored.
+
+    Parameters
+    ----------
+    lines : iterable
+        Lines of the form ``YYYYMMDD EXPID STAGE [failure]``.
+
+    Returns
+    -------
+    :class:`tuple`
+        A list of (night, expid, stage, failure) tuples, and the number
+        of lines that could not be parsed.
+    """
+    updates = list()
+    errors = 0
+    for n, line in enumerate(lines):
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith('#'):
+            continue
+        try:
+            night, expid, stage = fields[0:3]
+            if len(night) != 8 or not night.isdigit():
+                raise ValueError('night')
+            if stage not in ('rsync', 'checksum', 'backup'):
+                raise ValueError('stage')
+            if expid != 'all':
+                int(expid)
+            if len(fields) == 3:
+                failure = False
+            elif len(fields) == 4 and fields[3].lower() in ('failure', '--failure', 'true', '1'):
+                failure = True
+            elif len(fields) == 4 and fields[3].lower() in ('success', 'false', '0'):
+                failure = False
+            else:
+                raise ValueError('failure')
+        except ValueError:
+            log.error("Could not parse line %d: '%s'.", n + 1, line.rstrip())
+            errors += 1
+            continue
+        updates.append((night, expid, stage, failure))
+    return (updates, errors)
 
 
 def main():
@@ -253,8 +872,44 @@ def main():
     options = _options()
     if options.verbose:
         log.setLevel(DEBUG)
-    log.debug("st = TransferStatus('%s', install=%s, year='%s')", options.directory, options.install, str(options.night)[0:4])
-    st = TransferStatus(options.directory, install=options.install, year=str(options.night)[0:4])
+    if options.from_file is not None:
+        if options.from_file == '-':
+            updates, errors = _read_updates(sys.stdin)
+        else:
+            with open(options.from_file) as f:
+                updates, errors = _read_updates(f)
+        #
+        # Each year is stored separately, so load and save each year once.
+        #
+        statuses = dict()
+        for night, expid, stage, failure in updates:
+            year = night[0:4]
+            if year not in statuses:
+                log.debug("st = TransferStatus('%s', install=%s, year='%s', database=%s)",
+                          options.directory, options.install, year, options.database)
+                statuses[year] = TransferStatus(options.directory, install=options.install, year=year,
+                                                database=options.database)
+        applied = 0
+        for year in statuses:
+            st = statuses[year]
+            with st.batch():
+                for night, expid, stage, failure in updates:
+                    if night[0:4] != year:
+                        continue
+                    log.debug("st.update('%s', '%s', '%s', %s)", night, expid, stage, failure)
+                    try:
+                        st.update(night, expid, stage, failure)
+                    except KeyError:
+                        log.error("Undefined night = '%s'!", night)
+                        errors += 1
+                    else:
+                        applied += 1
+        log.info("Applied %d updates with %d errors.", applied, errors)
+        return int(errors > 0)
+    log.debug("st = TransferStatus('%s', install=%s, year='%s', database=%s)",
+              options.directory, options.install, str(options.night)[0:4], options.database)
+    st = TransferStatus(options.directory, install=options.install, year=str(options.night)[0:4],
+                        database=options.database)
     log.debug("st.update('%s', '%s', '%s', %s)", str(options.night), options.expid, options.stage, options.failure)
     st.update(str(options.night), options.expid, options.stage, options.failure)
     return 0
@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 """Test desitransfer.common.
 """
+import sys
 from datetime import datetime, timedelta
 import unittest
 from unittest.mock import patch
 from tempfile import TemporaryDirectory
-from ..common import (dt, MST, dir_perm, file_perm, empty_rsync, new_exposures, rsync,
-                      stamp, ensure_scratch, yesterday, today, idle_time, exclude_years)
+from ..common import (dt, MST, dir_perm, file_perm, empty_rsync, new_exposures, parse_rsync, rsync,
+                      stamp, ensure_scratch, yesterday, today, idle_time, exclude_years,
+                      SSHMaster, _popen, _popen_many)
 
 
 class FakeDateTime(datetime):
@@ -46,6 +48,30 @@ class TestCommon(unittest.TestCase):
         self.assertEqual(dir_perm, 0o2750)
         self.assertEqual(file_perm, 0o0440)
 
+    def test_popen(self):
+        """Test asynchronous subprocess wrapper.
+        """
+        pp = _popen([sys.executable, '-c', 'import sys; print("MOCK"); print("ERROR", file=sys.stderr)'])
+        self.assertEqual(pp, ('0', 'MOCK\n', 'ERROR\n'))
+        pp = _popen([sys.executable, '-c', 'import sys; sys.exit(2)'])
+        self.assertEqual(pp, ('2', '', ''))
+        pp = _popen([sys.executable, '-c', 'import sys; sys.stdout.write("x"*3000000)'])
+        self.assertEqual(pp[0], '0')
+        self.assertEqual(len(pp[1]), 3000000)
+        pp = _popen([sys.executable, '-c', 'import time; time.sleep(30)'], timeout=0.5)
+        self.assertNotEqual(pp[0], '0')
+        self.assertEqual(pp[2], 'Command timed out after 0.5 seconds.\n')
+
+    def test_popen_many(self):
+        """Test running several commands at the same time.
+        """
+        commands = [[sys.executable, '-c', 'import time; time.sleep(0.{0:d}); print({0:d})'.format(i)]
+                    for i in (3, 1, 2)]
+        pp = _popen_many(commands)
+        self.assertListEqual(pp, [('0', '3\n', ''), ('0', '1\n', ''), ('0', '2\n', '')])
+        pp = _popen_many(commands, limit=1)
+        self.assertListEqual(pp, [('0', '3\n', ''), ('0', '1\n', ''), ('0', '2\n', '')])
+
     def test_empty_rsync(self):
         """Test parsing of rsync output.
         """
@@ -81,6 +107,42 @@ total size is 118,417,836,324  speedup is 494,367.55
 """
         self.assertEqual(len(new_exposures(r)), 2)
 
+    def test_parse_rsync(self):
+        """Test parsing of itemized rsync output.
+        """
+        r = """receiving incremental file list
+cd+++++++++          4,096 12345678/
+>f+++++++++     12,345,678 12345678/desi-12345678.fits.fz
+>f..t......            123 12345679/request-12345679.json
+.f...p.....            456 12345679/guide-12345679.fits.fz
+cL+++++++++             11 latest -> 12345679
+*deleting                0 12345680/old.txt
+
+sent 765 bytes  received 238,769 bytes  159,689.33 bytes/sec
+total size is 118,417,836,324  speedup is 494,367.55
+"""
+        items = list(parse_rsync(r))
+        self.assertEqual(len(items), 6)
+        self.assertEqual(items[0].path, '12345678/')
+        self.assertEqual(items[0].size, 4096)
+        self.assertTrue(items[0].is_dir)
+        self.assertTrue(items[0].new)
+        self.assertEqual(items[0].top, '12345678')
+        self.assertEqual(items[1].size, 12345678)
+        self.assertTrue(items[1].is_file)
+        self.assertTrue(items[1].content)
+        self.assertTrue(items[2].content)
+        self.assertFalse(items[2].new)
+        self.assertTrue(items[3].metadata)
+        self.assertFalse(items[3].content)
+        self.assertFalse(items[4].is_file)
+        self.assertEqual(items[4].path, 'latest -> 12345679')
+        self.assertTrue(items[5].deleted)
+        self.assertFalse(items[5].is_file)
+        self.assertEqual(items[5].top, '12345680')
+        self.assertListEqual(list(parse_rsync(r.split('\n'))), items)
+        self.assertListEqual(list(parse_rsync('')), [])
+
     def test_rsync(self):
         """Test construction of rsync command.
         """
@@ -100,6 +162,37 @@ total size is 118,417,836,324  speedup is 494,367.55
                                  '--omit-dir-times', '/source/',
                                  'dts:/destination/'])
 
+    @patch('desitransfer.common._popen')
+    def test_SSHMaster(self, mock_popen):
+        """Test management of a shared ssh connection.
+        """
+        s = SSHMaster('dts', control_path='/tmp/cm', persist=5)
+        options = ['-o', 'ControlMaster=auto', '-o', 'ControlPath=/tmp/cm', '-o', 'ControlPersist=5m']
+        self.assertListEqual(s.command('/bin/ls', '/foo'),
+                             ['/bin/ssh'] + options + ['-q', 'dts', '/bin/ls', '/foo'])
+        self.assertEqual(s.rsh(), ' '.join(['/bin/ssh'] + options))
+        r = rsync('/source', '/destination', ssh=s.rsh())
+        self.assertListEqual(r, ['/bin/rsync', '--verbose',
+                                 '--recursive', '--copy-dirlinks', '--times',
+                                 '--omit-dir-times', '-e', s.rsh(), 'dts:/source/',
+                                 '/destination/'])
+        mock_popen.return_value = ('0', '', 'Master running (pid=1234)')
+        self.assertTrue(s.ensure())
+        mock_popen.assert_called_once_with(['/bin/ssh', '-o', 'ControlPath=/tmp/cm', '-O', 'check', 'dts'],
+                                           timeout=None)
+        mock_popen.reset_mock()
+        mock_popen.side_effect = [('255', '', 'Control socket connect(/tmp/cm): No such file or directory'),
+                                  ('0', '', '')]
+        self.assertTrue(s.ensure())
+        mock_popen.assert_called_with(['/bin/ssh', '-f', '-N', '-o', 'ControlMaster=yes',
+                                       '-o', 'ControlPath=/tmp/cm', '-o', 'ControlPersist=5m', 'dts'],
+                                      timeout=None)
+        mock_popen.side_effect = None
+        mock_popen.return_value = ('0', '', 'Exit request sent.')
+        self.assertTrue(s.stop())
+        mock_popen.assert_called_with(['/bin/ssh', '-o', 'ControlPath=/tmp/cm', '-O', 'exit', 'dts'],
+                                      timeout=None)
+
     @patch('desitransfer.common.dt')
     def test_stamp(self, mock_dt):
         """Test timestamp.
@@ -3,19 +3,25 @@
 """Test desitransfer.daemon.
 """
 import datetime
+import hashlib
 import importlib.resources as ir
 import json
 import logging
 import os
 import shutil
+import stat
 import sys
+import tarfile
+import threading
 import unittest
 import requests
+from io import BytesIO
 from tempfile import TemporaryDirectory
 from unittest.mock import call, patch, MagicMock
-from ..daemon import (_options, TransferDaemon, _popen, log,
-                      verify_checksum, lock_directory, unlock_directory,
-                      rsync_night)
+from ..common import SSHMaster
+from ..daemon import (_options, TransferDaemon, log, _sha256,
+                      ChecksumCache, TransferJournal, _balance, _untar, verify_checksum, lock_directory, unlock_directory,
+                      rsync_night, _manifest, _parse_manifest)
 
 
 class TestDaemon(unittest.TestCase):
@@ -168,6 +174,87 @@ desi_spectro_data_20190702.tar.idx
         mock_popen.return_value = ('2', '', 'No such file.')
         self.assertFalse(d.checksum_lock())
 
+    @patch('time.time')
+    @patch('desitransfer.daemon.TransferStatus')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_schedule(self, mock_cl, mock_log, mock_status, mock_time):
+        """Test concurrent transfer of several sections.
+        """
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        c = transfer.directories[0]
+        transfer.directories.append(c._replace(source='/data/dts/exposures/other', interval=10))
+        transfer.conf['common']['sections'] = '2'
+        mock_time.return_value = 1000000.0
+        started = [threading.Event(), threading.Event()]
+        finish = threading.Event()
+        calls = list()
+
+        def fake_directory(d, status):
+            calls.append((d.source, status))
+            started[len(calls) - 1].set()
+            finish.wait(10)
+
+        with patch.object(transfer, 'checksum_lock') as mock_lock, \
+                patch.object(transfer, 'directory', side_effect=fake_directory):
+            mock_lock.return_value = False
+            transfer.transfer()
+            self.assertTrue(started[0].wait(10))
+            self.assertTrue(started[1].wait(10))
+            transfer.transfer()
+            mock_log.debug.assert_has_calls([call("Transfer of %s is still running.", c.source),
+                                             call("Transfer of %s is still running.", '/data/dts/exposures/other')])
+            finish.set()
+            for task in transfer._section_tasks.values():
+                task.result()
+            mock_time.return_value = 1000000.0 + 60.0
+            transfer.transfer()
+            transfer._sections.shutdown(wait=True)
+        mock_log.debug.assert_any_call("Next transfer of %s is not due yet.", '/data/dts/exposures/other')
+        self.assertEqual([x[0] for x in calls], [c.source, '/data/dts/exposures/other', c.source])
+        #
+        # Sections that were running at the same time share a status object.
+        #
+        self.assertIs(calls[0][1], calls[1][1])
+        mock_status.assert_has_calls([call('/desi/root/spectro/staging/status', journal=0, database=None, export=0),
+                                      call('/desi/root/spectro/staging/status', journal=0, database=None, export=0)])
+        self.assertEqual(mock_status.call_count, 2)
+        self.assertEqual(transfer._statuses, dict())
+
+    @patch('desitransfer.daemon._popen')
+    @patch('desitransfer.common._popen')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_ssh_master(self, mock_cl, mock_log, mock_cpopen, mock_popen):
+        """Test sharing an ssh connection.
+        """
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            d = TransferDaemon(options)
+        self.assertIsNone(d.ssh)
+        self.assertIsNone(d._rsh())
+        self.assertEqual(d._ssh('/bin/ls'), ['/bin/ssh', '-q', 'dts', '/bin/ls'])
+        d.ssh = SSHMaster('dts', control_path='/tmp/cm')
+        options = ['-o', 'ControlMaster=auto', '-o', 'ControlPath=/tmp/cm', '-o', 'ControlPersist=10m']
+        self.assertEqual(d._rsh(), ' '.join(['/bin/ssh'] + options))
+        mock_popen.return_value = ('0', '/tmp/checksum-running', '')
+        mock_cpopen.side_effect = [('255', '', 'No ControlPath'), ('255', '', 'Connection refused')]
+        d.transfer()
+        mock_log.warning.assert_called_once_with('Could not start ssh master connection to dts; ' +
+                                                 'commands will open separate connections.')
+        mock_popen.assert_called_once_with(['/bin/ssh'] + options + ['-q', 'dts', '/bin/ls',
+                                           d.conf['common']['checksum_lock']], timeout=None)
+
     @patch('desitransfer.daemon.requests')
     @patch('desitransfer.daemon.log')
     @patch.object(TransferDaemon, '_configure_log')
@@ -237,8 +324,8 @@ desi_spectro_data_20190702.tar.idx
         mock_popen.return_value = ('0', links1, '')
         mock_backup.return_value = True
         transfer.directory(c[0])
-        mock_status.assert_called_once_with(os.path.join(os.path.dirname(c[0].staging), 'status'))
-        mock_popen.assert_called_once_with(['/bin/ssh', '-q', 'dts', '/bin/find', c[0].source, '-type', 'l'])
+        mock_status.assert_called_once_with(os.path.join(os.path.dirname(c[0].staging), 'status'), journal=0, database=None, export=0)
+        mock_popen.assert_called_once_with(['/bin/ssh', '-q', 'dts', '/bin/find', c[0].source, '-type', 'l'], timeout=None)
         mock_catchup.assert_called_once_with(c[0], '20190703', mock_status())
         mock_backup.assert_called_once_with(c[0], '20190703', mock_status())
         mock_status().update.assert_called_once_with('20190703', 'all', 'backup')
@@ -256,6 +343,179 @@ desi_spectro_data_20190702.tar.idx
         mock_log.warning.assert_has_calls([call('No links found, check connection.'),
                                            call('Malformed symlink detected: %s. Skipping.', '20190702/0000012'),
                                            call('Malformed symlink detected: %s. Skipping.', '20190702/00000123.tmp')])
+        #
+        # Links that have already been handled are skipped.
+        #
+        mock_exposure.reset_mock()
+        transfer._seen[c[0].source] = {'20190702/00000123', '20190702/00000124', '20190701/00000100'}
+        mock_popen.return_value = ('0', links1, '')
+        transfer.directory(c[0])
+        mock_exposure.assert_has_calls([call(c[0], '20190703/00000125', mock_status()),
+                                        call(c[0], '20190703/00000126', mock_status()),
+                                        call(c[0], '20190703/00000127', mock_status())])
+        self.assertEqual(mock_exposure.call_count, 3)
+        self.assertEqual(transfer._seen[c[0].source], {'20190702/00000123', '20190702/00000124'})
+
+    @patch('time.time')
+    @patch('desitransfer.daemon.yesterday')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_lookback(self, mock_cl, mock_log, mock_yst, mock_time):
+        """Test scheduling of older nights for catch-up and backup.
+        """
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        c = transfer.directories
+        mock_yst.return_value = '20190703'
+        mock_time.return_value = 100000.0
+        self.assertListEqual(transfer.lookback(c[0], 'catchup'), ['20190703'])
+        transfer.conf['common']['lookback'] = '3'
+        transfer.conf['common']['lookback_interval'] = '10'
+        self.assertListEqual(transfer.lookback(c[0], 'catchup'), ['20190703', '20190702'])
+        self.assertListEqual(transfer.lookback(c[0], 'catchup'), ['20190703', '20190701'])
+        self.assertListEqual(transfer.lookback(c[0], 'catchup'), ['20190703'])
+        self.assertListEqual(transfer.lookback(c[0], 'backup'), ['20190703', '20190702'])
+        mock_time.return_value = 100600.0
+        self.assertListEqual(transfer.lookback(c[0], 'catchup'), ['20190703', '20190702'])
+        self.assertListEqual(transfer.lookback(c[0], 'catchup'), ['20190703'])
+        mock_time.return_value = 101200.0
+        self.assertListEqual(transfer.lookback(c[0], 'catchup'), ['20190703', '20190702'])
+        self.assertListEqual(transfer.lookback(c[0], 'catchup'), ['20190703', '20190701'])
+        mock_yst.return_value = '20190301'
+        self.assertListEqual(transfer.lookback(c[0], 'catchup'), ['20190301', '20190228'])
+
+    @patch('time.time')
+    @patch('desitransfer.daemon._popen')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_links(self, mock_cl, mock_log, mock_popen, mock_time):
+        """Test full and incremental searches for links.
+        """
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        c = transfer.directories
+        full = ['/bin/ssh', '-q', 'dts', '/bin/find', c[0].source, '-type', 'l']
+        mock_time.return_value = 1000000.0
+        mock_popen.return_value = ('0', '20190703/00000126\n20190703/00000125\n', '')
+        self.assertEqual(transfer.links(c[0]), (['20190703/00000125', '20190703/00000126'], True))
+        mock_popen.assert_called_once_with(full, timeout=None)
+        #
+        # Enable incremental searches.
+        #
+        transfer.conf['common']['full_scan'] = '60'
+        mock_time.return_value = 1000000.0 + 5 * 60 + 10
+        mock_popen.return_value = ('0', '20190703/00000127\n', '')
+        self.assertEqual(transfer.links(c[0]), (['20190703/00000127'], False))
+        mock_popen.assert_called_with(['/bin/ssh', '-q', 'dts', '/bin/find', c[0].source,
+                                       '-mindepth', '2', '-maxdepth', '2', '-type', 'l', '-mmin', '-7'], timeout=None)
+        #
+        # A failed search does not advance the search window.
+        #
+        mock_time.return_value = 1000000.0 + 10 * 60 + 10
+        mock_popen.return_value = ('255', '', 'Connection refused')
+        self.assertEqual(transfer.links(c[0]), ([], False))
+        mock_log.warning.assert_called_once_with('Search for links in %s failed (status = %s), check connection.',
+                                                 c[0].source, '255')
+        mock_time.return_value = 1000000.0 + 15 * 60 + 10
+        mock_popen.return_value = ('0', '', '')
+        self.assertEqual(transfer.links(c[0]), ([], False))
+        mock_popen.assert_called_with(['/bin/ssh', '-q', 'dts', '/bin/find', c[0].source,
+                                       '-mindepth', '2', '-maxdepth', '2', '-type', 'l', '-mmin', '-12'], timeout=None)
+        #
+        # Time for another full search.
+        #
+        mock_time.return_value = 1000000.0 + 61 * 60
+        self.assertEqual(transfer.links(c[0]), ([], True))
+        mock_popen.assert_called_with(full, timeout=None)
+
+    @patch.object(TransferDaemon, 'backup_jobs')
+    @patch.object(TransferDaemon, 'exposure')
+    @patch.object(TransferDaemon, 'links')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_retry(self, mock_cl, mock_log, mock_links, mock_exposure, mock_jobs):
+        """Test that failed exposures are retried by incremental searches.
+        """
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        transfer.conf['common']['catchup'] = '30'
+        transfer.conf['common']['backup'] = '30'
+        c = transfer.directories[0]
+        status = MagicMock()
+        transfer._seen[c.source] = set(['20190703/00000126', '20190703/00000127'])
+        transfer.retry(c, '20190703/00000127')
+        self.assertEqual(transfer._seen[c.source], set(['20190703/00000126']))
+        mock_links.return_value = (['20190703/00000128'], False)
+        transfer.directory(c, status)
+        mock_exposure.assert_has_calls([call(c, '20190703/00000127', status),
+                                        call(c, '20190703/00000128', status)])
+        self.assertNotIn(c.source, transfer._retry)
+        #
+        # A failed search also retries the exposure.
+        #
+        mock_exposure.reset_mock()
+        transfer.retry(c, '20190703/00000127')
+        mock_links.return_value = ([], False)
+        transfer.directory(c, status)
+        mock_exposure.assert_called_once_with(c, '20190703/00000127', status)
+
+    @patch.object(TransferDaemon, 'install_exposure')
+    @patch.object(TransferDaemon, 'verify_exposure')
+    @patch.object(TransferDaemon, 'rsync_exposure')
+    @patch('desitransfer.daemon.TransferStatus')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_exposures(self, mock_cl, mock_log, mock_status, mock_rsync, mock_verify, mock_install):
+        """Test pipelined transfer of several exposures.
+        """
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        self.assertEqual(transfer.directories[0].workers, 1)
+        self.assertEqual(transfer.directories[0].verify_workers, 0)
+        c = transfer.directories[0]._replace(workers=3, verify_workers=2)
+        links = ['20190703/00000124', '20190703/00000125', '20190703/00000126', '20190703/00000127']
+        #
+        # 00000124 is already transferred, 00000126 crashes during rsync,
+        # 00000127 crashes during verification.
+        #
+        mock_rsync.side_effect = lambda d, link, status: {'20190703/00000124': False,
+                                                          '20190703/00000125': True,
+                                                          '20190703/00000127': True}[link]
+
+        def verify(d, link, status):
+            if link == '20190703/00000127':
+                raise Exception('Test Exception')
+
+        mock_verify.side_effect = verify
+        transfer.exposures(c, links, mock_status)
+        mock_rsync.assert_has_calls([call(c, link, mock_status) for link in links], any_order=True)
+        mock_verify.assert_has_calls([call(c, links[1], mock_status),
+                                      call(c, links[3], mock_status)], any_order=True)
+        self.assertEqual(mock_verify.call_count, 2)
+        mock_install.assert_called_once_with(c, links[1])
+        mock_log.debug.assert_has_calls([call("ThreadPoolExecutor(max_workers=%d)", 3),
+                                         call("ThreadPoolExecutor(max_workers=%d)", 2)])
+        self.assertEqual(mock_log.critical.call_count, 2)
 
     @patch('shutil.move')
     @patch('os.chmod')
@@ -279,9 +539,367 @@ desi_spectro_data_20190702.tar.idx
                 options = _options()
             transfer = TransferDaemon(options)
         c = transfer.directories
-        mock_isdir.return_value = True
+        transfer.index(c[0]).add_night('20190703', 'staging')
+        transfer.index(c[0]).add('20190703', '00000127', 'destination')
         transfer.exposure(c[0], '20190703/00000127', mock_status)
         mock_log.debug.assert_called_once_with('%s already transferred.', '/desi/root/spectro/staging/raw/20190703/00000127')
+        mock_isdir.assert_not_called()
+        mock_popen.assert_not_called()
+        self.assertIn('20190703/00000127', transfer._seen[c[0].source])
+
+    @patch('time.time')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_index(self, mock_cl, mock_log, mock_time):
+        """Test the index of exposures already present on disk.
+        """
+        staging = os.path.join(self.tmp.name, 'spectro', 'staging', 'raw')
+        destination = os.path.join(self.tmp.name, 'data')
+        os.makedirs(os.path.join(staging, '20190703', '00000127'))
+        os.makedirs(os.path.join(destination, '20190703', '00000126'))
+        os.makedirs(os.path.join(destination, '20190702', '00000125'))
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': self.tmp.name,
+                         'DESI_SPECTRO_DATA': destination}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        c = transfer.directories
+        mock_time.return_value = 1000000.0
+        i = transfer.index(c[0])
+        self.assertIs(transfer.index(c[0]), i)
+        self.assertTrue(i.has_night('20190703', 'staging'))
+        self.assertTrue(i.has_night('20190703', 'destination'))
+        self.assertFalse(i.has_night('20190702', 'staging'))
+        self.assertTrue(i.has_night('20190702', 'destination'))
+        self.assertFalse(i.has_night('20190704', 'destination'))
+        self.assertEqual(i.location('20190703', '00000127'), 'staging')
+        self.assertEqual(i.location('20190703', '00000126'), 'destination')
+        self.assertEqual(i.location('20190702', '00000125'), 'destination')
+        self.assertIsNone(i.location('20190703', '00000128'))
+        #
+        # Changes on disk are not seen until the index is reconciled.
+        #
+        os.makedirs(os.path.join(destination, '20190703', '00000128'))
+        self.assertIsNone(i.location('20190703', '00000128'))
+        i.add('20190703', '00000127', 'destination')
+        self.assertEqual(i.location('20190703', '00000127'), 'destination')
+        transfer.conf['common']['reconcile'] = '60'
+        transfer._seen[c[0].source] = set(['20190703/00000126'])
+        transfer._last_full_scan[c[0].source] = 1000000.0
+        mock_time.return_value = 1000000.0 + 3600.0
+        i2 = transfer.index(c[0])
+        self.assertIsNot(i2, i)
+        self.assertNotIn(c[0].source, transfer._seen)
+        self.assertNotIn(c[0].source, transfer._last_full_scan)
+        mock_log.info.assert_called_once_with('Reconciling exposure index for %s with disk.', destination)
+        self.assertEqual(i2.location('20190703', '00000128'), 'destination')
+        self.assertEqual(i2.location('20190703', '00000127'), 'staging')
+
+    @patch('os.path.isdir')
+    @patch('desitransfer.daemon._popen')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_rsync_exposure_retry(self, mock_cl, mock_log, mock_popen, mock_isdir):
+        """Test that an exposure is transferred again after rsync fails.
+        """
+        staging = os.path.join(self.tmp.name, 'spectro', 'staging', 'raw')
+        destination = os.path.join(self.tmp.name, 'data')
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': self.tmp.name,
+                         'DESI_SPECTRO_DATA': destination}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        c = transfer.directories
+        status = MagicMock()
+        mock_isdir.return_value = False
+        mock_popen.return_value = ('255', '', 'Connection refused')
+        self.assertTrue(transfer.rsync_exposure(c[0], '20190703/00000127', status))
+        self.assertIsNone(transfer.index(c[0]).location('20190703', '00000127'))
+        mock_isdir.assert_called_once_with(os.path.join(staging, '20190703', '00000127'))
+        mock_popen.return_value = ('0', '', '')
+        self.assertTrue(transfer.rsync_exposure(c[0], '20190703/00000127', status))
+        self.assertEqual(mock_popen.call_count, 2)
+        self.assertEqual(transfer.index(c[0]).location('20190703', '00000127'), 'staging')
+        status.update.assert_has_calls([call('20190703', '00000127', 'rsync', failure=True),
+                                        call('20190703', '00000127', 'rsync')])
+
+    @patch('desitransfer.daemon._sha256')
+    @patch('subprocess.Popen')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_bulk(self, mock_cl, mock_log, mock_popen, mock_sha):
+        """Test transferring an entire night as a tar stream.
+        """
+        staging = os.path.join(self.tmp.name, 'spectro', 'staging', 'raw')
+        destination = os.path.join(self.tmp.name, 'data')
+        os.makedirs(os.path.join(destination, '20190703', '00000126'))
+        stream = BytesIO()
+        with tarfile.open(fileobj=stream, mode='w') as tf:
+            files = {'00000127': b'abcdefghij' * 100, '00000128': b'0123456789' * 100}
+            for exposure in files:
+                info = tarfile.TarInfo('20190703/' + exposure)
+                info.type = tarfile.DIRTYPE
+                tf.addfile(info)
+                data = files[exposure]
+                checksum = '{0}  desi-{1}.fits.fz\n'.format(hashlib.sha256(data).hexdigest(), exposure).encode()
+                for name, content in (('desi-' + exposure + '.fits.fz', data),
+                                      ('checksum-' + exposure + '.sha256sum', checksum)):
+                    info = tarfile.TarInfo('20190703/' + exposure + '/' + name)
+                    info.size = len(content)
+                    info.mtime = 1562112000
+                    tf.addfile(info, BytesIO(content))
+        stream.seek(0)
+        mock_popen.return_value.stdout = stream
+        mock_popen.return_value.wait.return_value = 0
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': self.tmp.name,
+                         'DESI_SPECTRO_DATA': destination}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        c = transfer.directories[0]
+        mock_status = MagicMock()
+        self.assertTrue(transfer.bulk(c, '20190703', mock_status))
+        self.assertEqual(mock_popen.call_args[0][0],
+                         ['/bin/ssh', '-q', 'dts', '/bin/tar', '--create', '--dereference', '--file', '-',
+                          '--directory', c.source, '--exclude', '20190703/00000126', '20190703'])
+        mock_sha.assert_not_called()
+        mock_log.critical.assert_not_called()
+        mock_status.update.assert_has_calls([call('20190703', '00000127', 'rsync'),
+                                             call('20190703', '00000127', 'checksum'),
+                                             call('20190703', '00000128', 'rsync'),
+                                             call('20190703', '00000128', 'checksum')])
+        f = os.path.join(destination, '20190703', '00000128', 'desi-00000128.fits.fz')
+        with open(f, 'rb') as ff:
+            self.assertEqual(ff.read(), files['00000128'])
+        self.assertEqual(os.stat(f).st_mtime, 1562112000)
+        self.assertEqual(transfer.index(c).exposures('20190703', 'destination'),
+                         ['00000126', '00000127', '00000128'])
+        self.assertEqual(os.listdir(os.path.join(staging, '20190703')), [])
+        #
+        # Failure of the remote tar command.
+        #
+        mock_popen.return_value.stdout = BytesIO()
+        mock_popen.return_value.wait.return_value = 2
+        self.assertFalse(transfer.bulk(c, '20190704', mock_status))
+        mock_log.critical.assert_any_call('tar problem (status = %d) detected on bulk transfer of %s, check logs!',
+                                          2, '20190704')
+
+    @patch('os.makedirs')
+    @patch('desitransfer.daemon._popen_many')
+    @patch('desitransfer.daemon._popen')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_rsync_streams(self, mock_cl, mock_log, mock_popen, mock_many, mock_mkdir):
+        """Test transferring one exposure with several rsync commands.
+        """
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        c = transfer.directories[0]._replace(streams=2)
+        cmd = ['/bin/rsync', '--verbose', '--recursive', '--copy-dirlinks', '--times', '--omit-dir-times',
+               'dts:/data/dts/exposures/raw/20190703/00000127/', '/desi/root/spectro/staging/raw/20190703/00000127/']
+        lists = list()
+
+        def fake_many(commands, timeout=None):
+            for cc in commands:
+                with open(cc[cc.index('--files-from') + 1]) as f:
+                    lists.append(f.read())
+            return [('0', 'a\n', ''), ('23', 'b\n', 'error\n')]
+
+        mock_popen.return_value = ('0', '100 desi-00000127.fits.fz\n10 guide-00000127.fits.fz\n' +
+                                   '60 checksum-00000127.sha256sum\n30 request-00000127.json\n', '')
+        mock_many.side_effect = fake_many
+        r = transfer.rsync_streams(c, '20190703', '00000127', cmd)
+        self.assertEqual(r, ('23', 'a\nb\n', 'error\n'))
+        mock_mkdir.assert_called_once_with('/desi/root/spectro/staging/raw/20190703/00000127', exist_ok=True)
+        mock_popen.assert_called_once_with(['/bin/ssh', '-q', 'dts', '/bin/find', '-L',
+                                            '/data/dts/exposures/raw/20190703/00000127',
+                                            '-type', 'f', '-printf', "'%s %P\\n'"], timeout=None)
+        self.assertListEqual(lists, ['desi-00000127.fits.fz\n',
+                                     'checksum-00000127.sha256sum\nguide-00000127.fits.fz\nrequest-00000127.json\n'])
+        files_from = os.path.join(self.tmp.name, 'files_from__desi_root_spectro_data_20190703_00000127_0.txt')
+        self.assertEqual(mock_many.call_args[0][0][0][6:8], ['--files-from', files_from])
+        self.assertEqual([f for f in os.listdir(self.tmp.name) if f.startswith('files_from')], [])
+        #
+        # Fall back to a single command if the listing fails.
+        #
+        mock_popen.reset_mock()
+        mock_popen.side_effect = [('255', '', 'Connection refused'), ('0', '', '')]
+        r = transfer.rsync_streams(c, '20190703', '00000127', cmd)
+        self.assertEqual(r, ('0', '', ''))
+        mock_popen.assert_called_with(cmd, timeout=None)
+        self.assertEqual(mock_many.call_count, 1)
+
+    def test_balance(self):
+        """Test dividing files into groups of similar size.
+        """
+        self.assertEqual(_balance([], 4), [])
+        self.assertEqual(_balance([(5, 'a')], 4), [['a']])
+        self.assertEqual(_balance([(5, 'a'), (4, 'b'), (3, 'c'), (3, 'd'), (2, 'e')], 2),
+                         [['a', 'c'], ['b', 'd', 'e']])
+
+    def test_untar(self):
+        """Test unpacking a tar stream.
+        """
+        stream = BytesIO()
+        with tarfile.open(fileobj=stream, mode='w') as tf:
+            for name in ('20190703/00000127/foo.txt', '20190703/../evil.txt', '20190704/bar.txt'):
+                info = tarfile.TarInfo(name)
+                info.size = 3
+                tf.addfile(info, BytesIO(b'foo'))
+        stream.seek(0)
+        with patch('desitransfer.daemon.log') as mock_log:
+            hashes = _untar(stream, self.tmp.name, '20190703')
+        f = os.path.join(self.tmp.name, '20190703', '00000127', 'foo.txt')
+        self.assertEqual(hashes, {f: hashlib.sha256(b'foo').hexdigest()})
+        mock_log.warning.assert_has_calls([call("Skipping unexpected file %s in tar stream.", '20190703/../evil.txt'),
+                                           call("Skipping unexpected file %s in tar stream.", '20190704/bar.txt')])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'evil.txt')))
+
+    @patch('desitransfer.daemon._popen')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_journal(self, mock_cl, mock_log, mock_popen):
+        """Test resuming transfers after a crash.
+        """
+        staging = os.path.join(self.tmp.name, 'spectro', 'staging', 'raw')
+        destination = os.path.join(self.tmp.name, 'data')
+        os.makedirs(os.path.join(staging, '20190703', '00000127'))
+        os.makedirs(os.path.join(staging, '20190703', '00000128'))
+        os.makedirs(os.path.join(destination, '20190703', '00000126'))
+        j = TransferJournal(staging + '.journal')
+        j.record('20190703', '00000126', 'staged')
+        j.record('20190703', '00000127', 'rsync')
+        j.record('20190703', '00000128', 'staged')
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': self.tmp.name,
+                         'DESI_SPECTRO_DATA': destination}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        c = transfer.directories[0]
+        self.assertIsNone(transfer.journal(c))
+        transfer.conf['common']['journal'] = 'true'
+        journal = transfer.journal(c)
+        self.assertIs(transfer.journal(c), journal)
+        mock_popen.return_value = ('0', '', '')
+        mock_status = MagicMock()
+        self.assertTrue(transfer.rsync_exposure(c, '20190703/00000127', mock_status))
+        mock_log.info.assert_called_once_with('Resuming interrupted transfer of %s/%s.', '20190703', '00000127')
+        mock_popen.assert_called_once_with(['/bin/rsync', '--verbose', '--recursive',
+                                            '--copy-dirlinks', '--times', '--omit-dir-times', '--partial',
+                                            'dts:/data/dts/exposures/raw/20190703/00000127/',
+                                            os.path.join(staging, '20190703', '00000127') + '/'], timeout=None)
+        self.assertEqual(journal.stage('20190703', '00000127'), 'staged')
+        mock_popen.reset_mock()
+        mock_log.info.reset_mock()
+        self.assertTrue(transfer.rsync_exposure(c, '20190703/00000128', mock_status))
+        mock_log.info.assert_called_once_with('Resuming verification of %s/%s.', '20190703', '00000128')
+        mock_popen.assert_not_called()
+        self.assertFalse(transfer.rsync_exposure(c, '20190703/00000126', mock_status))
+        self.assertIsNone(journal.stage('20190703', '00000126'))
+        with patch('shutil.move') as mock_move:
+            transfer.install_exposure(c, '20190703/00000128')
+        mock_move.assert_called_once_with(os.path.join(staging, '20190703', '00000128'),
+                                          os.path.join(destination, '20190703'))
+        self.assertIsNone(journal.stage('20190703', '00000128'))
+        #
+        # Compacting drops installed exposures, and is skipped if nothing was added.
+        #
+        journal.compact()
+        with open(journal.filename) as f:
+            self.assertEqual(f.read(), '{"exposure": "20190703/00000127", "stage": "staged"}\n')
+        with patch('os.replace') as mock_replace:
+            journal.compact()
+        mock_replace.assert_not_called()
+        #
+        # Reloading compacts the journal.
+        #
+        with open(journal.filename, 'a') as f:
+            f.write('{"exposure": "20190703/0000')
+        j2 = TransferJournal(journal.filename)
+        self.assertEqual(j2.stage('20190703', '00000127'), 'staged')
+        self.assertIsNone(j2.stage('20190703', '00000128'))
+        with open(journal.filename) as f:
+            self.assertEqual(f.read(), '{"exposure": "20190703/00000127", "stage": "staged"}\n')
+
+    @patch('desitransfer.daemon._popen')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_rsync_exposures(self, mock_cl, mock_log, mock_popen):
+        """Test batched transfer of several exposures.
+        """
+        staging = os.path.join(self.tmp.name, 'spectro', 'staging', 'raw')
+        destination = os.path.join(self.tmp.name, 'data')
+        os.makedirs(os.path.join(staging, '20190703', '00000127'))
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': self.tmp.name,
+                         'DESI_SPECTRO_DATA': destination}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        c = transfer.directories[0]._replace(batch=2)
+        batches = list()
+
+        def fake_popen(cmd, timeout=None):
+            if '--files-from' in cmd:
+                with open(cmd[cmd.index('--files-from') + 1]) as f:
+                    batches.append((cmd[-2], f.read()))
+                if '00000130' in batches[-1][1]:
+                    return ('23', '', 'some files could not be transferred')
+            return ('0', '', '')
+
+        mock_popen.side_effect = fake_popen
+        mock_status = MagicMock()
+        links = ['20190703/00000127', '20190703/00000128', '20190703/00000129',
+                 '20190703/00000130', '20190704/00000001']
+        transferred = transfer.rsync_exposures(c, links, mock_status)
+        self.assertListEqual(transferred, links[1:])
+        self.assertListEqual(batches, [('dts:/data/dts/exposures/raw/20190703/', '00000128\n00000129\n'),
+                                       ('dts:/data/dts/exposures/raw/20190703/', '00000130\n'),
+                                       ('dts:/data/dts/exposures/raw/20190704/', '00000001\n')])
+        self.assertEqual([f for f in os.listdir(self.tmp.name) if f.startswith('files_from')], [])
+        self.assertTrue(os.path.isdir(os.path.join(staging, '20190704')))
+        self.assertTrue(os.path.isdir(os.path.join(destination, '20190704')))
+        mock_log.warning.assert_called_once_with('rsync problem (status = %s) detected for %d exposures in %s; ' +
+                                                 'transferring them individually.', '23', 1, '20190703')
+        mock_popen.assert_any_call(['/bin/rsync', '--verbose', '--recursive',
+                                    '--copy-dirlinks', '--times', '--omit-dir-times',
+                                    'dts:/data/dts/exposures/raw/20190703/00000130/',
+                                    os.path.join(staging, '20190703', '00000130') + '/'], timeout=None)
+        mock_status.update.assert_has_calls([call('20190703', '00000128', 'rsync'),
+                                             call('20190703', '00000129', 'rsync'),
+                                             call('20190703', '00000130', 'rsync'),
+                                             call('20190704', '00000001', 'rsync')])
+        self.assertIn('20190703/00000127', transfer._seen[c.source])
+        i = transfer.index(c)
+        self.assertEqual(i.location('20190703', '00000129'), 'staging')
+        #
+        # Verification and installation follow the transfer.
+        #
+        with patch.object(transfer, 'rsync_exposures') as mock_rsync, \
+                patch.object(transfer, 'verify_exposure') as mock_verify, \
+                patch.object(transfer, 'install_exposure') as mock_install:
+            mock_rsync.return_value = links[1:3]
+            transfer.batch_exposures(c, links, mock_status)
+            mock_verify.assert_has_calls([call(c, links[1], mock_status), call(c, links[2], mock_status)])
+            mock_install.assert_has_calls([call(c, links[1]), call(c, links[2])])
+            mock_install.reset_mock()
+            transfer.batch_exposures(c._replace(verify_workers=2), links, mock_status)
+            mock_install.assert_has_calls([call(c._replace(verify_workers=2), links[1]),
+                                           call(c._replace(verify_workers=2), links[2])])
 
     @patch('shutil.move')
     @patch('os.chmod')
@@ -329,7 +947,7 @@ desi_spectro_data_20190702.tar.idx
         mock_popen.assert_called_once_with(['/bin/rsync', '--verbose', '--recursive',
                                             '--copy-dirlinks', '--times', '--omit-dir-times',
                                             'dts:/data/dts/exposures/raw/20190703/00000127/',
-                                            '/desi/root/spectro/staging/raw/20190703/00000127/'])
+                                            '/desi/root/spectro/staging/raw/20190703/00000127/'], timeout=None)
         mock_lock.assert_called_once_with('/desi/root/spectro/staging/raw/20190703/00000127', False)
         mock_exists.assert_has_calls([call('/desi/root/spectro/staging/raw/20190703/00000127/checksum-00000127.sha256sum')])
         mock_cksum.assert_called_once_with('/desi/root/spectro/staging/raw/20190703/00000127/checksum-00000127.sha256sum')
@@ -481,7 +1099,7 @@ desi_spectro_data_20190702.tar.idx
         mock_popen.assert_called_once_with(['/bin/rsync', '--verbose', '--recursive',
                                             '--copy-dirlinks', '--times', '--omit-dir-times',
                                             'dts:/data/dts/exposures/raw/20190703/00000127/',
-                                            '/desi/root/spectro/staging/raw/20190703/00000127/'])
+                                            '/desi/root/spectro/staging/raw/20190703/00000127/'], timeout=None)
         mock_lock.assert_called_once_with('/desi/root/spectro/staging/raw/20190703/00000127', False)
         mock_exists.assert_has_calls([call('/desi/root/spectro/staging/raw/20190703/00000127/checksum-00000127.sha256sum')])
         # mock_cksum.assert_called_once_with('/desi/root/spectro/staging/raw/20190703/00000127/checksum-00000127.sha256sum')
@@ -536,7 +1154,7 @@ desi_spectro_data_20190702.tar.idx
         mock_popen.assert_called_once_with(['/bin/rsync', '--verbose', '--recursive',
                                             '--copy-dirlinks', '--times', '--omit-dir-times',
                                             'dts:/data/dts/exposures/raw/20190703/00000127/',
-                                            '/desi/root/spectro/staging/raw/20190703/00000127/'])
+                                            '/desi/root/spectro/staging/raw/20190703/00000127/'], timeout=None)
         mock_lock.assert_called_once_with('/desi/root/spectro/staging/raw/20190703/00000127', False)
         mock_exists.assert_has_calls([call('/desi/root/spectro/staging/raw/20190703/00000127/checksum-00000127.sha256sum')])
         # mock_cksum.assert_called_once_with('/desi/root/spectro/staging/raw/20190703/00000127/checksum-00000127.sha256sum')
@@ -682,7 +1300,7 @@ total size is 118,417,836,324  speedup is 494,367.55
         mock_exists.return_value = False
         mock_popen.return_value = ('0', r0, '')
         transfer.catchup(c[0], '20190703', mock_status)
-        mock_rsync.assert_called_once_with('/data/dts/exposures/raw', '/desi/root/spectro/data', '20190703', False)
+        mock_rsync.assert_called_once_with('/data/dts/exposures/raw', '/desi/root/spectro/data', '20190703', False, None, None, None)
         mock_log.warning.assert_has_calls([call('New files detected in %s!', '20190703'),
                                            call('No updated exposures in night %s detected.', '20190703')])
         mock_status.assert_not_called()
@@ -717,7 +1335,7 @@ total size is 118,417,836,324  speedup is 494,367.55
         mock_exists.return_value = False
         mock_popen.return_value = ('0', r1, '')
         transfer.catchup(c[0], '20190703', mock_status)
-        mock_rsync.assert_called_once_with('/data/dts/exposures/raw', '/desi/root/spectro/data', '20190703', False)
+        mock_rsync.assert_called_once_with('/data/dts/exposures/raw', '/desi/root/spectro/data', '20190703', False, None, None, None)
         mock_log.warning.assert_called_once_with('New files detected in %s!', '20190703')
         mock_log.critical.assert_has_calls([call("No checksum file for %s/%s!", '20190703', '00001234'),
                                            call("No checksum file for %s/%s!", '20190703', '00001235')], any_order=True)
@@ -727,10 +1345,168 @@ total size is 118,417,836,324  speedup is 494,367.55
                                          call("status.update('%s', '%s', 'checksum', failure=True)", '20190703', '00001235')], any_order=True)
         mock_status.update.assert_has_calls([call('20190703', '00001234', 'checksum', failure=True),
                                              call('20190703', '00001235', 'checksum', failure=True)], any_order=True)
+        #
+        # Restrict locking to the exposures that changed.
+        #
+        transfer.conf['common']['catchup_touched'] = 'true'
+        mock_rsync.reset_mock()
+        transfer.catchup(c[0], '20190703', mock_status)
+        mock_rsync.assert_called_once_with('/data/dts/exposures/raw', '/desi/root/spectro/data', '20190703', False, None, None,
+                                           {'00001234', '00001235'})
+
+    @patch('desitransfer.daemon._manifest')
+    @patch.object(TransferDaemon, 'checksum')
+    @patch('desitransfer.daemon.rsync_night')
+    @patch('desitransfer.daemon._popen')
+    @patch('os.path.exists')
+    @patch('os.path.isdir')
+    @patch('desitransfer.daemon.TransferStatus')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_catchup_manifest(self, mock_cl, mock_log, mock_status, mock_isdir, mock_exists,
+                                             mock_popen, mock_rsync, mock_checksum, mock_manifest):
+        """Test morning catch-up pass using a remote manifest.
+        """
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        transfer.conf['common']['manifest'] = 'true'
+        c = transfer.directories
+        mock_isdir.return_value = True
+        mock_exists.return_value = False
+        mock_manifest.return_value = {'00001234': [2, 15, 1562000100], '00001235': [3, 20, 1562000200]}
+        mock_popen.return_value = ('0', '00001234 2 15 1562000100\n00001235 4 25 1562000300\n. 1 3 1562000000\n' +
+                                   'logs 1 5 1562000400\n', '')
+        mock_rsync.return_value = True
+        transfer.catchup(c[0], '20190703', mock_status)
+        cmd = mock_popen.call_args[0][0]
+        self.assertListEqual(cmd[:3], ['/bin/ssh', '-q', 'dts'])
+        self.assertIn('/data/dts/exposures/raw/20190703', cmd)
+        mock_manifest.assert_called_once_with('/desi/root/spectro/data/20190703')
+        mock_rsync.assert_called_once_with('/data/dts/exposures/raw', '/desi/root/spectro/data', '20190703', False, None, None,
+                                           {'00001235', 'logs'}, restrict=True)
+        mock_checksum.assert_called_once_with('/desi/root/spectro/data/20190703/00001235/checksum-00001235.sha256sum',
+                                              mock_status, None)
+        manifest_file = os.path.join(self.tmp.name, 'manifest__desi_root_spectro_data_20190703.json')
+        with open(manifest_file) as j:
+            self.assertDictEqual(json.load(j), {'00001234': [2, 15, 1562000100], '00001235': [4, 25, 1562000300],
+                                                '.': [1, 3, 1562000000], 'logs': [1, 5, 1562000400]})
+        with open(os.path.join(self.tmp.name, 'ketchup__desi_root_spectro_data_20190703.txt')) as k:
+            self.assertEqual(k.read(), '. 1 3 1562000000\n00001235 4 25 1562000300\nlogs 1 5 1562000400\n')
+        #
+        # The saved manifest is used next time.
+        #
+        mock_manifest.reset_mock()
+        mock_rsync.reset_mock()
+        transfer.catchup(c[0], '20190703', mock_status, backup=True)
+        mock_manifest.assert_not_called()
+        mock_rsync.assert_not_called()
+        mock_log.info.assert_called_with('No files appear to have changed in %s.', '20190703')
+        #
+        # Fall back to rsync if the remote command fails.
+        #
+        mock_popen.side_effect = [('255', '', 'ssh: connection refused'), ('0', '', '')]
+        transfer.catchup(c[0], '20190704', mock_status)
+        mock_log.warning.assert_any_call('Could not obtain manifest of %s/%s (status = %s); ' +
+                                         'falling back to rsync.', '/data/dts/exposures/raw', '20190704', '255')
+        self.assertEqual(mock_popen.call_args[0][0][0], '/bin/rsync')
+
+    @patch.object(TransferDaemon, 'checksum')
+    @patch('desitransfer.daemon.rsync_night')
+    @patch('desitransfer.daemon._popen')
+    @patch('os.path.exists')
+    @patch('os.path.isdir')
+    @patch('desitransfer.daemon.TransferStatus')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_catchup_itemize(self, mock_cl, mock_log, mock_status, mock_isdir, mock_exists,
+                                            mock_popen, mock_rsync, mock_checksum):
+        """Test morning catch-up pass with itemized rsync output.
+        """
+        r1 = """receiving incremental file list
+>f+++++++++             10 00001234/bar.txt
+.f...p.....             20 00001235/foo.txt
+>f+++++++++             30 README.txt
+
+sent 765 bytes  received 238,769 bytes  159,689.33 bytes/sec
+total size is 118,417,836,324  speedup is 494,367.55
+"""
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        transfer.conf['common']['itemize'] = 'true'
+        transfer.conf['common']['catchup_touched'] = 'true'
+        c = transfer.directories
+        mock_isdir.return_value = True
+        mock_exists.return_value = False
+        mock_popen.return_value = ('0', r1, '')
+        transfer.catchup(c[0], '20190703', mock_status)
+        self.assertIn('--out-format=%i %l %n', mock_popen.call_args[0][0])
+        mock_rsync.assert_called_once_with('/data/dts/exposures/raw', '/desi/root/spectro/data', '20190703', False, None, None,
+                                           {'00001234', '00001235'})
+        mock_checksum.assert_called_once_with('/desi/root/spectro/data/20190703/00001234/checksum-00001234.sha256sum',
+                                              mock_status, None)
+
+    @patch.object(TransferDaemon, 'checksum')
+    @patch('desitransfer.daemon.rsync_night')
+    @patch('desitransfer.daemon._popen')
+    @patch('os.path.exists')
+    @patch('os.path.isdir')
+    @patch('desitransfer.daemon.TransferStatus')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_background_catchup(self, mock_cl, mock_log, mock_status, mock_isdir, mock_exists,
+                                               mock_popen, mock_rsync, mock_checksum):
+        """Test catch-up transfer running in the background.
+        """
+        r1 = """receiving incremental file list
+00001234/bar.txt
+
+sent 765 bytes  received 238,769 bytes  159,689.33 bytes/sec
+total size is 118,417,836,324  speedup is 494,367.55
+"""
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        transfer.conf['common']['catchup_workers'] = '2'
+        c = transfer.directories
+        mock_isdir.return_value = True
+        mock_exists.return_value = False
+        mock_popen.return_value = ('0', r1, '')
+        #
+        # Block the background catch-up until the test is ready.
+        #
+        lock = transfer.night_lock(c[0], '20190703')
+        lock.acquire()
+        self.assertTrue(transfer.background_catchup(c[0], '20190703', mock_status))
+        self.assertTrue(transfer.catchup_running(c[0], '20190703'))
+        self.assertFalse(transfer.background_catchup(c[0], '20190703', mock_status))
+        self.assertFalse(transfer.backup(c[0], '20190703', mock_status))
+        mock_log.debug.assert_has_calls([call("Catch-up transfer of %s is still running.", '20190703'),
+                                         call("Catch-up transfer of %s is still running.", '20190703')])
+        lock.release()
+        transfer._catchups[(c[0].destination, '20190703')].result()
+        transfer._background.shutdown(wait=True)
+        self.assertFalse(transfer.catchup_running(c[0], '20190703'))
+        mock_rsync.assert_called_once_with('/data/dts/exposures/raw', '/desi/root/spectro/data', '20190703', False, None, None, None)
+        mock_log.debug.assert_has_calls([call("Queuing checksum verification of %s/%s.", '20190703', '00001234')])
+        mock_checksum.assert_called_once_with('/desi/root/spectro/data/20190703/00001234/checksum-00001234.sha256sum',
+                                              mock_status, None)
+        mock_log.critical.assert_not_called()
 
     @patch('desitransfer.daemon.rsync_night')
-    @patch('os.chdir')
-    @patch('os.getcwd')
     @patch('desitransfer.daemon.empty_rsync')
     @patch('desitransfer.daemon._popen')
     @patch('os.remove')
@@ -738,7 +1514,7 @@ total size is 118,417,836,324  speedup is 494,367.55
     @patch('desitransfer.daemon.TransferStatus')
     @patch('desitransfer.daemon.log')
     @patch.object(TransferDaemon, '_configure_log')
-    def test_TransferDaemon_backup_no_data(self, mock_cl, mock_log, mock_status, mock_isdir, mock_rm, mock_popen, mock_empty, mock_getcwd, mock_chdir, mock_rsync):
+    def test_TransferDaemon_backup_no_data(self, mock_cl, mock_log, mock_status, mock_isdir, mock_rm, mock_popen, mock_empty, mock_rsync):
         """Test HPSS backup with no data for the night.
         """
         with patch.dict('os.environ',
@@ -758,8 +1534,6 @@ total size is 118,417,836,324  speedup is 494,367.55
         mock_status.update.assert_not_called()
 
     @patch('desitransfer.daemon.rsync_night')
-    @patch('os.chdir')
-    @patch('os.getcwd')
     @patch('desitransfer.daemon.empty_rsync')
     @patch('desitransfer.daemon._popen')
     @patch('os.remove')
@@ -767,7 +1541,7 @@ total size is 118,417,836,324  speedup is 494,367.55
     @patch('desitransfer.daemon.TransferStatus')
     @patch('desitransfer.daemon.log')
     @patch.object(TransferDaemon, '_configure_log')
-    def test_TransferDaemon_backup_already_done(self, mock_cl, mock_log, mock_status, mock_isdir, mock_rm, mock_popen, mock_empty, mock_getcwd, mock_chdir, mock_rsync):
+    def test_TransferDaemon_backup_already_done(self, mock_cl, mock_log, mock_status, mock_isdir, mock_rm, mock_popen, mock_empty, mock_rsync):
         """Test HPSS backup with night already done.
         """
         with patch.dict('os.environ',
@@ -792,10 +1566,79 @@ total size is 118,417,836,324  speedup is 494,367.55
         mock_rm.assert_called_once_with(ls_file)
         mock_status.assert_not_called()
         mock_status.update.assert_not_called()
+        #
+        # The backup finished while the daemon was not running, so it is recorded now.
+        #
+        transfer.tape = True
+        mock_status.status = {'20190703': {'12345678': [[0, 1, 1565300090000]]}}
+        mock_status.find.return_value = {'12345678': []}
+        self.assertFalse(transfer.backup(c[0], '20190703', mock_status))
+        mock_status.find.assert_called_once_with('20190703', stage='backup')
+        mock_status.update.assert_called_once_with('20190703', 'all', 'backup')
+        mock_status.update.reset_mock()
+        mock_status.find.return_value = {'12345678': [0]}
+        self.assertFalse(transfer.backup(c[0], '20190703', mock_status))
+        mock_status.update.assert_not_called()
+
+    @patch('time.time')
+    @patch('desitransfer.daemon._popen')
+    @patch('os.remove')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_hpss_backups(self, mock_cl, mock_log, mock_rm, mock_popen, mock_time):
+        """Test caching of HPSS listings.
+        """
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug', '--test']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        c = transfer.directories
+        mock_popen.return_value = ('0', '', '')
+        mock_time.return_value = 100000.0
+        ls_file = os.path.join(self.tmp.name, 'desi_spectro_data.test.txt')
+        with open(ls_file, 'w') as f:
+            f.write(self.fake_hsi1 + 'desi_spectro_data_20190702.tar\n')
+        #
+        # Without a cache, HPSS is listed every time.
+        #
+        self.assertEqual(transfer.hpss_backups(c[0]), {'desi_spectro_data_20190703.tar'})
+        self.assertEqual(transfer.hpss_backups(c[0]), {'desi_spectro_data_20190703.tar'})
+        self.assertEqual(mock_popen.call_count, 2)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'hpss_desi_spectro_data.test.json')))
+        #
+        # With a cache.
+        #
+        mock_popen.reset_mock()
+        transfer.conf['common']['hpss_cache'] = '60'
+        self.assertIn('desi_spectro_data_20190703.tar', transfer.hpss_backups(c[0], 'desi_spectro_data_20190703.tar'))
+        self.assertIn('desi_spectro_data_20190703.tar', transfer.hpss_backups(c[0], 'desi_spectro_data_20190703.tar'))
+        self.assertEqual(mock_popen.call_count, 1)
+        self.assertNotIn('desi_spectro_data_20190702.tar', transfer.hpss_backups(c[0], 'desi_spectro_data_20190702.tar'))
+        self.assertEqual(mock_popen.call_count, 2)
+        transfer.hpss_complete(c[0], '20190702')
+        self.assertIn('desi_spectro_data_20190702.tar', transfer.hpss_backups(c[0], 'desi_spectro_data_20190702.tar'))
+        self.assertEqual(mock_popen.call_count, 2)
+        #
+        # The cache persists.
+        #
+        with open(os.path.join(self.tmp.name, 'hpss_desi_spectro_data.test.json')) as j:
+            self.assertDictEqual(json.load(j), {'listed': 100000.0,
+                                                'complete': ['desi_spectro_data_20190702.tar',
+                                                             'desi_spectro_data_20190703.tar']})
+        transfer._hpss = dict()
+        self.assertEqual(len(transfer.hpss_backups(c[0], 'desi_spectro_data_20190702.tar')), 2)
+        self.assertEqual(mock_popen.call_count, 2)
+        #
+        # The cache expires.
+        #
+        mock_time.return_value = 100000.0 + 3600
+        self.assertEqual(transfer.hpss_backups(c[0]), {'desi_spectro_data_20190703.tar'})
+        self.assertEqual(mock_popen.call_count, 3)
 
     @patch('desitransfer.daemon.rsync_night')
-    @patch('os.chdir')
-    @patch('os.getcwd')
     @patch('desitransfer.daemon.empty_rsync')
     @patch('desitransfer.daemon._popen')
     @patch('os.remove')
@@ -803,7 +1646,7 @@ total size is 118,417,836,324  speedup is 494,367.55
     @patch('desitransfer.daemon.TransferStatus')
     @patch('desitransfer.daemon.log')
     @patch.object(TransferDaemon, '_configure_log')
-    def test_TransferDaemon_backup_test(self, mock_cl, mock_log, mock_status, mock_isdir, mock_rm, mock_popen, mock_empty, mock_getcwd, mock_chdir, mock_rsync):
+    def test_TransferDaemon_backup_test(self, mock_cl, mock_log, mock_status, mock_isdir, mock_rm, mock_popen, mock_empty, mock_rsync):
         """Test HPSS backup of night in 'test' mode.
         """
         with patch.dict('os.environ',
@@ -823,31 +1666,24 @@ total size is 118,417,836,324  speedup is 494,367.55
         with open(ls_file, 'w') as f:
             f.write(self.fake_hsi2)
         mock_empty.return_value = True
-        mock_getcwd.return_value = self.tmp.name
         mock_rm.side_effect = FileNotFoundError
         s = transfer.backup(c[0], '20190703', mock_status)
         self.assertTrue(s)
         hsi = os.path.join(transfer.conf['common']['hpss'], 'hsi')
         htar = os.path.join(transfer.conf['common']['hpss'], 'htar')
-        mock_chdir.assert_has_calls([call('/desi/root/spectro/data'),
-                                     call(self.tmp.name)])
         mock_log.info.assert_has_calls([call('No files appear to have changed in %s.', '20190703')])
         mock_log.debug.assert_has_calls([call("os.remove('%s')", ls_file),
                                          call("Failed to remove %s because it didn't exist. That's OK.", ls_file),
                                          call("%s -O %s ls -l desi/spectro/data" % (hsi, ls_file)),
                                          call('/bin/rsync --dry-run --verbose --recursive --copy-dirlinks --times --omit-dir-times ' +
                                               'dts:/data/dts/exposures/raw/20190703/ /desi/root/spectro/data/20190703/'),
-                                         call("os.chdir('%s')", '/desi/root/spectro/data'),
-                                         call('%s -cvhf desi/spectro/data/desi_spectro_data_20190703.tar -H crc:verify=all 20190703' % htar),
-                                         call("os.chdir('%s')", self.tmp.name)])
+                                         call('%s -cvhf desi/spectro/data/desi_spectro_data_20190703.tar -H crc:verify=all 20190703' % htar)])
         mock_status.assert_not_called()
         mock_status.update.assert_not_called()
 
     @patch('os.walk')
     @patch('os.chmod')
     @patch('desitransfer.daemon.rsync_night')
-    @patch('os.chdir')
-    @patch('os.getcwd')
     @patch('desitransfer.daemon.empty_rsync')
     @patch('desitransfer.daemon._popen')
     @patch('os.remove')
@@ -855,7 +1691,7 @@ total size is 118,417,836,324  speedup is 494,367.55
     @patch('desitransfer.daemon.TransferStatus')
     @patch('desitransfer.daemon.log')
     @patch.object(TransferDaemon, '_configure_log')
-    def test_TransferDaemon_backup_no_test(self, mock_cl, mock_log, mock_status, mock_isdir, mock_rm, mock_popen, mock_empty, mock_getcwd, mock_chdir, mock_rsync, mock_chmod, mock_walk):
+    def test_TransferDaemon_backup_no_test(self, mock_cl, mock_log, mock_status, mock_isdir, mock_rm, mock_popen, mock_empty, mock_rsync, mock_chmod, mock_walk):
         """Test HPSS backup of night in 'real' mode.
         """
         with patch.dict('os.environ',
@@ -872,7 +1708,6 @@ total size is 118,417,836,324  speedup is 494,367.55
                                   ('/desi/root/spectro/data/20190703/00001235', [], ['f2'])]
         mock_empty.return_value = True
         mock_popen.return_value = ('0', '', '')
-        mock_getcwd.return_value = 'HOME'
         ls_file = os.path.join(self.tmp.name, 'desi_spectro_data.txt')
         with open(ls_file, 'w') as f:
             f.write(self.fake_hsi2)
@@ -888,18 +1723,15 @@ total size is 118,417,836,324  speedup is 494,367.55
                                          call("os.chmod('%s', 0o%o)", '/desi/root/spectro/data/20190703', 0o2550),
                                          call("os.chmod('%s', 0o%o)", '/desi/root/spectro/data/20190703/00001234', 0o2550),
                                          call("os.chmod('%s', 0o%o)", '/desi/root/spectro/data/20190703/00001235', 0o2550),
-                                         call("os.chdir('%s')", '/desi/root/spectro/data'),
-                                         call('%s -cvhf desi/spectro/data/desi_spectro_data_20190703.tar -H crc:verify=all 20190703' % htar),
-                                         call("os.chdir('%s')", 'HOME')])
-        mock_popen.assert_has_calls([call([htar, '-cvhf', 'desi/spectro/data/desi_spectro_data_20190703.tar', '-H', 'crc:verify=all', '20190703'])])
+                                         call('%s -cvhf desi/spectro/data/desi_spectro_data_20190703.tar -H crc:verify=all 20190703' % htar)])
+        mock_popen.assert_has_calls([call([htar, '-cvhf', 'desi/spectro/data/desi_spectro_data_20190703.tar', '-H', 'crc:verify=all', '20190703'],
+                                          cwd='/desi/root/spectro/data')])
         mock_status.assert_not_called()
         mock_status.update.assert_not_called()
 
     @patch('os.walk')
     @patch('os.chmod')
     @patch('desitransfer.daemon.rsync_night')
-    @patch('os.chdir')
-    @patch('os.getcwd')
     @patch('desitransfer.daemon.empty_rsync')
     @patch('desitransfer.daemon._popen')
     @patch('os.remove')
@@ -909,8 +1741,7 @@ total size is 118,417,836,324  speedup is 494,367.55
     @patch.object(TransferDaemon, '_configure_log')
     def test_TransferDaemon_backup_htar_failure(self, mock_cl, mock_log,
                                                 mock_status, mock_isdir, mock_rm,
-                                                mock_popen, mock_empty, mock_getcwd,
-                                                mock_chdir, mock_rsync, mock_chmod,
+                                                mock_popen, mock_empty, mock_rsync, mock_chmod,
                                                 mock_walk):
         """Test HPSS backup of night with htar failure.
         """
@@ -930,7 +1761,6 @@ total size is 118,417,836,324  speedup is 494,367.55
         mock_popen.return_value = ('1', '', 'Generating .netrc entry...\n' +
                                    'Must run interactively to update .netrc\n' +
                                    'Unable to update .netrc file\nFor help, see https://docs.nersc.gov/accounts/passwords/\n')
-        mock_getcwd.return_value = 'HOME'
         ls_file = os.path.join(self.tmp.name, 'desi_spectro_data.txt')
         with open(ls_file, 'w') as f:
             f.write(self.fake_hsi2)
@@ -946,22 +1776,19 @@ total size is 118,417,836,324  speedup is 494,367.55
                                          call("os.chmod('%s', 0o%o)", '/desi/root/spectro/data/20190703', 0o2550),
                                          call("os.chmod('%s', 0o%o)", '/desi/root/spectro/data/20190703/00001234', 0o2550),
                                          call("os.chmod('%s', 0o%o)", '/desi/root/spectro/data/20190703/00001235', 0o2550),
-                                         call("os.chdir('%s')", '/desi/root/spectro/data'),
-                                         call('%s -cvhf desi/spectro/data/desi_spectro_data_20190703.tar -H crc:verify=all 20190703' % htar),
-                                         call("os.chdir('%s')", 'HOME')])
+                                         call('%s -cvhf desi/spectro/data/desi_spectro_data_20190703.tar -H crc:verify=all 20190703' % htar)])
         mock_log.critical.assert_has_calls([call("HTAR Backup failed! Command was: {0} -cvhf desi/spectro/data/desi_spectro_data_20190703.tar -H crc:verify=all 20190703.".format(htar) +
                                                  "\nHTAR error message was: Generating .netrc entry...\n" +
                                                  "Must run interactively to update .netrc\n" +
                                                  "Unable to update .netrc file\nFor help, see https://docs.nersc.gov/accounts/passwords/\n")])
-        mock_popen.assert_has_calls([call([htar, '-cvhf', 'desi/spectro/data/desi_spectro_data_20190703.tar', '-H', 'crc:verify=all', '20190703'])])
+        mock_popen.assert_has_calls([call([htar, '-cvhf', 'desi/spectro/data/desi_spectro_data_20190703.tar', '-H', 'crc:verify=all', '20190703'],
+                                          cwd='/desi/root/spectro/data')])
         mock_status.assert_not_called()
         mock_status.update.assert_not_called()
 
     @patch('os.walk')
     @patch('os.chmod')
     @patch('desitransfer.daemon.rsync_night')
-    @patch('os.chdir')
-    @patch('os.getcwd')
     @patch('desitransfer.daemon.empty_rsync')
     @patch('desitransfer.daemon._popen')
     @patch('os.remove')
@@ -971,8 +1798,7 @@ total size is 118,417,836,324  speedup is 494,367.55
     @patch.object(TransferDaemon, '_configure_log')
     def test_TransferDaemon_backup_delayed_data(self, mock_cl, mock_log, mock_status,
                                                 mock_isdir, mock_rm, mock_popen,
-                                                mock_empty, mock_getcwd, mock_chdir,
-                                                mock_rsync, mock_chmod, mock_walk):
+                                                mock_empty, mock_rsync, mock_chmod, mock_walk):
         """Test HPSS backup of night with delayed data.
         """
         with patch.dict('os.environ',
@@ -991,7 +1817,6 @@ total size is 118,417,836,324  speedup is 494,367.55
                                   ('/desi/root/spectro/data/20190703/00001235', [], ['f2'])]
         mock_empty.return_value = False
         mock_popen.return_value = ('0', '', '')
-        mock_getcwd.return_value = 'HOME'
         s = transfer.backup(c[0], '20190703', mock_status)
         self.assertTrue(s)
         hsi = os.path.join(transfer.conf['common']['hpss'], 'hsi')
@@ -1003,19 +1828,97 @@ total size is 118,417,836,324  speedup is 494,367.55
                                          call("os.chmod('%s', 0o%o)", '/desi/root/spectro/data/20190703', 0o2550),
                                          call("os.chmod('%s', 0o%o)", '/desi/root/spectro/data/20190703/00001234', 0o2550),
                                          call("os.chmod('%s', 0o%o)", '/desi/root/spectro/data/20190703/00001235', 0o2550),
-                                         call("os.chdir('%s')", '/desi/root/spectro/data'),
-                                         call('%s -cvhf desi/spectro/data/desi_spectro_data_20190703.tar -H crc:verify=all 20190703' % htar),
-                                         call("os.chdir('%s')", 'HOME')])
+                                         call('%s -cvhf desi/spectro/data/desi_spectro_data_20190703.tar -H crc:verify=all 20190703' % htar)])
         mock_log.warning.assert_has_calls([call('New files detected in %s!', '20190703'),
                                            call('No updated exposures in night %s detected.', '20190703')])
-        mock_rsync.assert_called_once_with('/data/dts/exposures/raw', '/desi/root/spectro/data', '20190703', False)
+        mock_rsync.assert_called_once_with('/data/dts/exposures/raw', '/desi/root/spectro/data', '20190703', False, None, None, None)
         mock_walk.assert_called_once_with('/desi/root/spectro/data/20190703')
         mock_chmod.assert_has_calls([call('/desi/root/spectro/data/20190703', 0o2550),
                                      call('/desi/root/spectro/data/20190703/00001234', 0o2550),
                                      call('/desi/root/spectro/data/20190703/00001235', 0o2550)])
+        mock_popen.assert_has_calls([call([htar, '-cvhf', 'desi/spectro/data/desi_spectro_data_20190703.tar', '-H', 'crc:verify=all', '20190703'],
+                                          cwd='/desi/root/spectro/data')])
         mock_status.assert_not_called()
         mock_status.update.assert_not_called()
 
+    @patch('desitransfer.daemon.TemporaryFile')
+    @patch('subprocess.Popen')
+    @patch('os.walk')
+    @patch('os.chmod')
+    @patch('desitransfer.daemon.rsync_night')
+    @patch('desitransfer.daemon.empty_rsync')
+    @patch('desitransfer.daemon._popen')
+    @patch('os.remove')
+    @patch('os.path.isdir')
+    @patch('desitransfer.daemon.TransferStatus')
+    @patch('desitransfer.daemon.log')
+    @patch.object(TransferDaemon, '_configure_log')
+    def test_TransferDaemon_backup_background(self, mock_cl, mock_log, mock_status, mock_isdir, mock_rm,
+                                              mock_popen, mock_empty, mock_rsync, mock_chmod, mock_walk, mock_Popen, mock_temp):
+        """Test HPSS backup of night with HTAR running in the background.
+        """
+        with patch.dict('os.environ',
+                        {'SCRATCH': self.tmp.name,
+                         'DESI_ROOT': '/desi/root',
+                         'DESI_SPECTRO_DATA': '/desi/root/spectro/data'}):
+            with patch.object(sys, 'argv', ['desi_transfer_daemon', '--debug']):
+                options = _options()
+            transfer = TransferDaemon(options)
+        transfer.conf['common']['background_backup'] = 'true'
+        c = transfer.directories
+        mock_isdir.return_value = True
+        mock_walk.return_value = [('/desi/root/spectro/data/20190703', ['00001234'], [])]
+        mock_empty.return_value = True
+        mock_popen.return_value = ('0', '', '')
+        ls_file = os.path.join(self.tmp.name, 'desi_spectro_data.txt')
+        with open(ls_file, 'w') as f:
+            f.write(self.fake_hsi2)
+        proc = mock_Popen.return_value
+        proc.pid = 12345
+        proc.poll.return_value = None
+        mock_temp.return_value.read.return_value = b''
+        s = transfer.backup(c[0], '20190703', mock_status)
+        self.assertFalse(s)
+        htar = os.path.join(transfer.conf['common']['hpss'], 'htar')
+        cmd = [htar, '-cvhf', 'desi/spectro/data/desi_spectro_data_20190703.tar', '-H', 'crc:verify=all', '20190703']
+        mock_Popen.assert_called_once_with(cmd, stdout=mock_temp(), stderr=mock_temp(), cwd='/desi/root/spectro/data')
+        mock_log.info.assert_has_calls([call("HTAR backup of %s started in the background (pid = %d).", '20190703', 12345)])
+        self.assertNotIn(call(cmd), mock_popen.mock_calls)
+        #
+        # While HTAR is running, the night is not backed up again.
+        #
+        mock_popen.reset_mock()
+        self.assertFalse(transfer.backup(c[0], '20190703', mock_status))
+        mock_popen.assert_not_called()
+        mock_log.debug.assert_has_calls([call("Backup of %s is still running.", '20190703')])
+        self.assertEqual(transfer.backup_jobs(c[0], mock_status), 1)
+        mock_status.update.assert_not_called()
+        #
+        # HTAR finishes.
+        #
+        proc.poll.return_value = 0
+        proc.returncode = 0
+        self.assertEqual(transfer.backup_jobs(c[0], mock_status), 0)
+        mock_log.info.assert_has_calls([call("HTAR backup of %s (pid = %d) finished with status %d.", '20190703', 12345, 0)])
+        mock_status.update.assert_called_once_with('20190703', 'all', 'backup', failure=False)
+        self.assertEqual(len(transfer._backups), 0)
+        #
+        # Shutting down waits for HTAR to finish.
+        #
+        proc2 = MagicMock()
+        proc2.pid = 12346
+        proc2.poll.side_effect = [None, 0]
+        proc2.returncode = 0
+        err = MagicMock()
+        err.read.return_value = b''
+        transfer._backups[(c[0].destination, '20190704')] = transfer._backup_job(proc2, cmd, MagicMock(), err)
+        with patch('time.sleep') as mock_sleep:
+            transfer.shutdown()
+        mock_sleep.assert_called_once_with(60)
+        mock_log.info.assert_has_calls([call("Waiting for %d HTAR backups of %s to finish.", 1, c[0].destination)])
+        mock_status().update.assert_called_once_with('20190704', 'all', 'backup', failure=False)
+        self.assertEqual(len(transfer._backups), 0)
+
     @patch('desitransfer.daemon.rsync_night')
     @patch('desitransfer.daemon.empty_rsync')
     @patch('desitransfer.daemon._popen')
@@ -1045,18 +1948,15 @@ total size is 118,417,836,324  speedup is 494,367.55
         mock_status.assert_not_called()
         mock_status.update.assert_not_called()
 
-    @patch('desitransfer.daemon.TemporaryFile')
-    @patch('subprocess.Popen')
-    def test_popen(self, mock_popen, mock_temp):
-        """Test Popen wrapper.
+    def test_sha256(self):
+        """Test chunked checksum computation.
         """
-        mock_file = mock_temp().__enter__.return_value = MagicMock()
-        mock_file.read.return_value = b'MOCK'
-        proc = mock_popen.return_value = MagicMock()
-        proc.returncode = 0
-        pp = _popen(['foo', 'bar'])
-        self.assertEqual(pp, ('0', 'MOCK', 'MOCK'))
-        mock_popen.assert_called_once_with(['foo', 'bar'], stdout=mock_file, stderr=mock_file)
+        data = b'abcdefghij' * 1000
+        f = os.path.join(self.tmp.name, 'test_file.txt')
+        with open(f, 'wb') as fp:
+            fp.write(data)
+        self.assertEqual(_sha256(f), hashlib.sha256(data).hexdigest())
+        self.assertEqual(_sha256(f, blocksize=7), hashlib.sha256(data).hexdigest())
 
     def test_verify_checksum(self):
         """Test checksum verification.
@@ -1108,55 +2008,116 @@ total size is 118,417,836,324  speedup is 494,367.55
         mock_log.error.assert_has_calls([call("Checksum mismatch for %s in %s!", os.path.join(d, 'test_file_1.txt'), c),
                                          call("Checksum mismatch for %s in %s!", os.path.join(d, 'test_file_2.txt'), c)])
 
-    @patch('os.walk')
-    @patch('os.chmod')
+    def test_verify_checksum_cache(self):
+        """Test checksum verification with a cache of previous results.
+        """
+        e = os.path.join(self.tmp.name, '20190703', '00000127')
+        os.makedirs(e)
+        for f in ('test_file_1.txt', 'test_file_2.txt'):
+            shutil.copy(os.path.join(str(ir.files('desitransfer.test')), 't', f), e)
+        c = os.path.join(e, 'checksum-00000127.sha256sum')
+        shutil.copy(os.path.join(str(ir.files('desitransfer.test')), 't', 't.sha256sum'), c)
+        cache_file = os.path.join(self.tmp.name, 'cache.json')
+        cache = ChecksumCache(cache_file)
+        with patch('desitransfer.daemon.log') as mock_log:
+            o = verify_checksum(c, cache=cache)
+        self.assertEqual(o, "")
+        self.assertTrue(os.path.exists(cache_file))
+        self.assertEqual(len(cache.cache['20190703/00000127']['files']), 2)
+        #
+        # A new cache object should pick up the saved data, and no files
+        # should be hashed.
+        #
+        cache = ChecksumCache(cache_file)
+        with patch('desitransfer.daemon._sha256') as mock_sha:
+            with patch('desitransfer.daemon.log') as mock_log:
+                o = verify_checksum(c, cache=cache)
+        self.assertEqual(o, "")
+        mock_sha.assert_not_called()
+        mock_log.debug.assert_has_calls([call("Using cached checksum for %s.", os.path.join(e, 'test_file_1.txt')),
+                                         call("Using cached checksum for %s.", os.path.join(e, 'test_file_2.txt'))],
+                                        any_order=True)
+        #
+        # Changing a file forces it to be hashed again.
+        #
+        with open(os.path.join(e, 'test_file_2.txt'), 'a') as f:
+            f.write('changed\n')
+        with patch('desitransfer.daemon.log') as mock_log:
+            o = verify_checksum(c, cache=cache)
+        self.assertEqual(o, "test_file_2.txt had a checksum mismatch.\n")
+        #
+        # Changing the checksum file invalidates the whole exposure.
+        #
+        st = os.stat(c)
+        os.utime(c, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        with patch('desitransfer.daemon._sha256') as mock_sha:
+            mock_sha.return_value = 'abcdef'
+            with patch('desitransfer.daemon.log') as mock_log:
+                o = verify_checksum(c, cache=cache)
+        self.assertEqual(mock_sha.call_count, 2)
+
+    def _make_tree(self):
+        """Create a small directory tree for testing locking.
+        """
+        d0 = os.path.join(self.tmp.name, 'd0')
+        for d in ('d1', 'd2'):
+            os.makedirs(os.path.join(d0, d))
+        for f in ('f1', 'f2', os.path.join('d1', 'f3'), os.path.join('d2', 'f4')):
+            with open(os.path.join(d0, f), 'w') as ff:
+                ff.write(f)
+        os.chmod(os.path.join(d0, 'd2', 'f4'), 0o0440)
+        return d0
+
+    def _modes(self, d0):
+        """Collect the modes of the tree created by :meth:`_make_tree`.
+        """
+        modes = dict()
+        for p in ('', 'd1', 'd2', 'f1', 'f2', os.path.join('d1', 'f3'), os.path.join('d2', 'f4')):
+            modes[p] = stat.S_IMODE(os.stat(os.path.join(d0, p)).st_mode)
+        return modes
+
     @patch('desitransfer.daemon.log')
-    def test_lock_directory(self, mock_log, mock_chmod, mock_walk):
+    def test_lock_directory(self, mock_log):
         """Test directory locking.
         """
-        mock_walk.return_value = [('/d0', ['d1', 'd2'], ['f1', 'f2']),
-                                  ('/d0/d1', [], ['f3']),
-                                  ('/d0/d2', [], ['f4'])]
-        lock_directory('/d0')
-        mock_log.debug.assert_has_calls([call("os.chmod('%s', 0o%o)", '/d0', 0o2750),
-                                         call("os.chmod('%s', 0o%o)", '/d0/f1', 0o0440),
-                                         call("os.chmod('%s', 0o%o)", '/d0/f2', 0o0440),
-                                         call("os.chmod('%s', 0o%o)", '/d0/d1', 0o2750),
-                                         call("os.chmod('%s', 0o%o)", '/d0/d1/f3', 0o0440),
-                                         call("os.chmod('%s', 0o%o)", '/d0/d2', 0o2750),
-                                         call("os.chmod('%s', 0o%o)", '/d0/d2/f4', 0o0440)])
-        mock_chmod.assert_has_calls([call('/d0', 0o2750),
-                                     call('/d0/f1', 0o0440),
-                                     call('/d0/f2', 0o0440),
-                                     call('/d0/d1', 0o2750),
-                                     call('/d0/d1/f3', 0o0440),
-                                     call('/d0/d2', 0o2750),
-                                     call('/d0/d2/f4', 0o0440)])
+        d0 = self._make_tree()
+        before = self._modes(d0)
+        lock_directory(d0, True)
+        self.assertEqual(self._modes(d0), before)
+        mock_log.debug.reset_mock()
+        lock_directory(d0)
+        self.assertEqual(self._modes(d0), {'': 0o2750, 'd1': 0o2750, 'd2': 0o2750,
+                                           'f1': 0o0440, 'f2': 0o0440, 'd1/f3': 0o0440, 'd2/f4': 0o0440})
+        #
+        # Files already at the correct mode, like d2/f4, are skipped.
+        #
+        mock_log.debug.assert_has_calls([call("os.chmod('%s', 0o%o)", d0, 0o2750),
+                                         call("os.chmod('%s', 0o%o)", d0 + '/f1', 0o0440),
+                                         call("os.chmod('%s', 0o%o)", d0 + '/f2', 0o0440),
+                                         call("os.chmod('%s', 0o%o)", d0 + '/d1', 0o2750),
+                                         call("os.chmod('%s', 0o%o)", d0 + '/d1/f3', 0o0440),
+                                         call("os.chmod('%s', 0o%o)", d0 + '/d2', 0o2750)])
+        self.assertEqual(len(mock_log.debug.mock_calls), 6)
+        mock_log.debug.reset_mock()
+        lock_directory(d0)
+        mock_log.debug.assert_not_called()
+        lock_directory(os.path.join(self.tmp.name, 'does-not-exist'))
+        mock_log.debug.assert_not_called()
 
-    @patch('os.walk')
-    @patch('os.chmod')
     @patch('desitransfer.daemon.log')
-    def test_unlock_directory(self, mock_log, mock_chmod, mock_walk):
+    def test_unlock_directory(self, mock_log):
         """Test directory unlocking.
         """
-        mock_walk.return_value = [('/d0', ['d1', 'd2'], ['f1', 'f2']),
-                                  ('/d0/d1', [], ['f3']),
-                                  ('/d0/d2', [], ['f4'])]
-        unlock_directory('/d0')
-        mock_log.debug.assert_has_calls([call("os.chmod('%s', 0o%o)", '/d0', 0o2750),
-                                         call("os.chmod('%s', 0o%o)", '/d0/f1', 0o0640),
-                                         call("os.chmod('%s', 0o%o)", '/d0/f2', 0o0640),
-                                         call("os.chmod('%s', 0o%o)", '/d0/d1', 0o2750),
-                                         call("os.chmod('%s', 0o%o)", '/d0/d1/f3', 0o0640),
-                                         call("os.chmod('%s', 0o%o)", '/d0/d2', 0o2750),
-                                         call("os.chmod('%s', 0o%o)", '/d0/d2/f4', 0o0640)])
-        mock_chmod.assert_has_calls([call('/d0', 0o2750),
-                                     call('/d0/f1', 0o0640),
-                                     call('/d0/f2', 0o0640),
-                                     call('/d0/d1', 0o2750),
-                                     call('/d0/d1/f3', 0o0640),
-                                     call('/d0/d2', 0o2750),
-                                     call('/d0/d2/f4', 0o0640)])
+        d0 = self._make_tree()
+        lock_directory(d0)
+        mock_log.debug.reset_mock()
+        unlock_directory(d0, only=['d1'])
+        self.assertEqual(self._modes(d0), {'': 0o2750, 'd1': 0o2750, 'd2': 0o2750,
+                                           'f1': 0o0640, 'f2': 0o0640, 'd1/f3': 0o0640, 'd2/f4': 0o0440})
+        self.assertEqual(len(mock_log.debug.mock_calls), 3)
+        mock_log.debug.assert_any_call("os.chmod('%s', 0o%o)", d0 + '/d1/f3', 0o0640)
+        unlock_directory(d0)
+        self.assertEqual(self._modes(d0)['d2/f4'], 0o0640)
 
     @patch('desitransfer.daemon._popen')
     @patch('desitransfer.daemon.lock_directory')
@@ -1171,11 +2132,36 @@ total size is 118,417,836,324  speedup is 494,367.55
         mock_popen.return_value = ('0', 'stdout', 'stderr')
         rsync_night('/source', '/destination', '20190703', True)
         mock_log.debug.assert_called_with(' '.join(cmd))
-        rsync_night('/source', '/destination', '20190703')
-        mock_popen.assert_called_with(cmd)
+        rsync_night('/source', '/destination', '20190703', timeout=3600)
+        mock_popen.assert_called_with(cmd, timeout=3600)
         mock_popen.return_value = ('1', 'stdout', 'stderr')
         rsync_night('/source', '/destination', '20190703')
         mock_log.critical.assert_called_once_with('rsync problem (status = %s) detected on catch-up for %s, check logs!',
                                                   '1', '20190703')
         mock_log.error.assert_has_calls([call('rsync STDOUT = \n%s', 'stdout'),
                                          call('rsync STDERR = \n%s', 'stderr')])
+        #
+        # Restrict rsync to a few exposures.
+        #
+        mock_popen.return_value = ('0', 'stdout', 'stderr')
+        self.assertTrue(rsync_night('/source', '/destination', '20190703', exposures={'00001235', '00001234'},
+                                    restrict=True))
+        mock_popen.assert_called_with(cmd[:6] + ['--include=/00001234/***', '--include=/00001235/***', '--exclude=/*/'] +
+                                      cmd[6:], timeout=None)
+        mock_lock.assert_called_with('/destination/20190703', False, {'00001235', '00001234'})
+
+    def test_manifest(self):
+        """Test summarizing exposures in a night.
+        """
+        n = os.path.join(self.tmp.name, '20190703')
+        os.makedirs(os.path.join(n, '00001234'))
+        for f, size, mtime in (('00001234/a.fits', 10, 1562000000), ('00001234/b.json', 5, 1562000100),
+                               ('README.txt', 3, 1562000200)):
+            with open(os.path.join(n, f), 'w') as o:
+                o.write('x' * size)
+            os.utime(os.path.join(n, f), (mtime, mtime))
+        m = _manifest(n)
+        self.assertDictEqual(m, {'00001234': [2, 15, 1562000100], '.': [1, 3, 1562000200]})
+        self.assertDictEqual(_manifest(os.path.join(self.tmp.name, '20190704')), {})
+        self.assertDictEqual(_parse_manifest('00001234 2 15 1562000100\n. 1 3 1562000200\n\n'), m)
+        self.assertDictEqual(_parse_manifest(''), {})
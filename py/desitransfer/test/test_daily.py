@@ -3,8 +3,10 @@
 """Test desitransfer.daily.
 """
 import os
+import stat
 import sys
 import unittest
+from tempfile import TemporaryDirectory
 from unittest.mock import patch, call, mock_open, Mock
 from ..daily import _config, _options, DailyDirectory
 from .. import __version__ as dtVersion
@@ -69,65 +71,113 @@ class TestDaily(unittest.TestCase):
                                  os.path.join(os.environ['HOME'],
                                               'stop_daily_transfer'))
 
+    @patch('os.path.exists')
+    @patch.object(DailyDirectory, 'permission')
     @patch('os.walk')
     @patch('os.stat')
     @patch('os.chmod')
-    @patch('subprocess.Popen')
+    @patch('desitransfer.daily._popen')
     @patch('desitransfer.daily.stamp')
     @patch('builtins.open', new_callable=mock_open)
-    def test_transfer(self, mo, mock_stamp, mock_popen, mock_chmod, mock_stat, mock_walk):
+    def test_transfer(self, mo, mock_stamp, mock_popen, mock_chmod, mock_stat, mock_walk, mock_permission, mock_exists):
         """Test the transfer functions in DailyDirectory.transfer().
         """
-        mock_walk.return_value = [('/dst/d0', [], ['f1', 'f2'])]
-        mode = Mock()
-        mode.st_mode = 137
-        mock_stat.return_value = mode
+        dir_mode = Mock()
+        dir_mode.st_mode = stat.S_IFDIR | 0o0755
+        file_mode = Mock()
+        file_mode.st_mode = stat.S_IFREG | 0o0644
+        mock_stat.side_effect = lambda p: dir_mode if p == '/dst/d0' else file_mode
+        mock_exists.return_value = False
         mock_stamp.return_value = '2019-07-03'
-        mock_popen().wait.return_value = 0
+        out = 'cd+++++++++ 4096 ./\n>f+++++++++ 10 f1\n>f..t...... 20 f2\n'
+        mock_popen.return_value = ('0', out, '')
         d = DailyDirectory('/src/d0', '/dst/d0')
         d.transfer()
         mo.assert_has_calls([call('/dst/d0.log', 'ab'),
                              call().__enter__(),
                              call().write(('DEBUG: desi_daily_transfer {}\n'.format(dtVersion)).encode('utf-8')),
-                             call().write(b'DEBUG: /bin/rsync --verbose --recursive --links --times --omit-dir-times dts:/src/d0/ /dst/d0/\n'),
+                             call().write(b'DEBUG: /bin/rsync --verbose --recursive --links --times --omit-dir-times --out-format=%i %l %n dts:/src/d0/ /dst/d0/\n'),
                              call().write(b'DEBUG: Transfer start: 2019-07-03\n'),
                              call().flush(),
+                             call().write(out.encode('utf-8')),
                              call().write(b'DEBUG: Transfer complete: 2019-07-03\n'),
                              call().__exit__(None, None, None)])
-        mock_walk.assert_called_once_with('/dst/d0')
+        mock_popen.assert_called_once_with(['/bin/rsync', '--verbose', '--recursive', '--links', '--times',
+                                            '--omit-dir-times', '--out-format=%i %l %n',
+                                            'dts:/src/d0/', '/dst/d0/'], timeout=None)
+        mock_walk.assert_not_called()
         mock_chmod.assert_has_calls([call('/dst/d0', 0o2750),
                                      call('/dst/d0/f1', 0o0440),
                                      call('/dst/d0/f2', 0o0440)])
+        mock_permission.assert_called_once_with()
 
+    @patch('os.path.exists')
+    @patch.object(DailyDirectory, 'permission')
     @patch('os.walk')
     @patch('os.stat')
     @patch('os.chmod')
-    @patch('subprocess.Popen')
+    @patch('desitransfer.daily._popen')
     @patch('desitransfer.daily.stamp')
     @patch('builtins.open', new_callable=mock_open)
-    def test_transfer_extra(self, mo, mock_stamp, mock_popen, mock_chmod, mock_stat, mock_walk):
+    def test_transfer_extra(self, mo, mock_stamp, mock_popen, mock_chmod, mock_stat, mock_walk, mock_permission, mock_exists):
         """Test the transfer functions in DailyDirectory.transfer() with extra options.
         """
-        mock_walk.return_value = [('/dst/d0', [], ['f1', 'f2'])]
-        mode = Mock()
-        mode.st_mode = 137
-        mock_stat.return_value = mode
+        mock_exists.return_value = False
         mock_stamp.return_value = '2019-07-03'
-        mock_popen().wait.return_value = 0
+        mock_popen.return_value = ('0', '', 'warning\n')
         d = DailyDirectory('/src/d0', '/dst/d0', extra=['--exclude-from', 'foo'])
-        d.transfer()
+        d.transfer(timeout=60)
         mo.assert_has_calls([call('/dst/d0.log', 'ab'),
                              call().__enter__(),
                              call().write(('DEBUG: desi_daily_transfer {}\n'.format(dtVersion)).encode('utf-8')),
-                             call().write(b'DEBUG: /bin/rsync --verbose --recursive --links --times --omit-dir-times --exclude-from foo dts:/src/d0/ /dst/d0/\n'),
+                             call().write(b'DEBUG: /bin/rsync --verbose --recursive --links --times --omit-dir-times --exclude-from foo --out-format=%i %l %n dts:/src/d0/ /dst/d0/\n'),
                              call().write(b'DEBUG: Transfer start: 2019-07-03\n'),
                              call().flush(),
+                             call().write(b'warning\n'),
                              call().write(b'DEBUG: Transfer complete: 2019-07-03\n'),
                              call().__exit__(None, None, None)])
-        mock_walk.assert_called_once_with('/dst/d0')
-        mock_chmod.assert_has_calls([call('/dst/d0', 0o2750),
-                                     call('/dst/d0/f1', 0o0440),
-                                     call('/dst/d0/f2', 0o0440)])
+        #
+        # Nothing changed, so nothing needs to be locked.
+        #
+        mock_walk.assert_not_called()
+        mock_stat.assert_not_called()
+        mock_chmod.assert_not_called()
+        mock_permission.assert_not_called()
+
+    @patch.object(DailyDirectory, 'permission')
+    @patch('desitransfer.daily._popen')
+    def test_transfer_after_failure(self, mock_popen, mock_permission):
+        """Test that a successful transfer after a failed one locks everything.
+        """
+        with TemporaryDirectory() as tmp:
+            dst = os.path.join(tmp, 'd0')
+            os.makedirs(os.path.join(dst, 'd1'))
+            f1 = os.path.join(dst, 'd1', 'f1')
+            with open(f1, 'w') as f:
+                f.write('f1\n')
+            os.chmod(f1, 0o0644)
+            d = DailyDirectory('/src/d0', dst)
+            mock_popen.return_value = ('23', '>f+++++++++ 3 d1/f1\n', 'some files vanished\n')
+            self.assertEqual(d.transfer(), 23)
+            self.assertTrue(os.path.exists(d.failed))
+            self.assertEqual(stat.S_IMODE(os.stat(f1).st_mode), 0o0644)
+            mock_permission.assert_not_called()
+            #
+            # Nothing changes on the next run, but the files from the failed run are locked.
+            #
+            mock_popen.return_value = ('0', '', '')
+            self.assertEqual(d.transfer(), 0)
+            self.assertFalse(os.path.exists(d.failed))
+            self.assertEqual(stat.S_IMODE(os.stat(f1).st_mode), 0o0440)
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.join(dst, 'd1')).st_mode), 0o2750)
+            mock_permission.assert_called_once_with()
+            #
+            # After a clean run, only changes are locked.
+            #
+            os.chmod(f1, 0o0644)
+            self.assertEqual(d.transfer(), 0)
+            self.assertEqual(stat.S_IMODE(os.stat(f1).st_mode), 0o0644)
+            mock_permission.assert_called_once_with()
 
     @patch('os.walk')
     @patch('os.stat')
@@ -6,11 +6,13 @@ import importlib.resources as ir
 import json
 import os
 import shutil
+import sqlite3
 import sys
 import unittest
 from unittest.mock import patch, call
 from tempfile import TemporaryDirectory
-from ..status import TransferStatus, _options
+from io import StringIO
+from ..status import TransferStatus, _options, _read_updates, main
 
 
 class TestStatus(unittest.TestCase):
@@ -42,6 +44,75 @@ class TestStatus(unittest.TestCase):
                 self.assertEqual(options.expid, '12345678')
                 self.assertEqual(options.stage, 'rsync')
 
+    def test_options_from_file(self):
+        """Test command-line arguments for bulk updates.
+        """
+        with patch.dict('os.environ', {'DESI_ROOT': '/desi'}):
+            with patch.object(sys, 'argv', ['desi_transfer_status', '--from-file', '-']):
+                options = _options()
+                self.assertEqual(options.from_file, '-')
+                self.assertIsNone(options.night)
+            with patch.object(sys, 'argv', ['desi_transfer_status', '20190703']):
+                with patch('sys.stderr', new_callable=StringIO):
+                    with self.assertRaises(SystemExit):
+                        options = _options()
+
+    @patch('desitransfer.status.log')
+    def test_read_updates(self, mock_log):
+        """Test parsing of bulk status updates.
+        """
+        lines = ['# night expid stage\n', '20200703 12345677 rsync\n', '\n',
+                 '20200703 12345677 checksum failure\n', '20200703 all backup\n',
+                 '20200703 12345677 foo\n', '2020073 12345677 rsync\n', '20200703 abc rsync\n',
+                 '20200703 12345678 checksum 0\n', '20200703 12345678 checksum maybe\n']
+        updates, errors = _read_updates(lines)
+        self.assertListEqual(updates, [('20200703', '12345677', 'rsync', False),
+                                       ('20200703', '12345677', 'checksum', True),
+                                       ('20200703', 'all', 'backup', False),
+                                       ('20200703', '12345678', 'checksum', False)])
+        self.assertEqual(errors, 4)
+        mock_log.error.assert_any_call("Could not parse line %d: '%s'.", 6, '20200703 12345677 foo')
+
+    @patch('desitransfer.status.log')
+    @patch('time.time')
+    def test_main_from_file(self, mock_time, mock_log):
+        """Test applying many updates at once.
+        """
+        mock_time.return_value = 1565300090
+        with TemporaryDirectory() as d:
+            js = os.path.join(d, 'desi_transfer_status_2020.json')
+            with open(js, 'w') as f:
+                json.dump(self.fake_status, f, indent=None, separators=(',', ':'))
+            updates = os.path.join(d, 'updates.txt')
+            with open(updates, 'w') as f:
+                f.write('20200703 12345680 rsync\n20200703 12345680 checksum\n' +
+                        '20210101 00012345 rsync\n20200703 all backup\n20200704 all backup\n')
+            with patch.dict('os.environ', {'DESI_ROOT': '/desi'}):
+                with patch.object(sys, 'argv', ['desi_transfer_status', '--directory', d, '--from-file', updates]):
+                    with patch.object(TransferStatus, '_write', autospec=True,
+                                      side_effect=TransferStatus._write) as mock_write:
+                        r = main()
+            self.assertEqual(r, 1)
+            self.assertEqual(mock_write.call_count, 2)
+            mock_log.error.assert_called_once_with("Undefined night = '%s'!", '20200704')
+            mock_log.info.assert_called_once_with("Applied %d updates with %d errors.", 4, 1)
+            with open(js) as f:
+                data = json.load(f)
+            self.assertEqual(data['20200703']['12345680'], [[2, 1, 1565300090000], [1, 1, 1565300090000],
+                                                            [0, 1, 1565300090000]])
+            with open(os.path.join(d, 'desi_transfer_status_2021.json')) as f:
+                self.assertDictEqual(json.load(f), {'20210101': {'12345': [[0, 1, 1565300090000]]}})
+            #
+            # Standard input.
+            #
+            with patch.dict('os.environ', {'DESI_ROOT': '/desi'}):
+                with patch.object(sys, 'argv', ['desi_transfer_status', '--directory', d, '--from-file', '-']):
+                    with patch('sys.stdin', StringIO('20200703 12345681 rsync\n')):
+                        r = main()
+            self.assertEqual(r, 0)
+            with open(js) as f:
+                self.assertIn('12345681', json.load(f)['20200703'])
+
     def test_TransferStatus_init(self):
         """Test status reporting mechanism setup.
         """
@@ -185,6 +256,266 @@ class TestStatus(unittest.TestCase):
                         c += 1
             self.assertEqual(c, 3)
 
+    @patch('time.time')
+    def test_TransferStatus_batch(self, mock_time):
+        """Test batched status updates.
+        """
+        mock_time.return_value = 1565300090
+        with TemporaryDirectory() as d:
+            js = os.path.join(d, 'desi_transfer_status_2020.json')
+            with open(js, 'w') as f:
+                json.dump(self.fake_status, f, indent=None, separators=(',', ':'))
+            os.chmod(js, 0o644)
+            s = TransferStatus(d, year=2020)
+            with patch.object(s, '_write', wraps=s._write) as mock_write:
+                with s.batch():
+                    s.update('20200703', '12345677', 'checksum')
+                    with s.batch():
+                        s.update('20200703', '12345678', 'checksum')
+                    s.update('20200703', '12345680', 'rsync')
+                    mock_write.assert_not_called()
+                    with open(js) as f:
+                        self.assertDictEqual(json.load(f), self.fake_status)
+                mock_write.assert_called_once_with()
+                with open(js) as f:
+                    self.assertDictEqual(json.load(f), s.status)
+                #
+                # Updates are written even if an exception occurs.
+                #
+                with self.assertRaises(ValueError):
+                    with s.batch():
+                        s.update('20200703', '12345681', 'rsync')
+                        raise ValueError('foo')
+                self.assertEqual(mock_write.call_count, 2)
+                with open(js) as f:
+                    self.assertIn('12345681', json.load(f)['20200703'])
+            #
+            # The file is replaced, not rewritten, and keeps its mode.
+            #
+            self.assertEqual(os.stat(js).st_mode & 0o777, 0o644)
+            self.assertListEqual(sorted(os.listdir(d)), ['desi_transfer_status_2020.json',
+                                                         'desi_transfer_status_2020.json.bak'])
+            #
+            # Batched journal records are appended together.
+            #
+            s = TransferStatus(d, year=2020, journal=10)
+            with patch.object(s, '_append', wraps=s._append) as mock_append:
+                with s.batch():
+                    s.update('20200703', '12345682', 'rsync')
+                    s.update('20200703', '12345682', 'checksum')
+                mock_append.assert_called_once_with(['20200703', '12345682', [0, 1, 1565300090000]],
+                                                    ['20200703', '12345682', [1, 1, 1565300090000]])
+            self.assertEqual(s.compact(), 2)
+
+    @patch('time.time')
+    def test_TransferStatus_merge(self, mock_time):
+        """Test that an out-of-date status object does not erase other updates.
+        """
+        mock_time.return_value = 1565300090
+        with TemporaryDirectory() as d:
+            js = os.path.join(d, 'desi_transfer_status_2020.json')
+            with open(js, 'w') as f:
+                json.dump(self.fake_status, f, indent=None, separators=(',', ':'))
+            stale = TransferStatus(d, year=2020)
+            s = TransferStatus(d, year=2020)
+            s.update('20200703', '12345681', 'rsync')
+            with s.batch():
+                s.update('20200703', '12345682', 'rsync')
+                s.update('20200703', '12345682', 'checksum')
+            stale.update('20200703', '12345677', 'checksum')
+            with open(js) as f:
+                status = json.load(f)
+            self.assertEqual(status['20200703']['12345681'], [[0, 1, 1565300090000]])
+            self.assertEqual(status['20200703']['12345682'], [[1, 1, 1565300090000], [0, 1, 1565300090000]])
+            self.assertEqual(status['20200703']['12345677'][0], [1, 1, 1565300090000])
+            self.assertDictEqual(stale.status, status)
+            #
+            # The file is only read again if it has changed, and the index is kept.
+            #
+            with patch.object(stale, '_read', wraps=stale._read) as mock_read:
+                stale.update('20200703', '12345678', 'checksum')
+                mock_read.assert_not_called()
+                self.assertIn(('20200703', '12345678'), stale._index)
+                s.update('20200703', '12345683', 'rsync')
+                stale.update('20200703', '12345683', 'checksum')
+                mock_read.assert_called_once_with()
+            with open(js) as f:
+                self.assertDictEqual(json.load(f), stale.status)
+            self.assertEqual(stale.status['20200703']['12345683'], [[1, 1, 1565300090000], [0, 1, 1565300090000]])
+
+    @patch('time.time')
+    def test_TransferStatus_journal(self, mock_time):
+        """Test status updates in journal mode.
+        """
+        mock_time.return_value = 1565300090
+        with TemporaryDirectory() as d:
+            js = os.path.join(d, 'desi_transfer_status_2020.json')
+            jn = os.path.join(d, 'desi_transfer_status_2020.journal')
+            with open(js, 'w') as f:
+                json.dump(self.fake_status, f, indent=None, separators=(',', ':'))
+            s = TransferStatus(d, year=2020, journal=10)
+            r = s.update('20200703', '12345677', 'checksum')
+            self.assertEqual(r, 1)
+            r = s.update('20200703', '12345680', 'rsync')
+            self.assertEqual(r, 1)
+            self.assertEqual(s.status['20200703']['12345680'][0], [0, 1, 1565300090000])
+            #
+            # The JSON file has not changed yet.
+            #
+            with open(js) as f:
+                self.assertDictEqual(json.load(f), self.fake_status)
+            with open(jn) as f:
+                self.assertListEqual(f.readlines(), ['["20200703","12345677",[1,1,1565300090000]]\n',
+                                                     '["20200703","12345680",[0,1,1565300090000]]\n'])
+            #
+            # A new object sees journaled updates, even a partial record.
+            #
+            with open(jn, 'a') as f:
+                f.write('["20200703","1234')
+            s2 = TransferStatus(d, year=2020, journal=10)
+            self.assertDictEqual(s2.status, s.status)
+            #
+            # Updates from both objects are merged.
+            #
+            r = s2.update('20200703', 'all', 'backup')
+            self.assertEqual(r, 3)
+            r = s.update('20200703', '12345681', 'rsync')
+            self.assertEqual(s.compact(), 4)
+            self.assertEqual(s2.compact(), 0)
+            self.assertEqual(os.path.getsize(jn), 0)
+            with open(js) as f:
+                data = json.load(f)
+            self.assertDictEqual(data, s.status)
+            self.assertEqual(data['20200703']['12345677'], [[2, 1, 1565300090000], [1, 1, 1565300090000],
+                                                            [0, 1, 1565300073000]])
+            self.assertEqual(data['20200703']['12345681'], [[0, 1, 1565300090000]])
+            #
+            # Automatic compaction.
+            #
+            s4 = TransferStatus(d, year=2020, journal=1)
+            s4.update('20200703', '12345681', 'checksum')
+            self.assertEqual(os.path.getsize(jn), 0)
+            with open(js) as f:
+                self.assertEqual(json.load(f)['20200703']['12345681'][0], [1, 1, 1565300090000])
+            #
+            # Without journal mode, the journal is ignored.
+            #
+            with open(jn, 'w') as f:
+                f.write('["20200703","12345682",[0,1,1565300090000]]\n')
+            s3 = TransferStatus(d, year=2020)
+            self.assertNotIn('12345682', s3.status['20200703'])
+            self.assertEqual(s3.compact(), 0)
+
+    @patch('time.time')
+    def test_TransferStatus_index(self, mock_time):
+        """Test that indexed lookups agree with the status data.
+        """
+        def brute(s, night, expid, stage):
+            return [k for k, r in enumerate(s.status[night][expid]) if r[0] == s._stages[stage]]
+
+        with TemporaryDirectory() as d:
+            js = os.path.join(d, 'desi_transfer_status_2020.json')
+            with open(js, 'w') as f:
+                json.dump({"20200703": {"12345677": [[2, 1, 1565300090000], [1, 1, 1565300080000],
+                                                     [0, 1, 1565300073000]],
+                                        "12345678": [[2, 1, 1565300090000], [0, 1, 1565300074664]]}},
+                          f, indent=None, separators=(',', ':'))
+            s = TransferStatus(d, year=2020)
+            self.assertIs(s.status['20200703']['12345677'][0], s.status['20200703']['12345678'][0])
+            self.assertListEqual(s.find('20200703', '12345677', 'rsync'), [2])
+            self.assertDictEqual(s.find('20200703', stage='checksum'), {'12345677': [1], '12345678': []})
+            mock_time.return_value = 1565300100
+            s.update('20200703', '12345678', 'checksum', failure=True)
+            s.update('20200703', '12345679', 'rsync')
+            s.update('20200703', 'all', 'backup')
+            mock_time.return_value = 1565300200
+            s.update('20200703', '12345678', 'checksum')
+            for expid in s.status['20200703']:
+                for stage in s._stages:
+                    self.assertListEqual(s.find('20200703', expid, stage), brute(s, '20200703', expid, stage))
+            self.assertListEqual(s.find('20200703', '12345678', 'backup'), [0, 2])
+            self.assertEqual(s.status['20200703']['12345678'][1], [1, 1, 1565300200000])
+            #
+            # The index is rebuilt if the rows are changed directly.
+            #
+            s.find('20200703', '12345678').insert(0, [0, 0, 1565300300000])
+            self.assertListEqual(s.find('20200703', '12345678', 'rsync'), [0, 4])
+            self.assertListEqual(s.find('20200703', '12345680', 'rsync'), [])
+
+    @patch('time.time')
+    def test_TransferStatus_database(self, mock_time):
+        """Test status updates stored in an SQLite database.
+        """
+        mock_time.return_value = 1565300090
+        with TemporaryDirectory() as d:
+            js = os.path.join(d, 'desi_transfer_status_2020.json')
+            db = os.path.join(d, 'status.db')
+            with open(js, 'w') as f:
+                json.dump(self.fake_status, f, indent=None, separators=(',', ':'))
+            #
+            # Existing data are imported.
+            #
+            s = TransferStatus(d, year=2020, database=db)
+            self.assertEqual(s.journal, 0)
+            self.assertDictEqual(s.status, self.fake_status)
+            r = s.update('20200703', '12345677', 'checksum')
+            self.assertEqual(r, 1)
+            self.assertEqual(s.status['20200703']['12345677'], [[1, 1, 1565300090000], [0, 1, 1565300073000]])
+            with open(js) as f:
+                self.assertDictEqual(json.load(f), s.status)
+            r = s.update('20200703', '12345677', 'checksum', failure=True)
+            self.assertEqual(r, 1)
+            self.assertEqual(s.status['20200703']['12345677'][0], [1, 0, 1565300090000])
+            mock_time.return_value = 1565300000
+            r = s.update('20200703', '12345677', 'rsync', failure=True)
+            self.assertEqual(r, 0)
+            mock_time.return_value = 1565300090
+            #
+            # A second writer does not import again, and its updates are seen by the first.
+            #
+            s2 = TransferStatus(d, year=2020, database=db)
+            self.assertDictEqual(s2.status, s.status)
+            s2.update('20200703', '12345680', 'rsync')
+            with s.batch():
+                s.update('20200704', '12345690', 'rsync')
+                r = s.update('20200703', 'all', 'backup')
+                self.assertEqual(r, 3)
+                with open(js) as f:
+                    self.assertNotIn('20200704', json.load(f))
+            with open(js) as f:
+                data = json.load(f)
+            self.assertDictEqual(data, s.status)
+            self.assertEqual(data['20200703']['12345680'], [[2, 1, 1565300090000], [0, 1, 1565300090000]])
+            self.assertEqual(data['20200704']['12345690'], [[0, 1, 1565300090000]])
+            self.assertListEqual(s.find('20200703', '12345677', 'checksum'), [1])
+            with self.assertRaises(KeyError):
+                s.update('20200705', 'all', 'backup')
+            conn = sqlite3.connect(db)
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM status').fetchone()[0], 8)
+            conn.close()
+            #
+            # Throttled export.
+            #
+            s3 = TransferStatus(d, year=2020, database=db, export=60)
+            s3.update('20200704', '12345691', 'rsync')
+            with open(js) as f:
+                self.assertIn('12345691', json.load(f)['20200704'])
+            mock_time.return_value = 1565300100
+            s3.update('20200704', '12345692', 'rsync')
+            with open(js) as f:
+                self.assertNotIn('12345692', json.load(f)['20200704'])
+            s2.update('20200704', '12345693', 'rsync')
+            self.assertEqual(s3.compact(), 1)
+            with open(js) as f:
+                data = json.load(f)
+            self.assertIn('12345692', data['20200704'])
+            self.assertIn('12345693', data['20200704'])
+            self.assertEqual(s3.compact(), 0)
+            mock_time.return_value = 1565300160
+            s3.update('20200704', '12345694', 'rsync')
+            with open(js) as f:
+                self.assertIn('12345694', json.load(f)['20200704'])
+
     @patch('time.time')
     def test_TransferStatus_edge_case(self, mock_time):
         """Test edge case when desitransfer.daemon is running in test mode.